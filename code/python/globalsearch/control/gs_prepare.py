@@ -4,10 +4,12 @@
 Script to check parameters and prepare for submission
 """
 import argparse
+import asyncio
 import json
-import os, sys, glob, subprocess
-from rpy2.robjects.packages import importr, PackageNotInstalledError
-import rpy2
+import os, re, sys, glob, subprocess
+import shutil
+
+from globalsearch.rnaseq.fastq_preflight import run_preflight
 
 
 DESCRIPTION = """gs_prepare.py - prepare data for workflow submission"""
@@ -21,12 +23,26 @@ OUTSAM_ATTRS_SPECIAL = { "None", "Standard", "All" }
 OUTSAM_ATTRS_MULTI = OUTSAM_ATTRS_STD | OUTSAM_ATTRS_EXT | OUTSAM_ATTRS_EXT2
 OUTSAM_ATTRS_SINGLE = OUTSAM_ATTRS_STD | OUTSAM_ATTRS_EXT | OUTSAM_ATTRS_EXT2 | OUTSAM_ATTRS_SPECIAL
 
+# version checks of the tools, in the order of the output
+TOOL_CHECKS = {
+    'STAR': {},
+    'salmon': {'num_info_components': 2, 'check_version': "0.13.1"},
+    'kallisto': {'version_switch': "version", 'num_info_components': 3, 'fail_if_not_exists': False},
+    'htseq-count': {},
+    'samtools': {'multiline': True, 'num_info_components': 2},
+    'trim_galore': {'num_info_components': 2, 'multiline': True, 'info_line': 3}
+}
+# kallisto pseudo --quant, which the kallisto_batch mode runs, exists from 0.46.2 up to 0.48
+KALLISTO_BATCH_VERSIONS = ((0, 46, 2), (0, 49))
+# results of the tool and R library checks, they are valid as long as the
+# checked files are unchanged
+PROBE_CACHE = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+                           'globalsearch', 'gs_prepare_probes.json')
+
+
 def silent_rpy2_print(o):
     pass
 
-rpy2.rinterface_lib.callbacks.consolewrite_print = silent_rpy2_print
-rpy2.rinterface_lib.callbacks.consolewrite_warnerror = silent_rpy2_print
-
 
 def check_star_options(star_options):
     try:
@@ -88,71 +104,193 @@ def create_dirs(config):
         os.makedirs(config["log_dir"])
 
 
-def __check_command(command, num_info_components=1, version_index=-1,
+def load_probe_cache(path=PROBE_CACHE):
+    try:
+        with open(path) as infile:
+            cache = json.load(infile)
+        return cache if isinstance(cache, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def save_probe_cache(cache, path=PROBE_CACHE):
+    """write the cache atomically, a cache that can't be written is not an error"""
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '%s.%d' % (path, os.getpid())
+        with open(tmp_path, 'w') as outfile:
+            json.dump(cache, outfile, indent=2)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+async def __run_probes(probes):
+    async def run_probe(path, version_switch):
+        proc = await asyncio.create_subprocess_exec(path, version_switch, stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.PIPE)
+        stdout, stderr = await proc.communicate()
+        return proc.returncode, stdout.decode('utf-8')
+    return await asyncio.gather(*[run_probe(path, version_switch) for path, version_switch in probes])
+
+
+def probe_commands(commands, cache_path=PROBE_CACHE):
+    """Run '<command> <version switch>' for the (command, version switch) pairs
+    concurrently and return a dictionary of pair -> standard output, None if
+    the command doesn't exist. The outputs are cached per executable path,
+    they are reused as long as the modification time and size of the
+    executable are unchanged."""
+    cache = load_probe_cache(cache_path)
+    entries = cache.setdefault('commands', {})
+    result = {}
+    pending = []
+    for command, version_switch in commands:
+        path = shutil.which(command)
+        if path is None:
+            result[(command, version_switch)] = None
+            continue
+        path = os.path.realpath(path)
+        key = '%s %s' % (path, version_switch)
+        entry = entries.get(key)
+        if entry is not None and entry['signature'] == file_signature(path):
+            result[(command, version_switch)] = entry['output']
+        else:
+            pending.append((command, version_switch, path, key))
+    if len(pending) > 0:
+        outputs = asyncio.run(__run_probes([(path, version_switch) for command, version_switch, path, key in pending]))
+        for (command, version_switch, path, key), (returncode, output) in zip(pending, outputs):
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, [command, version_switch])
+            result[(command, version_switch)] = output
+            entries[key] = {'signature': file_signature(path), 'output': output}
+        save_probe_cache(cache, cache_path)
+    return result
+
+
+def __check_command(command, output, num_info_components=1, version_index=-1,
                     check_version=None, version_switch='--version',
                     multiline=False, info_line=0, fail_if_not_exists=True):
     """Generic command checker, can check for different version info formats and
-    restrict version numbers
+    restrict version numbers. output is the output of the version switch, None
+    if the command doesn't exist
     """
-    try:
-        print("checking for %s... " % command, end="", flush=True)
-        compl_proc = subprocess.run([command, version_switch], check=True, capture_output=True)
-        if multiline:
-            info_string = compl_proc.stdout.decode('utf-8').split('\n')[info_line].strip()
-        else:
-            info_string = compl_proc.stdout.decode('utf-8').strip()
-        comps = info_string.split()
-        version = comps[version_index]
-
-        print("(found version '%s') ..." % version, end="", flush=True)
-        if check_version is not None and check_version != version:
-            sys.exit("Unsupported version %s. Currently, only %s %s is supported" % (command, check_version))
-        print("done.", flush=True)
-    except FileNotFoundError:
+    print("checking for %s... " % command, end="", flush=True)
+    if output is None:
         if fail_if_not_exists:
             sys.exit("Can not find %s (not installed or not in PATH)" % command)
         else:
             print("WARN: %s does not exist, but is optional" % command, flush=True)
+            return
+    if multiline:
+        info_string = output.split('\n')[info_line].strip()
+    else:
+        info_string = output.strip()
+    comps = info_string.split()
+    version = comps[version_index]
+
+    print("(found version '%s') ..." % version, end="", flush=True)
+    if check_version is not None and check_version != version:
+        sys.exit("Unsupported version %s %s. Currently, only %s %s is supported" % (command, version, command,
+                                                                                    check_version))
+    print("done.", flush=True)
+
+
+def check_commands(commands, cache_path=PROBE_CACHE):
+    """check the versions of the commands in TOOL_CHECKS, the commands are probed concurrently"""
+    switches = [TOOL_CHECKS[command].get('version_switch', '--version') for command in commands]
+    outputs = probe_commands(list(zip(commands, switches)), cache_path)
+    for command, version_switch in zip(commands, switches):
+        __check_command(command, outputs[(command, version_switch)], **TOOL_CHECKS[command])
+
+
+def version_tuple(version):
+    """the numeric components of a version string, e.g. (0, 46, 2) for 0.46.2"""
+    return tuple(int(component) for component in re.findall(r'\d+', version)[:3])
+
+
+def check_kallisto_batch(cache_path=PROBE_CACHE):
+    """the kallisto_batch mode needs a kallisto version with the pseudo command"""
+    version_switch = TOOL_CHECKS['kallisto']['version_switch']
+    output = probe_commands([('kallisto', version_switch)], cache_path)[('kallisto', version_switch)]
+    if output is None:
+        sys.exit("Can not find kallisto (not installed or not in PATH)")
+    version = output.split()[-1]
+    lowest, above = KALLISTO_BATCH_VERSIONS
+    if not lowest <= version_tuple(version) < above:
+        sys.exit("kallisto_batch needs kallisto 0.46.2 to 0.48 (kallisto pseudo --quant), found version %s" %
+                 version)
 
 
 def check_salmon():
-    __check_command("salmon", num_info_components=2, check_version="0.13.1")
+    check_commands(["salmon"])
 
 
 def check_star():
-    __check_command("STAR")
+    check_commands(["STAR"])
 
 
 def check_htseq():
-    __check_command("htseq-count")
+    check_commands(["htseq-count"])
 
 
 def check_samtools():
-    __check_command("samtools", multiline=True, num_info_components=2)
+    check_commands(["samtools"])
 
 
 def check_kallisto():
-    __check_command("kallisto", version_switch="version", num_info_components=3,
-                    fail_if_not_exists=False)
+    check_commands(["kallisto"])
+
 
 def check_trim_galore():
-    __check_command("trim_galore", num_info_components=2, multiline=True, info_line=3)
+    check_commands(["trim_galore"])
 
 
 def check_rlibrary_installed(libname):
+    """Returns the installation directory of the R library, None if it is not
+    installed. This starts an embedded R"""
     try:
-        lib = importr(libname)
-        return True
+        import rpy2
+        import rpy2.robjects
+        from rpy2.robjects.packages import importr, PackageNotInstalledError
+    except ImportError:
+        print("rpy2 is not installed, can't check R library '%s'" % libname, flush=True)
+        return None
+    rpy2.rinterface_lib.callbacks.consolewrite_print = silent_rpy2_print
+    rpy2.rinterface_lib.callbacks.consolewrite_warnerror = silent_rpy2_print
+    try:
+        importr(libname)
+        return str(rpy2.robjects.r['find.package'](libname)[0])
     except PackageNotInstalledError:
-        return False
+        return None
 
 
-def check_rlibraries_installed():
+def check_rlibraries_installed(cache_path=PROBE_CACHE):
+    """Returns the R libraries that are not installed. Libraries that were
+    found before are checked without R, as long as their DESCRIPTION file is
+    unchanged"""
     print("checking for installed R libraries...", end="", flush=True)
+    cache = load_probe_cache(cache_path)
+    entries = cache.setdefault('rlibraries', {})
     not_installed = []
     for rlib in ['GlobalSearch']:
-        if not check_rlibrary_installed(rlib):
+        entry = entries.get(rlib)
+        try:
+            if entry is not None and file_signature(os.path.join(entry['path'], 'DESCRIPTION')) == entry['signature']:
+                continue
+        except OSError:
+            pass
+        path = check_rlibrary_installed(rlib)
+        if path is None:
             not_installed.append(rlib)
+            entries.pop(rlib, None)
+        else:
+            entries[rlib] = {'path': path, 'signature': file_signature(os.path.join(path, 'DESCRIPTION'))}
+            save_probe_cache(cache, cache_path)
     print("done", flush=True)
 
     return not_installed
@@ -167,15 +305,14 @@ if __name__ == '__main__':
         config = json.load(infile)
     rna_algo = config['rnaseq_algorithm']
 
+    commands = []
     if rna_algo == 'star_salmon':
-        check_star()
-        check_salmon()
+        commands += ['STAR', 'salmon']
     if rna_algo == 'kallisto':
-        check_kallisto()
-
-    check_htseq()
-    check_samtools()
-    check_trim_galore()
+        commands += ['kallisto']
+    check_commands(commands + ['htseq-count', 'samtools', 'trim_galore'])
+    if rna_algo == 'kallisto' and config.get('kallisto_batch', False):
+        check_kallisto_batch()
     not_installed = check_rlibraries_installed()
     if len(not_installed) > 0:
         for libname in not_installed:
@@ -183,5 +320,10 @@ if __name__ == '__main__':
         sys.exit()
 
     check_params(config, rna_algo)
+    # optional: check the FASTQ files before they fail in an array task
+    if config.get('preflight', False):
+        errors = run_preflight(config, rna_algo)
+        if len(errors) > 0:
+            sys.exit("ERROR: %d problem(s) with the FASTQ files, see the preflight report above" % len(errors))
     create_dirs(config)
     print(rna_algo)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+"""
+checkpoint.py - stage level completion manifests for resuming pipeline runs
+
+After a stage finished successfully, a manifest is written that records the
+output paths and sizes, a hash of the stage parameters and the version of the
+tool that produced the outputs. A rerun can skip every stage whose manifest
+still matches. Outputs are produced under temporary names and renamed into
+place before the manifest is written, so partial files from an interrupted
+run are never mistaken for finished ones.
+"""
+import functools
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+
+MANIFEST_DIR = '.checkpoints'
+TMP_SUFFIX = '.tmp'
+
+
+def params_hash(params):
+    """stable hash of JSON serializable stage parameters"""
+    data = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def tool_version(command, version_switch='--version'):
+    """first line of the tool's version output, 'unknown' if it can't be determined"""
+    try:
+        compl_proc = subprocess.run([command, version_switch], check=True, capture_output=True)
+        lines = (compl_proc.stdout or compl_proc.stderr).decode('utf-8').strip().split('\n')
+        return lines[0].strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def tmp_path(path):
+    """temporary name of an output path"""
+    return path + TMP_SUFFIX
+
+
+def commit_path(path):
+    """atomically move the temporary version of path into place"""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path(path), path)
+
+
+def commit_dir_contents(tmp_dir, target_dir):
+    """move all entries of tmp_dir into target_dir, replacing existing entries,
+    and return the list of moved top level files"""
+    files = []
+    for name in sorted(os.listdir(tmp_dir)):
+        src = os.path.join(tmp_dir, name)
+        dst = os.path.join(target_dir, name)
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            shutil.rmtree(dst)
+        os.replace(src, dst)
+        if os.path.isfile(dst):
+            files.append(dst)
+    os.rmdir(tmp_dir)
+    return files
+
+
+def list_files(path):
+    """all files below a directory"""
+    result = []
+    for root, dirs, files in os.walk(path):
+        result.extend(os.path.join(root, f) for f in files)
+    return sorted(result)
+
+
+class Checkpoints:
+    """Completion manifests of the stages writing into results_dir.
+
+    :param results_dir: the directory the stage outputs are written to
+    :param resume: if False, stages are never skipped, manifests are still written
+    """
+    def __init__(self, results_dir, resume=True):
+        self.manifest_dir = os.path.join(results_dir, MANIFEST_DIR)
+        self.resume = resume
+        os.makedirs(self.manifest_dir, exist_ok=True)
+
+    def manifest_path(self, stage):
+        return os.path.join(self.manifest_dir, '%s.json' % stage)
+
+    def _load(self, stage):
+        try:
+            with open(self.manifest_path(stage)) as infile:
+                return json.load(infile)
+        except (OSError, ValueError):
+            return None
+
+    def digest(self, stage):
+        """hash of the stage's manifest, None if the stage has not completed.
+        Downstream stages include it in their parameters, so they rerun whenever
+        an upstream stage was rerun"""
+        manifest = self._load(stage)
+        return params_hash(manifest) if manifest is not None else None
+
+    def is_complete(self, stage, params, version):
+        """True if the stage completed with the same parameters and tool version
+        and all of its outputs are still present with the recorded sizes"""
+        if not self.resume:
+            return False
+        manifest = self._load(stage)
+        if manifest is None:
+            return False
+        if manifest['params_hash'] != params_hash(params) or manifest['tool_version'] != version:
+            return False
+        for path, size in manifest['outputs'].items():
+            if not os.path.isfile(path) or os.path.getsize(path) != size:
+                return False
+        print("Stage '%s' is complete, skipping" % stage, flush=True)
+        return True
+
+    def complete(self, stage, params, version, outputs):
+        """write the manifest for a stage whose outputs are in place"""
+        manifest = {
+            'stage': stage,
+            'params_hash': params_hash(params),
+            'tool_version': version,
+            'outputs': {path: os.path.getsize(path) for path in outputs}
+        }
+        path = self.manifest_path(stage)
+        with open(tmp_path(path), 'w') as outfile:
+            json.dump(manifest, outfile, indent=2, sort_keys=True)
+        os.replace(tmp_path(path), path)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+"""
+cohort_twopass.py - cohort level two-pass alignment
+
+STAR's --twopassMode Basic inserts the junctions of every sample into a
+private copy of the genome, which doubles the alignment time and rules out
+the shared genome. The cohort mode splits the two passes instead:
+
+  1. all samples are aligned against the regular index, only the
+     junctions (SJ.out.tab) are kept
+  2. this module merges and filters the junctions of all samples and
+     builds one index with the junctions inserted
+  3. all samples are aligned against the junction index, sharing the genome
+
+Junctions are kept if they are supported by at least min_unique_reads
+uniquely mapping reads in at least min_samples samples. Non-canonical
+junctions are only kept if they are annotated.
+"""
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+
+from .checkpoint import tmp_path
+from .fasta_index import find_genome_fasta
+from .fasta_stats import tune_index_args
+from .index_star import cached_genome_index
+
+DESCRIPTION = """cohort_twopass.py - merge first pass junctions and build the junction index"""
+
+COHORT_INDEX_DIR = 'star_cohort_index'
+FIRST_PASS_SUFFIX = '_pass1'
+MERGED_SJ_FILE = 'cohort_SJ.out.tab'
+
+DEFAULT_MIN_UNIQUE_READS = 3
+DEFAULT_MIN_SAMPLES = 1
+
+# SJ.out.tab strand codes and their sjdbFileChrStartEnd representation
+STRANDS = np.array(['.', '+', '-'])
+
+
+def cohort_index_dir(config):
+    """the junction index is shared by all data folders of the output directory"""
+    return os.path.join(config['output_dir'], COHORT_INDEX_DIR)
+
+
+def cohort_options(config):
+    """(min_unique_reads, min_samples) from the optional cohort_twopass configuration"""
+    options = config.get('cohort_twopass', {})
+    return (options.get('min_unique_reads', DEFAULT_MIN_UNIQUE_READS),
+            options.get('min_samples', DEFAULT_MIN_SAMPLES))
+
+
+def find_first_pass_junctions(output_dir):
+    """the junction files of the first pass of all data folders"""
+    return sorted(glob.glob(os.path.join(output_dir, '*', 'results_STAR_Salmon',
+                                         '*%s_SJ.out.tab' % FIRST_PASS_SUFFIX)))
+
+
+def read_junctions(path):
+    """Read a SJ.out.tab file into (chromosomes, values), values is an integer
+    array with the columns start, end, strand, motif, annotated, unique reads,
+    multimapping reads and maximum overhang"""
+    if os.path.getsize(path) == 0:  # no junctions were detected
+        return np.zeros(0, dtype=str), np.zeros((0, 8), dtype=np.int64)
+    chroms = np.loadtxt(path, dtype=str, usecols=0, ndmin=1, delimiter='\t')
+    values = np.loadtxt(path, dtype=np.int64, usecols=range(1, 9), ndmin=2, delimiter='\t')
+    return chroms, values.reshape(-1, 8)
+
+
+def merge_junctions(sj_paths, min_unique_reads=DEFAULT_MIN_UNIQUE_READS,
+                    min_samples=DEFAULT_MIN_SAMPLES):
+    """Merge the junctions of the samples and filter them.
+
+    Returns (chromosomes, starts, ends, strands, unique reads, samples) of the
+    retained junctions, sorted by position, strands as '+', '-' or '.'"""
+    all_chroms, all_values = [], []
+    for path in sj_paths:
+        chroms, values = read_junctions(path)
+        all_chroms.append(chroms)
+        all_values.append(values)
+    if len(all_chroms) == 0 or sum(len(chroms) for chroms in all_chroms) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return np.zeros(0, dtype=str), empty, empty, STRANDS[empty], empty, empty
+    chroms = np.concatenate(all_chroms)
+    values = np.concatenate(all_values)
+
+    # junctions are identified by chromosome, start, end and strand
+    chrom_names, chrom_ids = np.unique(chroms, return_inverse=True)
+    keys = np.column_stack([chrom_ids, values[:, 0], values[:, 1], values[:, 2]])
+    junctions, first_index, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+
+    unique_reads = np.bincount(inverse, weights=values[:, 5]).astype(np.int64)
+    # a junction occurs at most once per sample
+    samples = np.bincount(inverse, weights=values[:, 5] >= min_unique_reads).astype(np.int64)
+    annotated = np.zeros(len(junctions), dtype=bool)
+    np.logical_or.at(annotated, inverse, values[:, 4] > 0)
+    canonical = values[first_index, 3] > 0
+
+    keep = (samples >= min_samples) & (canonical | annotated)
+    junctions = junctions[keep]
+    return (chrom_names[junctions[:, 0]], junctions[:, 1], junctions[:, 2], STRANDS[junctions[:, 3]],
+            unique_reads[keep], samples[keep])
+
+
+def write_sjdb(path, chroms, starts, ends, strands):
+    """write the junctions in the sjdbFileChrStartEnd format"""
+    with open(path, 'w') as outfile:
+        for chrom, start, end, strand in zip(chroms, starts, ends, strands):
+            outfile.write('%s\t%d\t%d\t%s\n' % (chrom, start, end, strand))
+
+
+def build_cohort_index(config, genome_fasta, sj_paths, min_unique_reads=DEFAULT_MIN_UNIQUE_READS,
+                       min_samples=DEFAULT_MIN_SAMPLES):
+    """merge the first pass junctions and build the junction index. The index
+    is cached by the merged junctions, cohort_index_dir() links to it"""
+    junctions = merge_junctions(sj_paths, min_unique_reads, min_samples)
+    print("%d junctions from %d samples retained (min. %d unique reads in %d samples)" %
+          (len(junctions[0]), len(sj_paths), min_unique_reads, min_samples), flush=True)
+
+    sjdb_path = os.path.join(config['output_dir'], MERGED_SJ_FILE)
+    write_sjdb(tmp_path(sjdb_path), *junctions[:4])
+    os.replace(tmp_path(sjdb_path), sjdb_path)
+
+    index_options = config.get('star_index_options', {})
+    star_options = config.get('star_options', {})
+    genome_gff = config.get('genome_gff')
+    if genome_gff is not None and not os.path.exists(genome_gff):
+        genome_gff = None
+    args = argparse.Namespace(
+        runThreadN=index_options.get('runThreadN', 32),
+        genomeChrBinNbits=index_options.get('genomeChrBinNbits'),
+        genomeSAindexNbases=index_options.get('genomeSAindexNbases'),
+        genome_gff=genome_gff,
+        sjdbFileChrStartEnd=[sjdb_path],
+        sjdbOverhang=index_options.get('sjdbOverhang', star_options.get('sjdbOverhang', 100)),
+        limitSjdbInsertNsj=star_options.get('limitSjdbInsertNsj', 1602710),
+        sjdbGTFfeatureExon=index_options.get('sjdbGTFfeatureExon', star_options.get('sjdbGTFfeatureExon')),
+        sjdbGTFtagExonParentTranscript=index_options.get('sjdbGTFtagExonParentTranscript',
+                                                         star_options.get('sjdbGTFtagExonParentTranscript',
+                                                                          'Parent' if genome_gff else None)),
+        sjdbGTFtagExonParentGene=index_options.get('sjdbGTFtagExonParentGene',
+                                                   star_options.get('sjdbGTFtagExonParentGene')))
+    tune_index_args(args, genome_fasta)
+    cached_genome_index(config['output_dir'], genome_fasta, args, name=COHORT_INDEX_DIR)
+    return cohort_index_dir(config)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=DESCRIPTION)
+    parser.add_argument('configfile', help='configuration file')
+    args = parser.parse_args()
+    with open(args.configfile) as infile:
+        config = json.load(infile)
+
+    genome_fasta = find_genome_fasta(config['genome_dir'], config.get('genome_fasta'))
+    sj_paths = find_first_pass_junctions(config['output_dir'])
+    if len(sj_paths) == 0:
+        raise FileNotFoundError("no first pass junction files in '%s'" % config['output_dir'])
+    min_unique_reads, min_samples = cohort_options(config)
+    build_cohort_index(config, genome_fasta, sj_paths, min_unique_reads, min_samples)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+"""
+discovery_cache.py - persistent cache for the input directory scans
+
+Job generation and every array task scan the same input directories for
+data folders and FASTQ files. The results of these scans are stored in an
+SQLite database together with the modification time and inode of every
+directory that was visited. A lookup only needs to stat these directories
+to decide whether the stored result is still valid, any change in the
+directory metadata invalidates the entry and triggers a rescan.
+"""
+from contextlib import contextmanager
+import json
+import os
+import sqlite3
+from fs.osfs import OSFS
+
+CACHE_FILE_NAME = 'discovery_cache.sqlite'
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS scans (scope TEXT PRIMARY KEY, result TEXT NOT NULL)""",
+    """CREATE TABLE IF NOT EXISTS scan_dirs (scope TEXT NOT NULL, path TEXT NOT NULL,
+       mtime REAL, inode INTEGER, PRIMARY KEY (scope, path))"""
+]
+
+
+def discovery_cache_path(config):
+    """The default location of the cache database is the log directory"""
+    return os.path.join(config['log_dir'], CACHE_FILE_NAME)
+
+
+@contextmanager
+def open_discovery_cache(db_path):
+    """the DiscoveryCache at db_path for a with block, it is closed at the
+    end of the block. None if db_path is None"""
+    if db_path is None:
+        yield None
+        return
+    cache = DiscoveryCache(db_path)
+    try:
+        yield cache
+    finally:
+        cache.close()
+
+
+class DiscoveryCache:
+    """Cache for directory scans, keyed on scope and directory path, mtime and inode.
+
+    :param db_path: path to the SQLite database, will be created if it does not exist
+    :param filesys: the PyFS file system the scans are performed on
+    """
+    def __init__(self, db_path, filesys=OSFS('/')):
+        self.filesys = filesys
+        # long timeout: hundreds of array tasks can start at the same time
+        self.conn = sqlite3.connect(db_path, timeout=120)
+        with self.conn:
+            for statement in SCHEMA:
+                self.conn.execute(statement)
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        self.conn.close()
+
+    def signature(self, path, info=None):
+        """Return the (mtime, inode) signature of a directory, inode is None if the
+        file system does not provide it"""
+        if info is None:
+            info = self.filesys.getinfo(path, namespaces=['details', 'stat'])
+        return info.raw['details']['modified'], info.raw.get('stat', {}).get('st_ino')
+
+    def _is_valid(self, scope):
+        rows = self.conn.execute('SELECT path, mtime, inode FROM scan_dirs WHERE scope = ?',
+                                 (scope,)).fetchall()
+        if len(rows) == 0:
+            return False
+        for path, mtime, inode in rows:
+            try:
+                if self.signature(path) != (mtime, inode):
+                    return False
+            except Exception:
+                # directory was removed or is not accessible
+                return False
+        return True
+
+    def lookup(self, scope, scan):
+        """Return the cached result for scope if none of the directories visited by the
+        scan have changed. Otherwise, run scan(record) and store its result.
+        scan has to call record(path, info=None) for each directory it reads,
+        before it reads it, and return a JSON serializable result.
+        """
+        if self._is_valid(scope):
+            row = self.conn.execute('SELECT result FROM scans WHERE scope = ?', (scope,)).fetchone()
+            if row is not None:
+                self.hits += 1
+                return json.loads(row[0])
+
+        self.misses += 1
+        visited = {}
+
+        def record(path, info=None):
+            visited[path] = self.signature(path, info)
+
+        result = scan(record)
+        with self.conn:
+            self.conn.execute('DELETE FROM scan_dirs WHERE scope = ?', (scope,))
+            self.conn.executemany('INSERT INTO scan_dirs (scope, path, mtime, inode) VALUES (?, ?, ?, ?)',
+                                  [(scope, path, mtime, inode)
+                                   for path, (mtime, inode) in visited.items()])
+            self.conn.execute('INSERT OR REPLACE INTO scans (scope, result) VALUES (?, ?)',
+                              (scope, json.dumps(result)))
+        return result
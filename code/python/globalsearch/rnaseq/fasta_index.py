@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+"""
+fasta_index.py - samtools compatible FASTA index (.fai) with random access
+
+The index is built in a single pass over the memory mapped FASTA file and
+stored next to it as <fasta>.fai, in the format of samtools faidx: name,
+length, offset of the first base, bases per line and bytes per line. The
+index is reused as long as it is newer than the FASTA file, so the
+pipeline steps get the names and lengths of the sequences without reading
+the FASTA file again, and can read any region of a sequence directly.
+
+Records with lines of different lengths can't be described by a .fai file.
+They are still indexed in memory, reading them is linear in their length.
+
+Duplicate sequence names are reported by check_unique_names(), before STAR,
+kallisto or salmon spend hours on a FASTA file they would reject or
+quantify ambiguously.
+"""
+import argparse
+from collections import Counter, namedtuple
+import glob
+import mmap
+import os
+
+import numpy as np
+
+DESCRIPTION = """fasta_index.py - build the .fai index of a FASTA file"""
+
+FAI_SUFFIX = '.fai'
+FASTA_PATTERNS = ['*.fasta', '*.fa', '*.fna']
+
+# bytes that are compared at once when scanning a sequence
+SCAN_BLOCK_SIZE = 64 * 1024 * 1024
+
+FaiEntry = namedtuple('FaiEntry', ['name', 'length', 'offset', 'linebases', 'linewidth'])
+
+
+def fai_path(fasta_path):
+    return fasta_path + FAI_SUFFIX
+
+
+def find_genome_fasta(genome_dir, genome_fasta=None):
+    """the configured genome FASTA file if it exists, otherwise the FASTA file in genome_dir"""
+    if genome_fasta is not None and os.path.exists(genome_fasta):
+        return genome_fasta
+    for pattern in FASTA_PATTERNS:
+        paths = sorted(glob.glob(os.path.join(genome_dir, pattern)))
+        if len(paths) > 0:
+            return paths[0]
+    raise FileNotFoundError("no genome FASTA file in '%s'" % genome_dir)
+
+
+def _scan_sequence(mapped, data, name, seq_start, seq_end):
+    """Returns the FaiEntry of the sequence between seq_start and seq_end and
+    whether its lines have different lengths"""
+    line_start = seq_start
+    width = None
+    short_line = False
+    ragged = False
+    num_breaks = 0
+    for block_start in range(seq_start, seq_end, SCAN_BLOCK_SIZE):
+        block = data[block_start:min(seq_end, block_start + SCAN_BLOCK_SIZE)]
+        num_breaks += np.count_nonzero(block == ord('\r'))
+        line_ends = np.flatnonzero(block == ord('\n')) + block_start + 1
+        num_breaks += len(line_ends)
+        if len(line_ends) == 0:
+            continue
+        widths = np.diff(line_ends, prepend=line_start)
+        line_start = int(line_ends[-1])
+        if width is None:
+            width = int(widths[0])
+        # only the last line of a sequence may be shorter
+        if short_line or (widths > width).any() or (widths[:-1] < width).any():
+            ragged = True
+        short_line = short_line or widths[-1] < width
+    length = int(seq_end - seq_start - num_breaks)
+    if line_start < seq_end and width is not None:
+        # the last line, its line break belongs to the next header
+        if short_line or seq_end - line_start > width:
+            ragged = True
+    if width is None:
+        # a single line
+        line_break = 2 if mapped[seq_end - 1:seq_end] == b'\r' else 1
+        linebases, linewidth = (length, length + line_break) if length > 0 else (0, 0)
+    else:
+        line_break = 2 if mapped[seq_start + width - 2:seq_start + width - 1] == b'\r' else 1
+        linebases, linewidth = int(width - line_break), int(width)
+    return FaiEntry(name, length, seq_start, linebases, linewidth), ragged
+
+
+def scan_fasta_records(fasta_path):
+    """Returns the FaiEntry of every sequence in the FASTA file and the names
+    of the sequences with lines of different lengths"""
+    entries, ragged = [], []
+    with open(fasta_path, 'rb') as infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            return entries, ragged
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            data = np.frombuffer(mapped, dtype=np.uint8)
+            header = 0 if mapped[:1] == b'>' else mapped.find(b'\n>')
+            while header >= 0:
+                if mapped[header:header + 1] == b'\n':
+                    header += 1
+                header_end = mapped.find(b'\n', header)
+                if header_end < 0:
+                    header_end = len(mapped)
+                name = mapped[header + 1:header_end].decode('utf-8').split(maxsplit=1)
+                name = name[0] if len(name) > 0 else ''
+                seq_start = min(header_end + 1, len(mapped))
+                next_header = mapped.find(b'\n>', header_end)
+                seq_end = next_header if next_header >= 0 else len(mapped)
+                entry, is_ragged = _scan_sequence(mapped, data, name, seq_start, max(seq_start, seq_end))
+                entries.append(entry)
+                if is_ragged:
+                    ragged.append(name)
+                header = next_header
+            del data  # the buffer must be released before the map is closed
+    return entries, ragged
+
+
+def read_fai(path):
+    with open(path) as infile:
+        return [FaiEntry(name, int(length), int(offset), int(linebases), int(linewidth))
+                for name, length, offset, linebases, linewidth
+                in (line.rstrip('\n').split('\t')[:5] for line in infile if len(line.strip()) > 0)]
+
+
+def write_fai(entries, path):
+    """write the index atomically"""
+    tmp_path = '%s.%d' % (path, os.getpid())
+    with open(tmp_path, 'w') as outfile:
+        for entry in entries:
+            outfile.write('%s\t%d\t%d\t%d\t%d\n' % entry)
+    os.replace(tmp_path, path)
+
+
+def _index_is_current(fasta_path):
+    path = fai_path(fasta_path)
+    return (os.path.exists(path) and os.path.getsize(path) > 0 and
+            os.path.getmtime(path) >= os.path.getmtime(fasta_path))
+
+
+class FastaIndex:
+    """Names, lengths and random access to the sequences of a FASTA file.
+
+    :param fasta_path: the FASTA file, it can't be compressed
+    :param write: store a newly built index next to the FASTA file
+    """
+    def __init__(self, fasta_path, write=True):
+        if fasta_path.endswith('.gz'):
+            raise ValueError("compressed FASTA file '%s' can't be indexed" % fasta_path)
+        self.fasta_path = fasta_path
+        self.ragged = set()
+        if _index_is_current(fasta_path):
+            self.entries = read_fai(fai_path(fasta_path))
+        else:
+            self.entries, ragged = scan_fasta_records(fasta_path)
+            self.ragged = set(ragged)
+            if len(ragged) > 0:
+                print("FASTA file '%s' has sequences with lines of different lengths, no .fai written" %
+                      fasta_path, flush=True)
+            elif write:
+                try:
+                    write_fai(self.entries, fai_path(fasta_path))
+                except OSError as e:
+                    print("can't write the FASTA index of '%s': %s" % (fasta_path, str(e)), flush=True)
+        self.names = [entry.name for entry in self.entries]
+        self.lengths = np.array([entry.length for entry in self.entries], dtype=np.int64)
+        self._by_name = {}
+        for entry in self.entries:
+            self._by_name.setdefault(entry.name, entry)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def length(self, name):
+        return self._by_name[name].length
+
+    def duplicate_names(self):
+        """the names that occur more than once, in the order of the file"""
+        counts = Counter(self.names)
+        return [name for name in self._by_name if counts[name] > 1]
+
+    def check_unique_names(self):
+        duplicates = self.duplicate_names()
+        if len(duplicates) > 0:
+            raise ValueError("duplicate sequence names in '%s': %s" %
+                             (self.fasta_path, ', '.join(duplicates[:10]) +
+                              (' and %d more' % (len(duplicates) - 10) if len(duplicates) > 10 else '')))
+
+    def fetch(self, name, start=0, end=None):
+        """the bases from start to end (0-based, end exclusive) of a sequence"""
+        entry = self._by_name[name]
+        end = entry.length if end is None else min(end, entry.length)
+        start = max(0, start)
+        if start >= end:
+            return ''
+        with open(self.fasta_path, 'rb') as infile:
+            if name in self.ragged:
+                infile.seek(entry.offset)
+                bases = b''
+                while len(bases) < end:
+                    block = infile.read(SCAN_BLOCK_SIZE)
+                    if len(block) == 0:
+                        break
+                    bases += block.replace(b'\n', b'').replace(b'\r', b'')
+                return bases[start:end].decode('ascii')
+            first = entry.offset + start // entry.linebases * entry.linewidth + start % entry.linebases
+            last = entry.offset + (end - 1) // entry.linebases * entry.linewidth + (end - 1) % entry.linebases
+            infile.seek(first)
+            return infile.read(last - first + 1).replace(b'\n', b'').replace(b'\r', b'').decode('ascii')
+
+
+def check_unique_names(fasta_path):
+    """build or load the index of fasta_path and fail if it has duplicate sequence names"""
+    if fasta_path.endswith('.gz'):
+        print("not checking the sequence names of compressed FASTA file '%s'" % fasta_path, flush=True)
+        return
+    FastaIndex(fasta_path).check_unique_names()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=DESCRIPTION)
+    parser.add_argument('fasta', help='FASTA file')
+    args = parser.parse_args()
+    index = FastaIndex(args.fasta)
+    print("%d sequences, %d bp" % (len(index), index.lengths.sum()))
+    index.check_unique_names()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+"""
+fasta_stats.py - sequence statistics of a genome FASTA file and the STAR
+index parameters derived from them
+
+The sequence lengths are taken from the FASTA index (see fasta_index.py),
+which is built in one pass over the memory mapped file the first time and
+reused afterwards. Compressed files are streamed instead.
+
+The index parameters follow the STAR manual:
+
+  genomeSAindexNbases = min(14, log2(genome length) / 2 - 1)
+  genomeChrBinNbits = min(18, log2(max(genome length / number of sequences, read length)))
+
+The predicted memory is the size of the genome, the suffix array and the
+suffix array index, which is what a mapping task loads into memory.
+"""
+import argparse
+from collections import namedtuple
+import gzip
+import math
+
+import numpy as np
+
+from .fasta_index import FastaIndex
+
+DESCRIPTION = """fasta_stats.py - genome statistics and STAR index parameters"""
+
+GB = 1024 ** 3
+
+MAX_SA_INDEX_NBASES = 14
+MAX_CHR_BIN_NBITS = 18
+# STAR's minimum number of bits for suffix array entries
+MIN_GSTRAND_BIT = 32
+
+FastaStats = namedtuple('FastaStats', ['length', 'num_sequences', 'n50', 'lengths'])
+IndexParams = namedtuple('IndexParams', ['genomeSAindexNbases', 'genomeChrBinNbits', 'memory'])
+
+
+def _streamed_lengths(path):
+    lengths = []
+    with gzip.open(path, 'rt') as infile:
+        for line in infile:
+            if line.startswith('>'):
+                lengths.append(0)
+            elif len(lengths) > 0:
+                lengths[-1] += len(line.rstrip('\r\n'))
+    return lengths
+
+
+def n50(lengths):
+    """the length of the shortest sequence of the longest sequences that make up half of the total length"""
+    if len(lengths) == 0:
+        return 0
+    ordered = np.sort(lengths)[::-1]
+    covered = np.cumsum(ordered)
+    return int(ordered[np.searchsorted(covered, covered[-1] / 2.0)])
+
+
+def scan_fasta(path):
+    """total length, number of sequences, N50 and the lengths of the sequences of a FASTA file"""
+    if path.endswith('.gz'):
+        lengths = np.array(_streamed_lengths(path), dtype=np.int64)
+    else:
+        lengths = FastaIndex(path).lengths
+    return FastaStats(int(lengths.sum()), len(lengths), n50(lengths), lengths)
+
+
+def star_index_memory(lengths, sa_index_nbases, chr_bin_nbits):
+    """Predicted size in bytes of the genome, the suffix array and the suffix
+    array index that STAR builds from sequences of the given lengths"""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    genome_length = int(lengths.sum())
+    # every sequence starts at a bin boundary
+    bin_size = 2 ** chr_bin_nbits
+    padded_length = int((((lengths + bin_size - 1) // bin_size) * bin_size).sum())
+    gstrand_bit = max(MIN_GSTRAND_BIT, int(math.floor(math.log2(max(padded_length, 1)))) + 1)
+    # both strands are indexed
+    sa_bytes = 2 * genome_length * (gstrand_bit + 1) / 8
+    sa_index_bytes = (gstrand_bit + 3) / 8 * (4 ** (sa_index_nbases + 1) - 4) / 3
+    return int(padded_length + sa_bytes + sa_index_bytes)
+
+
+def star_index_params(stats, read_length=101):
+    """the recommended genomeSAindexNbases and genomeChrBinNbits for the genome
+    and the predicted memory of the index"""
+    genome_length = max(stats.length, 1)
+    sa_index_nbases = max(1, min(MAX_SA_INDEX_NBASES, int(math.floor(math.log2(genome_length) / 2 - 1))))
+    mean_length = genome_length / max(stats.num_sequences, 1)
+    chr_bin_nbits = max(1, min(MAX_CHR_BIN_NBITS, int(math.floor(math.log2(max(mean_length, read_length))))))
+    return IndexParams(sa_index_nbases, chr_bin_nbits,
+                       star_index_memory(stats.lengths, sa_index_nbases, chr_bin_nbits))
+
+
+def tune_index_args(args, genome_fasta):
+    """Fill in the index parameters that were not specified in args with the
+    values recommended for genome_fasta and report the predicted memory.
+    args needs genomeSAindexNbases, genomeChrBinNbits and sjdbOverhang."""
+    stats = scan_fasta(genome_fasta)
+    print("genome '%s': %d bp in %d sequences, N50 %d" % (genome_fasta, stats.length, stats.num_sequences,
+                                                          stats.n50), flush=True)
+    recommended = star_index_params(stats, args.sjdbOverhang + 1)
+    if args.genomeSAindexNbases is None:
+        args.genomeSAindexNbases = recommended.genomeSAindexNbases
+    if args.genomeChrBinNbits is None:
+        args.genomeChrBinNbits = recommended.genomeChrBinNbits
+    memory = star_index_memory(stats.lengths, args.genomeSAindexNbases, args.genomeChrBinNbits)
+    print("STAR index parameters: genomeSAindexNbases %d, genomeChrBinNbits %d, predicted index memory %.1f GB" %
+          (args.genomeSAindexNbases, args.genomeChrBinNbits, memory / GB), flush=True)
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=DESCRIPTION)
+    parser.add_argument('fasta', help='genome FASTA file')
+    parser.add_argument('--read_length', type=int, default=101)
+    args = parser.parse_args()
+    stats = scan_fasta(args.fasta)
+    params = star_index_params(stats, args.read_length)
+    print("length\t%d\nsequences\t%d\nN50\t%d" % (stats.length, stats.num_sequences, stats.n50))
+    print("genomeSAindexNbases\t%d\ngenomeChrBinNbits\t%d\nmemory_gb\t%.2f" %
+          (params.genomeSAindexNbases, params.genomeChrBinNbits, params.memory / GB))
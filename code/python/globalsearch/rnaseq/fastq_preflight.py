@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+
+"""
+fastq_preflight.py - check the FASTQ files of all data folders before submission
+
+A truncated or corrupt FASTQ file is otherwise only noticed when trim_galore
+or STAR fails on it, hours into an array task. The preflight scans all FASTQ
+pairs of the configuration in a process pool, one pair per worker:
+
+  integrity  every gzip stream is decompressed to its end, which detects
+             truncated files, CRC errors and garbage after the last member.
+             Concatenated gzip members (bgzip, cat *.gz) are supported
+  reads      the exact number of reads of a verified file. Without the
+             verification (quick mode), only the first sample_reads reads
+             are decompressed and the count is extrapolated from the file
+             size and the compressed bytes of the sample
+  tail       in quick mode, the last gzip members in the final TAIL_WINDOW
+             bytes are decompressed, which detects files that were cut off
+             (bgzip and other multi member files). If no member starts in
+             the window, the size in the gzip trailer is compared with the
+             estimated size of the file, which is a weaker check
+  sync       the read names of R1 and R2 agree for the sampled reads (without
+             the /1 and /2 suffixes and comments), and both mates have the
+             same number of reads
+  lengths    the distribution of the read lengths in the sample
+
+The numbers are summed up to a runtime and disk forecast for every data
+folder. The throughputs and output sizes below are rough averages per CPU
+core, the forecast is meant to spot the folders that don't fit the time
+limit or the disk quota of an array task, not to schedule it exactly.
+
+gs_prepare runs the preflight on the submit host, so it uses the quick
+mode and at most SUBMIT_HOST_WORKERS processes unless the preflight
+section asks for more. Run as a script, e.g. in its own Slurm job, the
+files are verified with all CPUs by default.
+"""
+import argparse
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import json
+import os
+import sys
+import zlib
+
+from fs.osfs import OSFS
+
+from .find_files import rnaseq_data_folder_list, find_fastq_files
+
+DESCRIPTION = """fastq_preflight.py - check the integrity, read counts and mate synchronization of the FASTQ files"""
+
+DEFAULT_FASTQ_PATTERN = "*_{{pairnum}}.fq.*"
+GZIP_MAGIC = b'\x1f\x8b'
+# window bits of zlib for a gzip header and trailer
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+# file bytes that are read at once, also the granularity of the quick estimate
+BLOCK_SIZE = 1 << 16
+SAMPLE_READS = 100000
+# bytes at the end of a gzip file that the quick mode checks, and the number
+# of gzip member headers in it that are tried, the last one first
+TAIL_WINDOW = 1 << 20
+TAIL_MEMBERS = 8
+# the gzip trailer stores the uncompressed size modulo 2^32, it is compared
+# with the estimated size within this factor, if the estimate is small enough
+TRAILER_SIZE_FACTOR = 4
+
+# fragments (read pairs or single reads) per CPU second of every stage
+FRAGMENTS_PER_CPU_SECOND = {'trim_galore': 8000, 'STAR': 5000, 'salmon': 50000, 'kallisto': 20000}
+STAGES = {'star_salmon': ['trim_galore', 'STAR', 'salmon'], 'kallisto': ['trim_galore', 'kallisto']}
+# size of the trimmed FASTQ files relative to the input files
+TRIMMED_SIZE_RATIO = 1.0
+# bytes of the coordinate sorted STAR BAM file per sequenced base
+BAM_BYTES_PER_BASE = 0.35
+# CPUs of an array task if the preflight section doesn't specify them
+DEFAULT_THREADS = 32
+# scanning processes of the preflight on the submit host
+SUBMIT_HOST_WORKERS = 4
+
+FastqScan = namedtuple('FastqScan', ['path', 'size', 'reads', 'exact', 'lengths', 'error'])
+PairScan = namedtuple('PairScan', ['folder', 'first', 'second', 'errors'])
+Forecast = namedtuple('Forecast', ['fragments', 'bases', 'hours', 'disk'])
+
+
+def _blocks(path, block_size=BLOCK_SIZE):
+    """the decompressed blocks of the file at path, each with the number of
+    file bytes read so far. Files that are not gzip compressed are returned
+    as they are. Raises ValueError if the gzip stream is corrupt or truncated"""
+    with open(path, 'rb') as infile:
+        raw = infile.read(block_size)
+        consumed = 0
+        if not raw.startswith(GZIP_MAGIC):
+            while len(raw) > 0:
+                consumed += len(raw)
+                yield raw, consumed
+                raw = infile.read(block_size)
+            return
+
+        decompressor = zlib.decompressobj(GZIP_WBITS)
+        while len(raw) > 0:
+            consumed += len(raw)
+            while len(raw) > 0:
+                if decompressor.eof:
+                    # zero padding after the last member is ignored like gzip does
+                    if raw.strip(b'\x00') == b'':
+                        break
+                    decompressor = zlib.decompressobj(GZIP_WBITS)
+                try:
+                    data = decompressor.decompress(raw)
+                except zlib.error as e:
+                    raise ValueError("corrupt gzip stream near byte %d: %s" % (consumed, str(e)))
+                yield data, consumed
+                raw = decompressor.unused_data
+            raw = infile.read(block_size)
+        if not decompressor.eof:
+            raise ValueError("truncated gzip stream, the file ends after %d bytes" % consumed)
+
+
+def _decode_members(data):
+    """True if data consists of complete gzip members (and zero padding),
+    False if the last member is cut off, None if it is not gzip data"""
+    while len(data) > 0 and data.strip(b'\x00') != b'':
+        decompressor = zlib.decompressobj(GZIP_WBITS)
+        try:
+            decompressor.decompress(data)
+        except zlib.error:
+            return None
+        if not decompressor.eof:
+            return False
+        data = decompressor.unused_data
+    return True
+
+
+def check_tail(path, expected_size=None):
+    """None if the end of the gzip file at path is intact, otherwise a
+    description of the problem. expected_size is the estimated uncompressed
+    size, it is compared with the size in the trailer if no gzip member
+    starts in the last TAIL_WINDOW bytes"""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as infile:
+        infile.seek(max(0, size - TAIL_WINDOW))
+        window = infile.read()
+    starts = []
+    position = window.rfind(GZIP_MAGIC + b'\x08')
+    while position >= 0 and len(starts) < TAIL_MEMBERS:
+        starts.append(position)
+        position = window.rfind(GZIP_MAGIC + b'\x08', 0, position)
+    cut_off = False
+    for start in starts:
+        complete = _decode_members(window[start:])
+        if complete:
+            return None
+        # a header that was cut off, or the magic bytes in compressed data
+        cut_off = cut_off or complete is False
+    if cut_off:
+        return "truncated gzip stream, the last member ends at byte %d" % size
+    if expected_size is not None and expected_size * TRAILER_SIZE_FACTOR < 1 << 32 and len(window) >= 8:
+        trailer_size = int.from_bytes(window[-4:], 'little')
+        if not expected_size / TRAILER_SIZE_FACTOR <= trailer_size <= expected_size * TRAILER_SIZE_FACTOR:
+            return ("truncated gzip stream, the trailer size %d does not match the estimated size %d" %
+                    (trailer_size, expected_size))
+    return None
+
+
+def _is_gzip(path):
+    with open(path, 'rb') as infile:
+        return infile.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+
+
+def read_name(header):
+    """the name of a read from its header line, without the mate suffix"""
+    name = header[1:].split(maxsplit=1)[0] if len(header) > 1 else b''
+    if name.endswith(b'/1') or name.endswith(b'/2'):
+        name = name[:-2]
+    return name.decode('utf-8', 'replace')
+
+
+def _is_record(lines):
+    header, sequence, separator, quality = lines
+    return header.startswith(b'@') and separator.startswith(b'+') and len(sequence) == len(quality)
+
+
+def scan_fastq(path, sample_reads=SAMPLE_READS, verify=True):
+    """Scan the FASTQ file at path, returns its FastqScan and the names of the
+    sampled reads. Problems with the file are reported in FastqScan.error"""
+    size = os.path.getsize(path)
+    sample, names, lengths = [], [], Counter()
+    sample_consumed = sample_newlines = None
+    # the last two blocks, they contain the last record
+    newlines, previous, last = 0, b'', b''
+    try:
+        for data, consumed in _blocks(path):
+            if len(data) == 0:
+                continue
+            newlines += data.count(b'\n')
+            previous, last = last, data
+            if sample_consumed is None:
+                sample.append(data)
+                if newlines >= 4 * sample_reads:
+                    sample_consumed, sample_newlines = consumed, newlines
+                    if not verify:
+                        break
+    except (OSError, ValueError) as e:
+        return FastqScan(path, size, None, False, lengths, str(e)), names
+
+    lines = b''.join(sample).split(b'\n', 4 * sample_reads)[:4 * sample_reads]
+    if sample_consumed is None and last.endswith(b'\n'):
+        lines.pop()
+    for start in range(0, len(lines) - 3, 4):
+        if not _is_record(lines[start:start + 4]):
+            return FastqScan(path, size, None, False, lengths,
+                             "malformed FASTQ record %d" % (start // 4 + 1)), names
+        names.append(read_name(lines[start]))
+        lengths[len(lines[start + 1])] += 1
+
+    if sample_consumed is not None and not verify:
+        reads, exact = int(round(sample_newlines / 4 * size / sample_consumed)), False
+        if _is_gzip(path):
+            expected_size = int(sum(len(data) for data in sample) * size / sample_consumed)
+            error = check_tail(path, expected_size)
+            if error is not None:
+                return FastqScan(path, size, None, False, lengths, error), names
+    else:
+        tail = (previous + last).split(b'\n')
+        if last.endswith(b'\n'):
+            tail.pop()
+        num_lines = newlines + (0 if last.endswith(b'\n') or len(last) == 0 else 1)
+        if num_lines % 4 != 0 or (len(tail) >= 4 and not _is_record(tail[-4:])):
+            return FastqScan(path, size, None, True, lengths,
+                             "%d lines, the last FASTQ record is incomplete" % num_lines), names
+        reads, exact = num_lines // 4, True
+    error = "no reads" if reads == 0 else None
+    return FastqScan(path, size, reads, exact, lengths, error), names
+
+
+def check_sync(first_names, second_names):
+    """None if the sampled read names of both mates agree, otherwise a
+    description of the first difference"""
+    for index, (first, second) in enumerate(zip(first_names, second_names)):
+        if first != second:
+            return "mates out of sync at read %d: '%s' in R1, '%s' in R2" % (index + 1, first, second)
+    if len(first_names) != len(second_names):
+        return "mates out of sync: %d sampled reads in R1, %d in R2" % (len(first_names), len(second_names))
+    return None
+
+
+def scan_pair(pair, sample_reads=SAMPLE_READS, verify=True):
+    """the PairScan of pair = (folder, first, second), second is None for single end data"""
+    folder, first_path, second_path = pair
+    first, first_names = scan_fastq(first_path, sample_reads, verify)
+    errors = ["%s: %s" % (first_path, first.error)] if first.error is not None else []
+    second = None
+    if second_path is not None:
+        second, second_names = scan_fastq(second_path, sample_reads, verify)
+        if second.error is not None:
+            errors.append("%s: %s" % (second_path, second.error))
+        elif first.error is None:
+            sync_error = check_sync(first_names, second_names)
+            if sync_error is None and first.exact and second.exact and first.reads != second.reads:
+                sync_error = "mates out of sync: %d reads in R1, %d in R2" % (first.reads, second.reads)
+            if sync_error is not None:
+                errors.append("%s: %s" % (first_path, sync_error))
+    return PairScan(folder, first, second, errors)
+
+
+def scan_pairs(pairs, workers=None, sample_reads=SAMPLE_READS, verify=True):
+    """the PairScans of the (folder, first, second) pairs, in the same order"""
+    if len(pairs) == 0:
+        return []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(scan_pair, pairs, repeat(sample_reads), repeat(verify)))
+
+
+def discover_pairs(config, filesys=OSFS('/')):
+    """dictionary of data folder -> (folder, first, second) of its FASTQ pairs,
+    found with the same patterns as the pipeline"""
+    patterns = config.get('fastq_patterns', []) or [DEFAULT_FASTQ_PATTERN]
+    result = {}
+    for folder in rnaseq_data_folder_list(config, filesys):
+        data_folder = os.path.join(config['input_dir'], folder)
+        result[folder] = [(folder, first, second) for first, second in find_fastq_files(data_folder, patterns, filesys)]
+    return result
+
+
+def mean_length(lengths):
+    num_reads = sum(lengths.values())
+    return sum(length * count for length, count in lengths.items()) / num_reads if num_reads > 0 else 0
+
+
+def length_summary(lengths):
+    """minimum, median and maximum of a read length distribution"""
+    if len(lengths) == 0:
+        return "no reads sampled"
+    half, seen = sum(lengths.values()) / 2, 0
+    for median in sorted(lengths):
+        seen += lengths[median]
+        if seen >= half:
+            break
+    return "length %d-%d, median %d" % (min(lengths), max(lengths), median)
+
+
+def forecast(pair_scans, algorithm, threads=DEFAULT_THREADS):
+    """the Forecast of a data folder from the scans of its pairs, failed scans are left out"""
+    fragments = bases = size = 0
+    for pair_scan in pair_scans:
+        if len(pair_scan.errors) > 0:
+            continue
+        scans = [scan for scan in (pair_scan.first, pair_scan.second) if scan is not None]
+        fragments += pair_scan.first.reads
+        bases += sum(scan.reads * mean_length(scan.lengths) for scan in scans)
+        size += sum(scan.size for scan in scans)
+    cpu_seconds = sum(fragments / FRAGMENTS_PER_CPU_SECOND[stage] for stage in STAGES[algorithm])
+    disk = size * TRIMMED_SIZE_RATIO
+    if algorithm == 'star_salmon':
+        disk += bases * BAM_BYTES_PER_BASE
+    return Forecast(fragments, int(bases), cpu_seconds / threads / 3600, int(disk))
+
+
+def _format_scan(scan):
+    return "%s: %.2fM reads%s, %s" % (os.path.basename(scan.path), scan.reads / 1e6,
+                                      '' if scan.exact else ' (estimated)', length_summary(scan.lengths))
+
+
+def print_report(folder_scans, algorithm, threads=DEFAULT_THREADS, outfile=sys.stdout):
+    """print the scans and the forecast of every data folder, returns the list of errors"""
+    errors = []
+    for folder, pair_scans in folder_scans.items():
+        if len(pair_scans) == 0:
+            errors.append("%s: no FASTQ files found" % folder)
+            print("%s: ERROR no FASTQ files found" % folder, file=outfile)
+            continue
+        result = forecast(pair_scans, algorithm, threads)
+        print("%s: %d file set(s), %.2fM fragments, %.2f Gbases, ~%.1f h with %d threads, ~%.1f GB disk" %
+              (folder, len(pair_scans), result.fragments / 1e6, result.bases / 1e9, result.hours, threads,
+               result.disk / 1024 ** 3), file=outfile)
+        for pair_scan in pair_scans:
+            for scan in (pair_scan.first, pair_scan.second):
+                if scan is not None and scan.error is None:
+                    print("  %s" % _format_scan(scan), file=outfile)
+            for error in pair_scan.errors:
+                print("  ERROR %s" % error, file=outfile)
+            errors += pair_scan.errors
+    outfile.flush()
+    return errors
+
+
+def run_preflight(config, algorithm, outfile=sys.stdout, verify=False, workers=SUBMIT_HOST_WORKERS):
+    """Run the preflight for the data folders of config with the options of
+    its "preflight" section (true or a dictionary), returns the list of errors.
+    verify and workers are the defaults of the options, the quick mode with
+    a few processes is suitable for the submit host"""
+    options = config['preflight'] if isinstance(config.get('preflight'), dict) else {}
+    folder_pairs = discover_pairs(config)
+    pairs = [pair for folder in folder_pairs.values() for pair in folder]
+    print("Preflight of %d FASTQ file set(s) in %d data folder(s)" % (len(pairs), len(folder_pairs)),
+          file=outfile, flush=True)
+    scans = iter(scan_pairs(pairs, options.get('workers', workers), options.get('sample_reads', SAMPLE_READS),
+                            options.get('verify', verify)))
+    folder_scans = {folder: [next(scans) for _ in folder_pairs[folder]] for folder in folder_pairs}
+    return print_report(folder_scans, algorithm, options.get('threads', DEFAULT_THREADS), outfile)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=DESCRIPTION)
+    parser.add_argument('configfile', help="configuration file")
+    parser.add_argument('--quick', action='store_true',
+                        help="only decompress the sampled reads and estimate the read counts")
+    parser.add_argument('--workers', type=int, default=None, help="number of scanning processes")
+    args = parser.parse_args()
+    with open(args.configfile) as infile:
+        config = json.load(infile)
+    options = config['preflight'] if isinstance(config.get('preflight'), dict) else {}
+    if args.quick:
+        options['verify'] = False
+    if args.workers is not None:
+        options['workers'] = args.workers
+    config['preflight'] = options
+    errors = run_preflight(config, config['rnaseq_algorithm'], verify=True, workers=None)
+    if len(errors) > 0:
+        sys.exit("ERROR: %d problem(s) with the FASTQ files" % len(errors))
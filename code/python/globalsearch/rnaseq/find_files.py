@@ -3,19 +3,53 @@
 find_files.py - module for flexible finding of FASTQ files
 """
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import glob
 import logging
+import time
 import os, re, fs
 import jinja2
 from fs.osfs import OSFS  # make sure we install the fs package !!!
 
 
-def rnaseq_data_folder_list(config, filesys=OSFS('/')):
+def scan_data_folders(input_dir, filesys=OSFS('/'), num_threads=1, stats=None):
+    """Return the directories in input_dir in listing order. On latency bound
+    network file systems, the directory checks can be run in num_threads
+    concurrent threads.
+    If stats is a dictionary, the number of entries, the elapsed time and the
+    scan throughput are stored in it.
+    """
+    start = time.perf_counter()
+    entries = filesys.listdir(input_dir)
+    paths = [fs.path.combine(input_dir, d) for d in entries]
+    if num_threads is not None and num_threads > 1 and len(paths) > 1:
+        with ThreadPoolExecutor(max_workers=min(num_threads, len(paths))) as executor:
+            # map() keeps the listing order
+            is_dir = list(executor.map(filesys.isdir, paths))
+    else:
+        is_dir = [filesys.isdir(path) for path in paths]
+    result = [d for d, d_is_dir in zip(entries, is_dir) if d_is_dir]
+
+    elapsed = time.perf_counter() - start
+    entries_per_second = len(entries) / elapsed if elapsed > 0 else float('inf')
+    logging.getLogger("rnaseq").info("scanned %d entries of '%s' in %.3f s (%.1f entries/s, %d thread(s))",
+                                     len(entries), input_dir, elapsed, entries_per_second,
+                                     num_threads or 1)
+    if stats is not None:
+        stats.update({'entries': len(entries), 'seconds': elapsed,
+                      'entries_per_second': entries_per_second})
+    return result
+
+
+def rnaseq_data_folder_list(config, filesys=OSFS('/'), cache=None, stats=None):
     """Function to determine the list of directories that are to be submitted to
     the cluster for RNA sequencing analysis
+    If a DiscoveryCache is provided, the scan of the input directory is cached.
+    The number of threads to check the input directory entries can be set with
+    the "scan_threads" configuration setting
     """
     result = []
-    pattern = re.compile('R[E]?\d+.*')
+    pattern = re.compile(r'R[E]?\d+.*')
     try:
         includes_list = config['includes']
     except KeyError:
@@ -40,8 +74,19 @@ def rnaseq_data_folder_list(config, filesys=OSFS('/')):
         # that match the pattern
         #print("ADD TOPLEVEL FILES: %s" % config['input_dir'])
         #result = [d for d in filesys.listdir(config['input_dir']) if re.match(pattern, d)]
-        result = [d for d in filesys.listdir(config['input_dir'])
-                if filesys.isdir(fs.path.combine(config['input_dir'], d))]
+        try:
+            num_threads = config['scan_threads']
+        except KeyError:
+            num_threads = 1
+
+        def scan(record):
+            record(config['input_dir'])
+            return scan_data_folders(config['input_dir'], filesys, num_threads, stats)
+
+        if cache is None:
+            result = scan(lambda path, info=None: None)
+        else:
+            result = cache.lookup('folders:%s' % config['input_dir'], scan)
     return result
 
 
@@ -77,13 +122,132 @@ def _find_fastq_files(data_folder, patterns, rootfs):
     return result
 
 
-def find_fastq_files(data_folder, patterns, filesys=OSFS('/')):
+# Placeholder for the read number while translating a pattern into a regular expression
+READNUM_MARKER = 'READNUM@@MARKER'
+
+
+def _translate_component(component):
+    """regular expression of a glob path component: * and ? don't match a
+    slash, [...] and [!...] are character classes, everything else is literal"""
+    result = []
+    i, n = 0, len(component)
+    while i < n:
+        c = component[i]
+        i += 1
+        if c == '*':
+            result.append('[^/]*')
+        elif c == '?':
+            result.append('[^/]')
+        elif c == '[':
+            j = i + 1 if i < n and component[i] == '!' else i
+            if j < n and component[j] == ']':
+                j += 1
+            j = component.find(']', j)
+            if j < 0:
+                result.append(re.escape(c))
+            else:
+                chars = component[i:j].replace('\\', '\\\\')
+                # a literal [ and the set operations of future re versions are escaped
+                chars = re.sub(r'([\[&~|])', r'\\\1', chars)
+                if chars.startswith('!'):
+                    chars = '^' + chars[1:]
+                elif chars.startswith('^'):
+                    chars = '\\' + chars
+                result.append('[%s]' % chars)
+                i = j + 1
+        else:
+            result.append(re.escape(c))
+    return ''.join(result)
+
+
+def _translate_glob(pattern):
+    """regular expression (without anchors) of an absolute glob path, "**"
+    matches any number of directories, like the PyFS glob()"""
+    result = []
+    for component in pattern.strip('/').split('/'):
+        if component == '**':
+            result.append('.*/?')
+        elif component != '':
+            result.append('/' + _translate_component(component))
+    return ''.join(result)
+
+
+def _compile_fastq_patterns(patterns):
+    """Compile all patterns into a single regular expression that is matched against
+    the paths below the data folder. Each pattern becomes a named alternative "p<i>",
+    the position of the read number is captured in the group "r<i>".
+    Returns the compiled expression and for each pattern, whether it has a read number
+    """
+    alternatives = []
+    has_readnum = []
+    for i, pat in enumerate(patterns):
+        # keep "pairnum" for legacy reasons
+        rendered = jinja2.Template(pat).render({'pairnum': READNUM_MARKER, 'readnum': READNUM_MARKER})
+        regex = _translate_glob(fs.path.combine('/**', rendered))
+        marker = re.escape(READNUM_MARKER)
+        has_readnum.append(marker in regex)
+        regex = regex.replace(marker, '(?P<r%d>[12])' % i, 1).replace(marker, '(?P=r%d)' % i)
+        alternatives.append('(?P<p%d>%s)' % (i, regex))
+    return re.compile('(?ms)^(?:%s)$' % '|'.join(alternatives)), has_readnum
+
+
+def _walk_files(filesys, data_folder, record):
+    """Walk all files below filesys and report every visited directory to record()"""
+    if record is None:
+        yield from filesys.walk.files()
+        return
+    record(data_folder)
+    for step in filesys.walk.walk(namespaces=['details', 'stat']):
+        for info in step.dirs:
+            record(fs.path.join(data_folder, fs.path.relpath(step.path), info.name), info)
+        for info in step.files:
+            yield fs.path.combine(step.path, info.name)
+
+
+def _find_fastq_files_indexed(data_folder, patterns, rootfs, record=None):
+    """File finder that walks the data folder exactly once and matches every file against
+    all patterns at the same time.
+    Files matching a pattern with a read number are paired up by the part of the path
+    that surrounds the read number. All pairs are returned, ordered by pattern and path.
+    A file is only assigned to the first pattern it matches
+    """
+    matcher, has_readnum = _compile_fastq_patterns(patterns)
+    filesys = rootfs.opendir(data_folder)
+    first_reads = [[] for _ in patterns]
+    second_reads = [{} for _ in patterns]
+    for path in _walk_files(filesys, data_folder, record):
+        match = matcher.match(path)
+        if match is None:
+            continue
+        index = int(match.lastgroup[1:])
+        if not has_readnum[index]:
+            first_reads[index].append((path, path))
+            continue
+        group = 'r%d' % index
+        start, end = match.span(group)
+        key = path[:start] + path[end:]
+        if match.group(group) == '1':
+            first_reads[index].append((key, path))
+        else:
+            second_reads[index][key] = path
+
+    result = []
+    for index in range(len(patterns)):
+        for key, first in sorted(first_reads[index], key=lambda entry: entry[1]):
+            second = second_reads[index].get(key)
+            result.append((fs.path.combine(data_folder, first),
+                           fs.path.combine(data_folder, second) if second is not None else None))
+    return result
+
+
+def find_fastq_files(data_folder, patterns, filesys=OSFS('/'), cache=None):
     """
     This function finds the FASTQ files according to the specified patterns. It will
     start at data_folder and try to find all FASTQ files, if possible as pairs.
     If there is no second file, the second component of the result will be None.
     For the most part, patterns will follow the glob format, you can specify the position
-    of the pair number in Jinja2 format
+    of the pair number in Jinja2 format.
+    The data folder is only traversed once, all matching pairs are returned
     Example:
 
     A pattern of
@@ -96,9 +260,15 @@ def find_fastq_files(data_folder, patterns, filesys=OSFS('/')):
     :param data_folder: the top level folder to start searching from
     :param patterns: list of patterns to use in glob searching
     :param filesys: the PyFS file system to use in glob searching
+    :param cache: optional DiscoveryCache to look up the result of earlier searches
     :return the list of matching paths
     """
-    return _find_fastq_files(data_folder, patterns, filesys)
+    if cache is None:
+        return _find_fastq_files_indexed(data_folder, patterns, filesys)
+    scope = 'fastq:%s:%s' % (data_folder, ','.join(patterns))
+    result = cache.lookup(scope, lambda record: _find_fastq_files_indexed(data_folder, patterns,
+                                                                          filesys, record))
+    return [tuple(pair) for pair in result]
 
 
 # Base pattern for searching
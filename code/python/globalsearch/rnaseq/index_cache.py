@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+"""
+index_cache.py - content addressed cache for STAR and kallisto indexes
+
+An index is stored under <cache_root>/<name>.<key>, where the key is a hash
+of the content of the input files, the index parameters and the version of
+the indexing tool. <cache_root>/<name> is a symbolic link to the most
+recently used index, so readers don't need to know the key.
+
+A build runs in a temporary location with an exclusive lock held, and is
+renamed into place when it is complete, so concurrent tasks neither build
+the same index twice nor see a partially written index. Tasks that find
+the lock taken wait for the build and reuse its result.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+
+KEY_LENGTH = 16
+DIGEST_MEMO = '.input_digests.json'
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def _load_memo(cache_root):
+    try:
+        with open(os.path.join(cache_root, DIGEST_MEMO)) as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_memo(cache_root, memo):
+    os.makedirs(cache_root, exist_ok=True)
+    path = os.path.join(cache_root, DIGEST_MEMO)
+    tmp_path = '%s.%d' % (path, os.getpid())
+    with open(tmp_path, 'w') as outfile:
+        json.dump(memo, outfile, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def _hash_file(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(HASH_BLOCK_SIZE), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def file_digest(path, cache_root=None):
+    """sha256 of a file's content. With a cache_root, the digests are memoized
+    by path, size and modification time, so large FASTA files are only read
+    again when they change. The memo is read, hashed and updated with its lock
+    held, so concurrent tasks neither drop each other's entries nor hash the
+    same file side by side"""
+    if cache_root is None:
+        return _hash_file(path)
+    os.makedirs(cache_root, exist_ok=True)
+    with open(os.path.join(cache_root, DIGEST_MEMO + '.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            stat = os.stat(path)
+            memo_key = os.path.realpath(path)
+            memo = _load_memo(cache_root)
+            entry = memo.get(memo_key)
+            if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+                return entry['sha256']
+            digest = _hash_file(path)
+            memo[memo_key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest}
+            _save_memo(cache_root, memo)
+            return digest
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def index_key(input_paths, params, version, cache_root=None):
+    """the cache key of an index built from input_paths with params by the given tool version"""
+    data = {
+        'inputs': [file_digest(path, cache_root) for path in input_paths],
+        'params': params,
+        'version': version
+    }
+    serialized = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()[:KEY_LENGTH]
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def _link(cache_root, name, target_name):
+    """atomically point <cache_root>/<name> to target_name"""
+    link_path = os.path.join(cache_root, name)
+    if os.path.islink(link_path) and os.readlink(link_path) == target_name:
+        return
+    if os.path.isdir(link_path) and not os.path.islink(link_path):
+        # an index from before the cache, a symlink can't replace a directory
+        shutil.rmtree(link_path)
+    tmp_link = '%s.link.%d' % (link_path, os.getpid())
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(target_name, tmp_link)
+    os.replace(tmp_link, link_path)
+
+
+def cached_index(cache_root, name, key, build):
+    """Return the path of the index <cache_root>/<name>.<key>, calling
+    build(path) to create it at the given temporary path if it does not
+    exist yet. build can create a file or a directory."""
+    os.makedirs(cache_root, exist_ok=True)
+    target_name = '%s.%s' % (name, key)
+    target = os.path.join(cache_root, target_name)
+    if not os.path.exists(target):
+        with open(target + '.lock', 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print("index '%s' is being built by another task, waiting" % target, flush=True)
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # the index might have been completed while waiting for the lock
+                if not os.path.exists(target):
+                    build_path = target + '.tmp'
+                    _remove(build_path)  # left behind by an interrupted build
+                    build(build_path)
+                    os.replace(build_path, target)
+                    print("index '%s' built" % target, flush=True)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    else:
+        print("index '%s' found in the cache" % target, flush=True)
+    _link(cache_root, name, target_name)
+    return target
+
+
+def resolve_index(cache_root, name):
+    """the path of the current index <cache_root>/<name>, None if there is none"""
+    path = os.path.join(cache_root, name)
+    return path if os.path.exists(path) else None
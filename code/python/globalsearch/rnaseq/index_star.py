@@ -6,17 +6,50 @@ Module to encapsulate STAR indexing.
 It takes the genome directory and one or more FASTA files
 and passes them to STAR to generate a genome index within
 the genome directory.
-If the index exists, it will skip the generation, to avoid
-wasting time as this is a very costly step.
+Indexes are cached in star_index.<key> directories of the genome
+directory, the key is a hash of the input files, the parameters and the
+STAR version. If a matching index exists, it will skip the generation, to
+avoid wasting time as this is a very costly step. star_index is a link to
+the index that was built or found last.
+
+If a GFF/GTF file is specified, the splice junctions of the annotation
+are inserted at index time, so the mapping runs don't need to insert
+them on the fly and can share the loaded genome.
+
+genomeSAindexNbases and genomeChrBinNbits are derived from the length and
+the number of sequences of the genome unless they are specified.
 """
 import argparse
 import os
 import subprocess
-import glob
 
+from .checkpoint import tool_version
+from .fasta_index import check_unique_names, find_genome_fasta
+from .fasta_stats import tune_index_args
+from .index_cache import cached_index, index_key, resolve_index
 
 DESCRIPTION = """index_star_salmon.py - Create genome index using STAR"""
 
+# STAR writes this file into indexes that include annotations
+ANNOTATION_SJDB_FILE = 'sjdbList.fromGTF.out.tab'
+
+# name of the link to the current index in the genome directory
+STAR_INDEX_NAME = 'star_index'
+
+
+def is_annotated_index(genome_dir):
+    """True if the index in genome_dir was built with the junctions of a GTF/GFF file"""
+    return os.path.exists(os.path.join(genome_dir, ANNOTATION_SJDB_FILE))
+
+
+def star_index_dir(genome_dir):
+    """the directory of the STAR index for genome_dir: the cached index if there
+    is one, otherwise genome_dir itself, which can contain an index built
+    in place. The path is resolved, so a task keeps using the same index even if
+    a newer one is built while it runs"""
+    index_dir = resolve_index(genome_dir, STAR_INDEX_NAME)
+    return os.path.realpath(index_dir if index_dir is not None else genome_dir)
+
 
 ####################### Create STAR index ###############################
 ### This should be specific for the organism
@@ -28,13 +61,21 @@ def create_genome_index(genome_dir, genome_fasta, args):
                      '--genomeFastaFiles', genome_fasta,
                      '--genomeChrBinNbits', str(args.genomeChrBinNbits),
                      '--genomeSAindexNbases', str(args.genomeSAindexNbases)]
+    # insert the annotated and/or the listed junctions at index time
+    if args.genome_gff is not None:
+        index_command += ['--sjdbGTFfile', args.genome_gff]
+    if args.sjdbFileChrStartEnd is not None:
+        index_command += ['--sjdbFileChrStartEnd'] + args.sjdbFileChrStartEnd
+    if args.genome_gff is not None or args.sjdbFileChrStartEnd is not None:
+        index_command += ['--sjdbOverhang', str(args.sjdbOverhang),
+                          '--limitSjdbInsertNsj', str(args.limitSjdbInsertNsj)]
     # optional commands
     if args.sjdbGTFfeatureExon is not None:
-        index_command += ["sjdbGTFfeatureExon", args.sjdbGTFfeatureExon]
+        index_command += ["--sjdbGTFfeatureExon", args.sjdbGTFfeatureExon]
     if args.sjdbGTFtagExonParentTranscript is not None:
-        index_command += ["sjdbGTFtagExonParentTranscript", args.sjdbGTFtagExonParentTranscript]
-    if args.sjdbGTFtagExonParentTranscript is not None:
-        index_command += ["sjdbGTFtagExonParentGene", args.sjdbGTFtagExonParentGene]
+        index_command += ["--sjdbGTFtagExonParentTranscript", args.sjdbGTFtagExonParentTranscript]
+    if args.sjdbGTFtagExonParentGene is not None:
+        index_command += ["--sjdbGTFtagExonParentGene", args.sjdbGTFtagExonParentGene]
 
     index_cmd = ' '.join(index_command)
     print("RUNNING STAR in index MODE: '%s'" % index_cmd, flush=True)
@@ -48,21 +89,59 @@ def create_genome_index(genome_dir, genome_fasta, args):
         print('finished indexing with STAR', flush=True)
 
 
+def index_params(args):
+    """the parameters that determine the content of the index"""
+    params = {'genomeChrBinNbits': args.genomeChrBinNbits, 'genomeSAindexNbases': args.genomeSAindexNbases}
+    if args.genome_gff is not None or args.sjdbFileChrStartEnd is not None:
+        params.update(sjdbOverhang=args.sjdbOverhang, limitSjdbInsertNsj=args.limitSjdbInsertNsj)
+    if args.genome_gff is not None:
+        params.update(sjdbGTFfeatureExon=args.sjdbGTFfeatureExon,
+                      sjdbGTFtagExonParentTranscript=args.sjdbGTFtagExonParentTranscript,
+                      sjdbGTFtagExonParentGene=args.sjdbGTFtagExonParentGene)
+    return params
+
+
+def cached_genome_index(cache_root, genome_fasta, args, name=STAR_INDEX_NAME):
+    """Return the directory of the index for the FASTA file, the optional
+    annotation and junction files and the parameters, building it
+    if it's not in cache_root yet"""
+    input_paths = [genome_fasta]
+    if args.genome_gff is not None:
+        input_paths.append(args.genome_gff)
+    if args.sjdbFileChrStartEnd is not None:
+        input_paths += args.sjdbFileChrStartEnd
+    key = index_key(input_paths, index_params(args), tool_version('STAR'), cache_root)
+
+    def build(index_dir):
+        check_unique_names(genome_fasta)
+        os.makedirs(index_dir)
+        create_genome_index(index_dir, genome_fasta, args)
+    return cached_index(cache_root, name, key, build)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
                                      description=DESCRIPTION)
     parser.add_argument('genomedir', help='genome directory')
     parser.add_argument('--genome_fasta', help='genome FASTA file')
+    parser.add_argument('--genome_gff', help='genome GFF/GTF file, its junctions are inserted into the index')
     parser.add_argument('--runThreadN', type=int, default=32)
-    parser.add_argument('--genomeChrBinNbits', type=int, default=16)
-    parser.add_argument('--genomeSAindexNbases', type=int, default=12)
+    parser.add_argument('--genomeChrBinNbits', type=int, help="default: derived from the genome")
+    parser.add_argument('--genomeSAindexNbases', type=int, help="default: derived from the genome")
     parser.add_argument("--sjdbGTFfeatureExon")
     parser.add_argument("--sjdbGTFtagExonParentTranscript")
     parser.add_argument("--sjdbGTFtagExonParentGene")
+    parser.add_argument('--sjdbFileChrStartEnd', nargs='+', help="junction files to insert into the index")
+    parser.add_argument('--sjdbOverhang', type=int, default=100, help="maximum read length - 1")
+    parser.add_argument('--limitSjdbInsertNsj', type=int, default=1602710)
 
     args = parser.parse_args()
-    if args.genome_fasta is not None and os.path.exists(args.genome_fasta):
-        genome_fasta = args.genome_fasta
-    else:
-        genome_fasta = glob.glob('%s/*.fasta' % (args.genomedir))[0]
-    create_genome_index(args.genomedir, genome_fasta, args)
+    genome_fasta = find_genome_fasta(args.genomedir, args.genome_fasta)
+    if args.genome_gff is not None and not os.path.exists(args.genome_gff):
+        print("genome GFF '%s' does not exist, building index without annotation" % args.genome_gff, flush=True)
+        args.genome_gff = None
+    if args.genome_gff is not None and args.sjdbGTFtagExonParentTranscript is None:
+        # GFF files link exons to transcripts through the Parent attribute
+        args.sjdbGTFtagExonParentTranscript = "Parent"
+    tune_index_args(args, genome_fasta)
+    cached_genome_index(args.genomedir, genome_fasta, args)
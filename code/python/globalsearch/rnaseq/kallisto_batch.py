@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+"""
+kallisto_batch.py - quantify many samples with a single kallisto process
+
+kallisto quant loads the index for every sample, which dominates the run
+time for cohorts of many small samples. kallisto pseudo --quant reads a
+batch file with one line per sample ("<id> <file 1> <file 2>"), loads the
+index once and writes the estimated counts and TPM of all samples as
+sparse matrices (matrix.cells, transcripts.txt, matrix.abundance.mtx,
+matrix.abundance.tpm.mtx). The matrices are split into an abundance.tsv
+file per sample directory, in the format kallisto quant writes.
+
+Batch mode needs a kallisto version with the pseudo command (0.46.2 to 0.48).
+It does not compute bootstraps or a bias correction and it does not report
+effective lengths: the eff_length column of abundance.tsv holds the
+transcript length, and so do the lengths of the TPMs if kallisto did not
+write them. The counts and TPMs are written at full precision. So the
+results can't be mistaken for kallisto quant results, every sample
+directory of a batch gets a marker file (BATCH_MARKER) that describes the
+run, tximport only accepts them with transcript length weighting.
+"""
+import json
+import os
+import shutil
+import subprocess
+
+import numpy as np
+
+from .checkpoint import tmp_path, commit_path
+from .fasta_index import FastaIndex
+
+BATCH_FILE = 'batch.txt'
+CELLS_FILE = 'matrix.cells'
+TRANSCRIPTS_FILE = 'transcripts.txt'
+COUNTS_MATRIX = 'matrix.abundance.mtx'
+TPM_MATRIX = 'matrix.abundance.tpm.mtx'
+ABUNDANCE_FILE = 'abundance.tsv'
+ABUNDANCE_HEADER = 'target_id\tlength\teff_length\test_counts\ttpm\n'
+BATCH_MARKER = 'kallisto_batch.json'
+
+
+def is_batch_result(result_dir):
+    """True if the kallisto results in result_dir are from a batch run"""
+    return os.path.exists(os.path.join(result_dir, BATCH_MARKER))
+
+
+def write_batch_marker(path, command, tpm_source):
+    with open(path, 'w') as outfile:
+        json.dump({'call': ' '.join(command), 'n_bootstraps': 0, 'bias_correction': False,
+                   'eff_length': 'transcript length, not the effective length', 'tpm': tpm_source},
+                  outfile, indent=2)
+
+
+def write_batch_file(path, samples):
+    """write the batch file for samples, a list of (sample_dir, input_files)
+    tuples, the samples are identified by their position"""
+    with open(path, 'w') as outfile:
+        for index, (sample_dir, input_files) in enumerate(samples):
+            outfile.write('\t'.join(['s%d' % index] + list(input_files)) + '\n')
+
+
+def read_lines(path):
+    with open(path) as infile:
+        return [line.strip() for line in infile if len(line.strip()) > 0]
+
+
+def read_matrix_market(path, shape):
+    """Read a coordinate MatrixMarket file into a dense array with the given
+    (samples, transcripts) shape, transposing it if it was written the other way"""
+    with open(path) as infile:
+        line = infile.readline()
+        while line.startswith('%'):
+            line = infile.readline()
+        rows, cols, nonzero = [int(value) for value in line.split()]
+        entries = np.loadtxt(infile, ndmin=2).reshape(-1, 3)
+    if (rows, cols) != shape and (cols, rows) == shape:
+        entries = entries[:, [1, 0, 2]]
+    elif (rows, cols) != shape:
+        raise ValueError("matrix '%s' is %dx%d, expected %dx%d" % (path, rows, cols, shape[0], shape[1]))
+    matrix = np.zeros(shape)
+    matrix[entries[:, 0].astype(np.int64) - 1, entries[:, 1].astype(np.int64) - 1] = entries[:, 2]
+    return matrix
+
+
+def tpm(counts, lengths):
+    """transcripts per million of the estimated counts of every sample (rows)"""
+    rates = counts / np.maximum(lengths, 1)
+    totals = rates.sum(axis=1, keepdims=True)
+    return np.divide(rates * 1e6, totals, out=np.zeros_like(rates), where=totals > 0)
+
+
+def write_abundance(path, names, lengths, counts, tpms):
+    """write abundance.tsv with the transcript lengths as eff_length, the
+    counts and TPMs are written at full precision"""
+    with open(path, 'w') as outfile:
+        outfile.write(ABUNDANCE_HEADER)
+        for name, length, count, value in zip(names, lengths.tolist(), counts.tolist(), tpms.tolist()):
+            outfile.write('%s\t%d\t%d\t%r\t%r\n' % (name, length, length, count, value))
+
+
+def split_batch_results(batch_dir, samples, transcriptome_file, command):
+    """write the abundance.tsv and the batch marker of every sample from the
+    matrices of a batch run of command"""
+    cells = read_lines(os.path.join(batch_dir, CELLS_FILE))
+    names = read_lines(os.path.join(batch_dir, TRANSCRIPTS_FILE))
+    shape = (len(cells), len(names))
+    counts = read_matrix_market(os.path.join(batch_dir, COUNTS_MATRIX), shape)
+    fasta_index = FastaIndex(transcriptome_file)
+    lengths = np.array([fasta_index.length(name) if name in fasta_index else 0 for name in names])
+    if os.path.exists(os.path.join(batch_dir, TPM_MATRIX)):
+        tpms = read_matrix_market(os.path.join(batch_dir, TPM_MATRIX), shape)
+        tpm_source = 'kallisto'
+    else:
+        tpms = tpm(counts, lengths)
+        tpm_source = 'estimated counts per transcript length'
+
+    rows = {cell: row for row, cell in enumerate(cells)}
+    for index, (sample_dir, input_files) in enumerate(samples):
+        row = rows['s%d' % index]
+        build_dir = tmp_path(sample_dir)
+        if os.path.exists(build_dir):
+            shutil.rmtree(build_dir)
+        os.makedirs(build_dir)
+        write_abundance(os.path.join(build_dir, ABUNDANCE_FILE), names, lengths, counts[row], tpms[row])
+        write_batch_marker(os.path.join(build_dir, BATCH_MARKER), command, tpm_source)
+        commit_path(sample_dir)
+
+
+def run_kallisto_batch(index_path, batch_dir, samples, transcriptome_file, threads=4):
+    """Quantify samples, a list of (sample_dir, input_files) tuples, with one
+    kallisto process. Samples whose directory exists are finished and skipped.
+    batch_dir holds the batch file and the matrices while the batch runs, it
+    is removed when the batch is done or failed."""
+    samples = [(sample_dir, input_files) for sample_dir, input_files in samples
+               if not os.path.exists(sample_dir)]
+    if len(samples) == 0:
+        print("all kallisto results found, skipping the batch", flush=True)
+        return
+    if os.path.exists(batch_dir):
+        shutil.rmtree(batch_dir)
+    os.makedirs(batch_dir)
+    try:
+        batch_file = os.path.join(batch_dir, BATCH_FILE)
+        write_batch_file(batch_file, samples)
+        command = ['kallisto', 'pseudo', '--quant', '-i', index_path, '-o', batch_dir, '-b', batch_file,
+                   '-t', str(threads), '--rf-stranded']
+        print('Kallisto batch command (%d samples): "%s"' % (len(samples), ' '.join(command)), flush=True)
+        subprocess.run(command, check=True, capture_output=False)
+        split_batch_results(batch_dir, samples, transcriptome_file, command)
+    finally:
+        shutil.rmtree(batch_dir, ignore_errors=True)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+"""
+kallisto_bootstrap.py - bootstrap summaries of many kallisto abundance.h5 files
+
+kallisto quant runs with -b 100, so every abundance.h5 holds 100 bootstrap
+estimates of the counts (/bootstrap/bs0 ... bs99). Loading all of them for
+a cohort needs samples x bootstraps x transcripts values in memory at
+once. Here every file is opened lazily by a worker process and its
+bootstraps are streamed in blocks of transcripts, so a worker holds one
+block of one bootstrap plus the running sums. The per transcript summaries
+of every sample
+
+  mean      mean of the bootstrap counts
+  variance  variance of the bootstrap counts (n - 1 denominator)
+  InfRV     inferential relative variance, max(variance - mean, 0) / (mean + 5) + 0.01,
+            as computed by fishpond::computeInfRV()
+
+are written into one matrix file (see matrix_h5.py) in blocks of samples,
+with the transcripts as rows and the samples as columns. Samples without
+bootstraps have NaN summaries.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+import h5py
+import numpy as np
+
+from .matrix_h5 import MatrixWriter
+from .salmon_quants import names_digest, sample_names
+
+DESCRIPTION = """kallisto_bootstrap.py - mean, variance and InfRV of the kallisto bootstraps of all samples"""
+
+ABUNDANCE_H5 = 'abundance.h5'
+SUMMARIES = ('mean', 'variance', 'InfRV')
+# transcripts per block of a bootstrap that is read at once
+BLOCK_ROWS = 1 << 20
+# samples that are written to the matrix file at once
+BLOCK_SAMPLES = 16
+INFRV_PSEUDOCOUNT = 5
+INFRV_SHIFT = 0.01
+
+
+def find_abundance_files(analysis_dir):
+    """the abundance.h5 files below analysis_dir, sorted by path"""
+    result = []
+    for root, dirs, files in os.walk(analysis_dir):
+        if ABUNDANCE_H5 in files:
+            result.append(os.path.join(root, ABUNDANCE_H5))
+    return sorted(result)
+
+
+def read_ids(path):
+    with h5py.File(path, 'r') as infile:
+        return [name.decode('utf-8') if isinstance(name, bytes) else name for name in infile['aux/ids'][:]]
+
+
+def infrv(mean, variance, pseudocount=INFRV_PSEUDOCOUNT, shift=INFRV_SHIFT):
+    return np.maximum(variance - mean, 0) / (mean + pseudocount) + shift
+
+
+def bootstrap_summary(path, block_rows=BLOCK_ROWS):
+    """Returns the digest of the transcript ids and the mean, variance and
+    InfRV of the bootstraps in the abundance.h5 file at path. The sums are
+    taken relative to the first bootstrap, which keeps the variance exact for
+    large counts."""
+    with h5py.File(path, 'r') as infile:
+        ids_digest = names_digest([name.decode('utf-8') if isinstance(name, bytes) else name
+                                   for name in infile['aux/ids'][:]])
+        estimate = infile['est_counts']
+        bootstraps = [infile['bootstrap'][name] for name in sorted(infile.get('bootstrap', {}).keys())]
+        num_rows = estimate.shape[0]
+        mean = np.full(num_rows, np.nan)
+        variance = np.full(num_rows, np.nan)
+        if len(bootstraps) == 0:
+            return ids_digest, mean, variance, variance.copy()
+        for start in range(0, num_rows, block_rows):
+            end = min(num_rows, start + block_rows)
+            shift = bootstraps[0][start:end]
+            sums = np.zeros(end - start)
+            squares = np.zeros(end - start)
+            for bootstrap in bootstraps:
+                values = bootstrap[start:end] - shift
+                sums += values
+                squares += values * values
+            mean[start:end] = shift + sums / len(bootstraps)
+            if len(bootstraps) > 1:
+                variance[start:end] = np.maximum(squares - sums * sums / len(bootstraps), 0) / (len(bootstraps) - 1)
+    return ids_digest, mean, variance, infrv(mean, variance)
+
+
+def summarize_bootstraps(paths, samples, out_path, workers=None, block_samples=BLOCK_SAMPLES):
+    """Write the bootstrap summaries of the abundance.h5 files in paths, named
+    samples, to the matrix file out_path. All files must have been quantified
+    against the same index."""
+    if len(paths) == 0:
+        raise ValueError("no abundance.h5 files")
+    ids = read_ids(paths[0])
+    ids_digest = names_digest(ids)
+    with MatrixWriter(out_path, ids, samples, SUMMARIES, chunk_cols=block_samples) as writer, \
+            ProcessPoolExecutor(max_workers=workers) as executor:
+        # one block of samples at a time, so at most a block of summaries is held in memory
+        for block_start in range(0, len(paths), block_samples):
+            block_paths = paths[block_start:block_start + block_samples]
+            results = list(executor.map(bootstrap_summary, block_paths))
+            for path, result in zip(block_paths, results):
+                if result[0] != ids_digest:
+                    raise ValueError("'%s' was quantified against another index than '%s'" % (path, paths[0]))
+            for index, name in enumerate(SUMMARIES):
+                writer.write_columns(name, block_start, np.column_stack([result[index + 1] for result in results]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=DESCRIPTION)
+    parser.add_argument('analysis_dir', help='the pipeline output directory')
+    parser.add_argument('outfile', help='matrix file (HDF5) for the summaries')
+    parser.add_argument('--workers', type=int, default=None, help="number of reader processes")
+    args = parser.parse_args()
+    analysis_dir = os.path.realpath(args.analysis_dir)
+    paths = find_abundance_files(analysis_dir)
+    print("Summarizing the bootstraps of %d abundance.h5 files in '%s'" % (len(paths), analysis_dir), flush=True)
+    summarize_bootstraps(paths, sample_names(paths, analysis_dir), args.outfile, args.workers)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+"""
+Generate a SLURM job file that merges the first pass junctions of a cohort
+two-pass alignment and builds the junction index. The job runs STAR
+genomeGenerate, so it gets the same sbatch options as the STAR index job
+"""
+
+import jinja2
+import argparse
+import json
+import os
+
+from globalsearch.rnaseq.make_star_idx_job import make_sbatch_options, make_sbatch_extras
+
+
+TEMPLATE = """#!/bin/bash
+
+#SBATCH -J cohort_twopass
+#SBATCH -o {{log_dir}}/"%j".out
+#SBATCH -e {{log_dir}}/"%j".out
+
+{{sbatch_options}}
+
+echo "TASK ID: $SLURM_JOB_ID"
+
+{{sbatch_extras}}
+
+python3 -m globalsearch.rnaseq.cohort_twopass {{configfile}}
+"""
+
+DESCRIPTION = """make_cohort_twopass_job.py - Create the cohort two-pass junction index job file for Slurm"""
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=DESCRIPTION)
+    parser.add_argument('configfile', help="configuration file")
+    args = parser.parse_args()
+    with open(args.configfile) as infile:
+        config = json.load(infile)
+
+    templ = jinja2.Template(TEMPLATE)
+    config['configfile'] = os.path.abspath(args.configfile)
+    config['sbatch_extras'] = make_sbatch_extras(config)
+    config['sbatch_options'] = make_sbatch_options(config)
+    print(templ.render(config))
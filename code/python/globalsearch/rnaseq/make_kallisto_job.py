@@ -4,8 +4,10 @@ import jinja2
 import os
 import argparse
 import json
+import sys
 
 from globalsearch.rnaseq.find_files import rnaseq_data_folder_list
+from globalsearch.rnaseq.discovery_cache import open_discovery_cache, discovery_cache_path
 
 TEMPLATE = """#!/bin/bash
 
@@ -18,11 +20,12 @@ TEMPLATE = """#!/bin/bash
 
 echo "ARRAY TASK ID: $SLURM_ARRAY_TASK_ID"
 data_folders=({{data_folders}})
-data_folder=${data_folders[$SLURM_ARRAY_TASK_ID]}
+batch_size={{batch_size}}
+batch_folders=(${data_folders[@]:$((SLURM_ARRAY_TASK_ID * batch_size)):$batch_size})
 
 {{sbatch_extras}}
 
-python3 -m globalsearch.rnaseq.run_kallisto {{fastq_patterns}} {{genome_dir}} {{input_dir}} $data_folder {{genome_fasta}} {{output_dir}}
+python3 -m globalsearch.rnaseq.run_kallisto {{fastq_patterns}} {{trim_galore_options}} {{discovery_cache_option}} {{kallisto_merged_option}} {{kallisto_batch_option}} {{genome_dir}} {{input_dir}} ${batch_folders[@]} {{genome_fasta}} {{output_dir}}
 """
 
 DESCRIPTION = """make_kallisto_job.py - Create Kallisto job file for Slurm"""
@@ -55,10 +58,44 @@ if __name__ == '__main__':
     config['sbatch_extras'] = make_sbatch_extras(config)
     config['sbatch_options_comments'] = make_sbatch_options(config)
 
-    data_folders = rnaseq_data_folder_list(config)
+    # optional persistent cache for the input directory scans
+    try:
+        use_discovery_cache = config['discovery_cache']
+    except KeyError:
+        use_discovery_cache = False
+    if use_discovery_cache:
+        cache_path = discovery_cache_path(config)
+        config['discovery_cache_option'] = '--discovery_cache %s' % cache_path
+    else:
+        cache_path = None
+        config['discovery_cache_option'] = ''
+
+    scan_stats = {}
+    with open_discovery_cache(cache_path) as cache:
+        data_folders = rnaseq_data_folder_list(config, cache=cache, stats=scan_stats)
+    if len(scan_stats) > 0:
+        # the job file goes to stdout, so report the scan throughput on stderr
+        print("scanned %d entries in %.3f s (%.1f entries/s)" % (scan_stats['entries'], scan_stats['seconds'],
+                                                               scan_stats['entries_per_second']),
+              file=sys.stderr)
     config["data_folders"] = ' '.join(data_folders)
     config['fastq_patterns'] = '--fastq_patterns "%s"' % ','.join(config['fastq_patterns']) if len(config['fastq_patterns']) > 0 else ''
 
+    # optional core/memory budget for the concurrent trim_galore runs
+    trim_galore_options = []
+    try:
+        trim_galore_options += ["--trim_cores", str(config['trim_galore_options']['cores'])]
+    except KeyError:
+        pass
+    try:
+        trim_galore_options += ["--trim_memory", str(config['trim_galore_options']['memory'])]
+    except KeyError:
+        pass
+    config['trim_galore_options'] = ' '.join(trim_galore_options)
+
+    # optional folder level quantification in addition to the per sample results
+    config['kallisto_merged_option'] = '--merged' if config.get('kallisto_merged', False) else ''
+
     # Array specification
     try:
         array_max_tasks = config['sbatch_options']['array_max_tasks']
@@ -69,5 +106,12 @@ if __name__ == '__main__':
     else:
         array_max_task_spec = ""
 
-    config["array_range"] = "0-%d%s" % (len(data_folders) - 1, array_max_task_spec)
+    # every array task processes batch_size data folders. Only with kallisto_batch,
+    # their file sets are quantified by a single kallisto pseudo --quant process,
+    # which has no bootstraps and no bias correction
+    batch_size = max(1, config.get('batch_size', 1))
+    config['batch_size'] = batch_size
+    config['kallisto_batch_option'] = '--batch' if config.get('kallisto_batch', False) else ''
+    num_tasks = (len(data_folders) + batch_size - 1) // batch_size
+    config["array_range"] = "0-%d%s" % (num_tasks - 1, array_max_task_spec)
     print(templ.render(config))
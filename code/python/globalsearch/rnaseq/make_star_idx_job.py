@@ -24,7 +24,7 @@ echo "TASK ID: $SLURM_JOB_ID"
 
 {{sbatch_extras}}
 
-python3 -m globalsearch.rnaseq.index_star {{star_index_cmd_options}} {{genome_fasta_option}} {{genome_dir}}
+python3 -m globalsearch.rnaseq.index_star {{star_index_cmd_options}} {{genome_fasta_option}} {{genome_gff_option}} {{genome_dir}}
 """
 
 DESCRIPTION = """make_star_salmon_job.py - Create STAR Salmon job file for Slurm"""
@@ -64,6 +64,27 @@ if __name__ == '__main__':
     except:
         pass
 
+    # if the optional genome_gff exists, its junctions are inserted into the index,
+    # so the mapping runs can share the genome
+    config['genome_gff_option'] = ''
+    try:
+        genome_gff = config['genome_gff']
+        if os.path.exists(genome_gff):
+            config['genome_gff_option'] = '--genome_gff %s' % genome_gff
+            try:
+                sjdb_overhang = config['star_index_options']['sjdbOverhang']
+            except KeyError:
+                sjdb_overhang = config.get('star_options', {}).get('sjdbOverhang')
+            if sjdb_overhang is not None:
+                config['genome_gff_option'] += ' --sjdbOverhang %s' % str(sjdb_overhang)
+            try:
+                config['genome_gff_option'] += (' --limitSjdbInsertNsj %s' %
+                                                str(config['star_options']['limitSjdbInsertNsj']))
+            except KeyError:
+                pass
+    except KeyError:
+        pass
+
     # see if optional star_index_options exists
     try:
         config['star_index_cmd_options'] = ''
@@ -82,18 +103,16 @@ if __name__ == '__main__':
         except KeyError:
             pass
 
-        try:
-            options.append("--sjdbGTFfeatureExon %s" % star_index_options['sjdbGTFfeatureExon'])
-        except KeyError:
-            pass
-        try:
-            options.append("--sjdbGTFtagExonParentTranscript %s" % star_index_options['sjdbGTFtagExonParentTranscript'])
-        except KeyError:
-            pass
-        try:
-            options.append("--sjdbGTFtagExonParentGene %s" % star_index_options['sjdbGTFtagExonParentGene'])
-        except KeyError:
-            pass
+        # the GTF options default to the mapping options when the annotation goes into the index
+        gtf_options = {}
+        if len(config['genome_gff_option']) > 0:
+            gtf_options.update(config.get('star_options', {}))
+        gtf_options.update(star_index_options)
+        for name in ['sjdbGTFfeatureExon', 'sjdbGTFtagExonParentTranscript', 'sjdbGTFtagExonParentGene']:
+            try:
+                options.append("--%s %s" % (name, gtf_options[name]))
+            except KeyError:
+                pass
 
 
         config['star_index_cmd_options'] = ' '.join(options)
@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 
 import jinja2
+import glob
 import os
 import argparse
 import json
+import sys
 
 from globalsearch.rnaseq.find_files import rnaseq_data_folder_list
+from globalsearch.rnaseq.discovery_cache import open_discovery_cache, discovery_cache_path
+from globalsearch.rnaseq.star_sweep import FilterSetting, permissive_setting
+from globalsearch.rnaseq.cohort_twopass import cohort_index_dir, FIRST_PASS_SUFFIX
 
 TEMPLATE = """#!/bin/bash
 
@@ -18,13 +23,14 @@ TEMPLATE = """#!/bin/bash
 
 echo "ARRAY TASK ID: $SLURM_ARRAY_TASK_ID"
 data_folders=({{data_folders}})
-data_folder=${data_folders[$SLURM_ARRAY_TASK_ID]}
-star_prefix="star_{{star_options.outFilterMismatchNmax}}_{{star_options.outFilterMismatchNoverLmax}}_{{star_options.outFilterScoreMinOverLread}}_{{star_options.outFilterMatchNmin}}{{dedup_prefix}}"
+batch_size={{batch_size}}
+batch_folders=(${data_folders[@]:$((SLURM_ARRAY_TASK_ID * batch_size)):$batch_size})
+star_prefix="star_{{star_options.outFilterMismatchNmax}}_{{star_options.outFilterMismatchNoverLmax}}_{{star_options.outFilterScoreMinOverLread}}_{{star_options.outFilterMatchNmin}}{{dedup_prefix}}{{pass_suffix}}"
 salmon_prefix="salmon_{{star_options.outFilterMismatchNmax}}_{{star_options.outFilterMismatchNoverLmax}}_{{star_options.outFilterScoreMinOverLread}}_{{star_options.outFilterMatchNmin}}{{dedup_prefix}}"
 
 {{sbatch_extras}}
 
-python3 -m globalsearch.rnaseq.run_star_salmon {{star_extra_options}} {{salmon_extra_options}} {{twopass_mode}} {{fastq_patterns}} {{runThreadN}} {{out_sam_attributes}} --outFilterMismatchNmax {{star_options.outFilterMismatchNmax}} --outFilterMismatchNoverLmax {{star_options.outFilterMismatchNoverLmax}} --outFilterScoreMinOverLread {{star_options.outFilterScoreMinOverLread}} --outFilterMatchNmin {{star_options.outFilterMatchNmin}} {{dedup_option}} --starPrefix $star_prefix --salmonPrefix $salmon_prefix {{genome_gff_option}} {{genome_fasta_option}} {{genome_dir}} {{input_dir}} $data_folder {{output_dir}}
+python3 -m globalsearch.rnaseq.run_star_salmon {{star_extra_options}} {{trim_galore_options}} {{discovery_cache_option}} {{genome_state_dir_option}} {{salmon_extra_options}} {{twopass_mode}} {{first_pass_option}} {{batch_overlap_option}} {{filter_sweep_option}} {{fastq_patterns}} {{runThreadN}} {{out_sam_attributes}} --outFilterMismatchNmax {{star_options.outFilterMismatchNmax}} --outFilterMismatchNoverLmax {{star_options.outFilterMismatchNoverLmax}} --outFilterScoreMinOverLread {{star_options.outFilterScoreMinOverLread}} --outFilterMatchNmin {{star_options.outFilterMatchNmin}} {{dedup_option}} --starPrefix $star_prefix --salmonPrefix $salmon_prefix {{genome_gff_option}} {{genome_fasta_option}} {{genome_dir}} {{input_dir}} ${batch_folders[@]} {{output_dir}}
 """
 
 DESCRIPTION = """make_star_salmon_job.py - Create STAR Salmon job file for Slurm"""
@@ -45,6 +51,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
                                      description=DESCRIPTION)
     parser.add_argument('configfile', help="configuration file")
+    parser.add_argument('--cohort_pass', type=int, choices=[1, 2], default=None,
+                        help="job for the first or second pass of a cohort two-pass alignment")
     args = parser.parse_args()
     with open(args.configfile) as infile:
         config = json.load(infile)
@@ -58,8 +66,38 @@ if __name__ == '__main__':
     config['dedup_prefix'] = '_dedup' if config['deduplicate_bam_files'] else ''
     config['dedup_option'] = '--dedup' if config['deduplicate_bam_files'] else ''
     config['dedup_option'] = '--dedup' if config['deduplicate_bam_files'] else ''
+    try:
+        if config['deduplicate_bam_files'] and config['dedup_streaming']:
+            config['dedup_option'] += ' --dedup_streaming'
+    except KeyError:
+        pass
     config['twopass_mode'] = '--twopassMode' if config['star_options']['twopassMode'] else ''
 
+    # cohort two-pass: the first pass collects the junctions of all data folders,
+    # the second pass aligns against the index with the merged junctions
+    config['pass_suffix'] = ''
+    config['first_pass_option'] = ''
+    if args.cohort_pass is not None:
+        config['twopass_mode'] = ''
+    if args.cohort_pass == 1:
+        config['pass_suffix'] = FIRST_PASS_SUFFIX
+        config['first_pass_option'] = '--first_pass'
+    elif args.cohort_pass == 2:
+        genome_fastas = glob.glob('%s/*.fasta' % config['genome_dir'])
+        config['genome_dir'] = cohort_index_dir(config)
+
+    # optional STAR filter sweep: align once with the most permissive setting
+    # and derive the requested settings from it
+    config['filter_sweep_option'] = ''
+    try:
+        settings = [FilterSetting(**setting) for setting in config['star_filter_sweep']]
+        if len(settings) > 0:
+            config['star_options'].update(permissive_setting(settings)._asdict())
+            config['filter_sweep_option'] = '--filter_sweep %s' % ' '.join(
+                ','.join(str(value) for value in setting) for setting in settings)
+    except KeyError:
+        pass
+
     # override runThreadN
     try:
         config["runThreadN"] = "--runThreadN %d" % config['star_options']['runThreadN']
@@ -73,8 +111,26 @@ if __name__ == '__main__':
     except:
         config['out_sam_attributes'] = ''
 
+    # optional directory for the shared genome lock, it has to be shared by the tasks of a node
+    try:
+        config['genome_state_dir_option'] = '--genome_state_dir %s' % config['genome_state_dir']
+    except KeyError:
+        config['genome_state_dir_option'] = ''
+
     config['fastq_patterns'] = '--fastq_patterns "%s"' % ','.join(config['fastq_patterns']) if len(config['fastq_patterns']) > 0 else ''
 
+    # optional core/memory budget for the concurrent trim_galore runs
+    trim_galore_options = []
+    try:
+        trim_galore_options += ["--trim_cores", str(config['trim_galore_options']['cores'])]
+    except KeyError:
+        pass
+    try:
+        trim_galore_options += ["--trim_memory", str(config['trim_galore_options']['memory'])]
+    except KeyError:
+        pass
+    config['trim_galore_options'] = ' '.join(trim_galore_options)
+
     # see if optional genome_gff exists
     try:
         config['genome_gff_option'] = ''
@@ -136,8 +192,30 @@ if __name__ == '__main__':
             config['genome_fasta_option'] = '--genome_fasta %s' % genome_fasta
     except:
         pass
+    if args.cohort_pass == 2 and config['genome_fasta_option'] == '' and len(genome_fastas) > 0:
+        # the junction index directory does not contain the FASTA file for Salmon
+        config['genome_fasta_option'] = '--genome_fasta %s' % genome_fastas[0]
 
-    data_folders = rnaseq_data_folder_list(config)
+    # optional persistent cache for the input directory scans
+    try:
+        use_discovery_cache = config['discovery_cache']
+    except KeyError:
+        use_discovery_cache = False
+    if use_discovery_cache:
+        cache_path = discovery_cache_path(config)
+        config['discovery_cache_option'] = '--discovery_cache %s' % cache_path
+    else:
+        cache_path = None
+        config['discovery_cache_option'] = ''
+
+    scan_stats = {}
+    with open_discovery_cache(cache_path) as cache:
+        data_folders = rnaseq_data_folder_list(config, cache=cache, stats=scan_stats)
+    if len(scan_stats) > 0:
+        # the job file goes to stdout, so report the scan throughput on stderr
+        print("scanned %d entries in %.3f s (%.1f entries/s)" % (scan_stats['entries'], scan_stats['seconds'],
+                                                               scan_stats['entries_per_second']),
+              file=sys.stderr)
     config["data_folders"] = ' '.join(data_folders)
 
     # Array specification
@@ -150,5 +228,15 @@ if __name__ == '__main__':
     else:
         array_max_task_spec = ""
 
-    config["array_range"] = "0-%d%s" % (len(data_folders) - 1, array_max_task_spec)
+    # batch mode: every array task processes batch_size data folders
+    # against the same loaded genome
+    batch_size = max(1, config.get('batch_size', 1))
+    config['batch_size'] = batch_size
+    num_tasks = (len(data_folders) + batch_size - 1) // batch_size
+    try:
+        config['batch_overlap_option'] = '--batch_overlap %d' % config['batch_overlap']
+    except KeyError:
+        config['batch_overlap_option'] = ''
+
+    config["array_range"] = "0-%d%s" % (num_tasks - 1, array_max_task_spec)
     print(templ.render(config))
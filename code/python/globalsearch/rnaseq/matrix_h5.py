@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+"""
+matrix_h5.py - gene x sample matrices in a chunked HDF5 file
+
+Loading the CSV matrices of thousands of samples parses every value as
+text. The HDF5 file stores the matrices as binary values in chunks of
+CHUNK_ROWS genes x CHUNK_COLS samples, so a subset of genes or samples
+only reads the chunks it touches. Layout:
+
+  /gene_ids               gene ids (rows)
+  /samples                sample names (columns)
+  /<matrix>               float64 genes x samples, e.g. /TPM, /NumReads
+  /organisms/<organism>   row indexes of the genes of an organism
+  /sample_info/<name>     optional per sample values, e.g. the source files
+
+Missing values are NaN. The file can be read with any HDF5 library, e.g.
+h5py, rhdf5 or pandas, or with read_matrix() below:
+
+  gene_ids, samples, tpm = read_matrix('matrices.h5', 'TPM', samples=['R1', 'R7'])
+"""
+import argparse
+import os
+
+import h5py
+import numpy as np
+
+from .checkpoint import tmp_path, commit_path
+
+DESCRIPTION = """matrix_h5.py - print a subset of a matrix in an HDF5 matrix file as CSV"""
+
+CHUNK_ROWS = 1024
+CHUNK_COLS = 128
+GENE_IDS = 'gene_ids'
+SAMPLES = 'samples'
+ORGANISMS = 'organisms'
+SAMPLE_INFO = 'sample_info'
+
+
+class MatrixWriter:
+    """Writes the matrices of a matrix file in blocks of columns, for results
+    that are too large to be held in memory at once. Columns that are not
+    written are NaN. The file is written under a temporary name and renamed
+    into place when the writer is closed without an error.
+
+    :param names: the names of the matrices
+    :param organism_rows: dictionary of organism -> row indexes of its genes
+    :param sample_info: dictionary of name -> list of a string or number per sample
+    :param chunk_cols: samples per chunk, blocks of that many columns are written most efficiently
+    """
+    def __init__(self, path, gene_ids, samples, names, organism_rows=None, sample_info=None,
+                 chunk_cols=CHUNK_COLS):
+        self.path = path
+        self.shape = (len(gene_ids), len(samples))
+        self.outfile = h5py.File(tmp_path(path), 'w')
+        try:
+            self.outfile.create_dataset(GENE_IDS, data=list(gene_ids), dtype=h5py.string_dtype())
+            self.outfile.create_dataset(SAMPLES, data=list(samples), dtype=h5py.string_dtype())
+            chunks = (max(1, min(self.shape[0], CHUNK_ROWS)), max(1, min(self.shape[1], chunk_cols)))
+            for name in names:
+                if 0 in self.shape:
+                    self.outfile.create_dataset(name, shape=self.shape, dtype=np.float64)
+                else:
+                    self.outfile.create_dataset(name, shape=self.shape, dtype=np.float64, chunks=chunks,
+                                                fillvalue=np.nan, compression='gzip', compression_opts=4,
+                                                shuffle=True)
+            group = self.outfile.create_group(ORGANISMS)
+            for organism, rows in (organism_rows or {}).items():
+                group.create_dataset(organism, data=np.asarray(rows, dtype=np.int64))
+            group = self.outfile.create_group(SAMPLE_INFO)
+            for name, values in (sample_info or {}).items():
+                if len(values) != len(samples):
+                    raise ValueError("sample info '%s' has %d values for %d samples" % (name, len(values),
+                                                                                       len(samples)))
+                if len(values) > 0 and isinstance(values[0], str):
+                    group.create_dataset(name, data=list(values), dtype=h5py.string_dtype())
+                else:
+                    group.create_dataset(name, data=np.asarray(values, dtype=np.int64 if len(values) == 0 else None))
+        except Exception:
+            self.abort()
+            raise
+
+    def write_columns(self, name, start, block):
+        """write block, a genes x n array, to the columns start to start + n of matrix name"""
+        if block.shape[0] != self.shape[0] or start + block.shape[1] > self.shape[1]:
+            raise ValueError("a %dx%d block at column %d doesn't fit matrix '%s' (%dx%d)" %
+                             (block.shape[0], block.shape[1], start, name, self.shape[0], self.shape[1]))
+        if block.size > 0:
+            self.outfile[name][:, start:start + block.shape[1]] = block
+
+    def abort(self):
+        self.outfile.close()
+        os.remove(tmp_path(self.path))
+
+    def close(self):
+        self.outfile.close()
+        commit_path(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_matrices(path, gene_ids, samples, matrices, organism_rows=None, sample_info=None):
+    """Write matrices, a dictionary of name -> (genes x samples) array, with
+    their gene and sample indexes, see MatrixWriter"""
+    shape = (len(gene_ids), len(samples))
+    for name, matrix in matrices.items():
+        if matrix.shape != shape:
+            raise ValueError("matrix '%s' is %dx%d, expected %dx%d" % (name, matrix.shape[0],
+                                                                       matrix.shape[1], shape[0], shape[1]))
+    with MatrixWriter(path, gene_ids, samples, list(matrices.keys()), organism_rows, sample_info) as writer:
+        for name, matrix in matrices.items():
+            writer.write_columns(name, 0, matrix)
+
+
+def _indexes(names, selected, kind):
+    """positions of the selected names, KeyError for unknown names"""
+    positions = {name: index for index, name in enumerate(names)}
+    try:
+        return np.array([positions[name] for name in selected], dtype=np.int64)
+    except KeyError as e:
+        raise KeyError("unknown %s %s" % (kind, e))
+
+
+def _read_selection(dataset, rows, cols):
+    """read the given rows and columns (None for all) of a 2D dataset, only
+    the chunks that contain the selection are read"""
+    if (rows is not None and len(rows) == 0) or (cols is not None and len(cols) == 0):
+        return np.empty((dataset.shape[0] if rows is None else len(rows),
+                         dataset.shape[1] if cols is None else len(cols)), dtype=dataset.dtype)
+    # h5py selections have to be increasing and can only use one index list
+    row_sel, row_order = (slice(None), None) if rows is None else np.unique(rows, return_inverse=True)
+    if cols is None:
+        result = dataset[row_sel, :]
+    else:
+        unique_cols, col_order = np.unique(cols, return_inverse=True)
+        num_rows = dataset.shape[0] if rows is None else len(row_sel)
+        result = np.empty((num_rows, len(unique_cols)), dtype=dataset.dtype)
+        step = dataset.chunks[1] if dataset.chunks else dataset.shape[1]
+        start = 0
+        while start < len(unique_cols):
+            block_start = unique_cols[start] - unique_cols[start] % step
+            end = np.searchsorted(unique_cols, block_start + step)
+            block = dataset[row_sel, block_start:block_start + step]
+            result[:, start:end] = block[:, unique_cols[start:end] - block_start]
+            start = end
+        result = result[:, col_order]
+    return result if row_order is None else result[row_order]
+
+
+def read_index(path):
+    """the gene ids and the sample names of a matrix file"""
+    with h5py.File(path, 'r') as infile:
+        return list(infile[GENE_IDS].asstr()[:]), list(infile[SAMPLES].asstr()[:])
+
+
+def read_sample_info(path):
+    """the per sample values of a matrix file as a dictionary of name -> list"""
+    result = {}
+    with h5py.File(path, 'r') as infile:
+        for name, dataset in infile.get(SAMPLE_INFO, {}).items():
+            values = dataset.asstr()[:] if h5py.check_string_dtype(dataset.dtype) else dataset[:]
+            result[name] = list(values)
+    return result
+
+
+def read_matrix(path, name, genes=None, samples=None, organism=None):
+    """Read the matrix name from the file at path, optionally restricted to a
+    list of gene ids, a list of sample names or the genes of an organism.
+    Returns (gene ids, sample names, matrix) in the requested order."""
+    with h5py.File(path, 'r') as infile:
+        gene_ids = infile[GENE_IDS].asstr()[:]
+        sample_names = infile[SAMPLES].asstr()[:]
+        rows = None
+        if organism is not None:
+            rows = infile[ORGANISMS][organism][:]
+        if genes is not None:
+            gene_rows = _indexes(gene_ids, genes, 'gene')
+            rows = gene_rows if rows is None else gene_rows[np.isin(gene_rows, rows)]
+        cols = None if samples is None else _indexes(sample_names, samples, 'sample')
+        matrix = _read_selection(infile[name], rows, cols)
+    gene_ids = list(gene_ids) if rows is None else [gene_ids[row] for row in rows]
+    sample_names = list(sample_names) if cols is None else [sample_names[col] for col in cols]
+    return gene_ids, sample_names, matrix
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=DESCRIPTION)
+    parser.add_argument('h5file', help='HDF5 matrix file')
+    parser.add_argument('matrix', help='matrix name, e.g. TPM or NumReads')
+    parser.add_argument('--genes', nargs='+', default=None, help='gene ids')
+    parser.add_argument('--samples', nargs='+', default=None, help='sample names')
+    parser.add_argument('--organism', default=None, help='only the genes of this organism')
+    args = parser.parse_args()
+    gene_ids, sample_names, matrix = read_matrix(args.h5file, args.matrix, args.genes, args.samples,
+                                                 args.organism)
+    print(','.join(['gene_id'] + sample_names))
+    for gene_id, values in zip(gene_ids, matrix):
+        print(','.join([gene_id] + ['NA' if np.isnan(value) else '%.15g' % value for value in values]))
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+"""
+organism_index.py - map the transcripts of a merged genome FASTA to their organisms
+
+The FASTA files of holobiont datasets merge the transcripts of several
+organisms and tag every sequence name with its organism, e.g.
+Past_Smic_merged_CDS_suffixed.fasta. The post run step used to find the
+rows of an organism with a substring search of the organism name over all
+gene ids, once per organism, which also matches ids that only contain the
+name by chance.
+
+The organism of a sequence name is determined from its tokens (the parts
+between '_', '|', '.', '-' and ':'): the last token if it is an organism
+name, otherwise the first one, otherwise the only token that is an
+organism name. Names without such a token fall back to the substring
+search, but only if exactly one organism matches. The assignment of all
+sequences is stored next to the FASTA file as <fasta>.organisms and reused
+as long as it is newer than the FASTA file and was built for the same
+organisms, so splitting a matrix is a lookup per row and a single sort.
+
+Unlike the substring search, unassigned names (no organism or more than
+one) are not written to any organism's rows, they are reported instead.
+"""
+import argparse
+import os
+import re
+
+import numpy as np
+
+from .fasta_index import FastaIndex
+
+DESCRIPTION = """organism_index.py - build the organism index of a merged genome FASTA file"""
+
+ORGANISMS_SUFFIX = '.organisms'
+UNASSIGNED = -1
+TOKEN_SEPARATORS = re.compile(r'[_|.\-:]')
+
+
+def organisms_path(fasta_path):
+    return fasta_path + ORGANISMS_SUFFIX
+
+
+def organism_of(name, organisms):
+    """position of the organism of the sequence name in organisms, UNASSIGNED
+    if it can't be determined unambiguously"""
+    tokens = TOKEN_SEPARATORS.split(name)
+    positions = {organism: index for index, organism in enumerate(organisms)}
+    for token in (tokens[-1], tokens[0]):
+        if token in positions:
+            return positions[token]
+    matches = {positions[token] for token in tokens if token in positions}
+    if len(matches) == 0:
+        matches = {index for index, organism in enumerate(organisms) if organism in name}
+    return matches.pop() if len(matches) == 1 else UNASSIGNED
+
+
+def _read_organisms(path, organisms):
+    """the cached assignments as a dictionary, None if they were built for other organisms"""
+    with open(path) as infile:
+        header = infile.readline().rstrip('\n').split('\t')
+        if header[0] != '#organisms' or header[1:] != list(organisms):
+            return None
+        result = {}
+        for line in infile:
+            name, index = line.rstrip('\n').split('\t')
+            result[name] = int(index)
+        return result
+
+
+def _write_organisms(path, organisms, assignments):
+    """write the assignments atomically"""
+    tmp_path = '%s.%d' % (path, os.getpid())
+    with open(tmp_path, 'w') as outfile:
+        outfile.write('\t'.join(['#organisms'] + list(organisms)) + '\n')
+        for name, index in assignments.items():
+            outfile.write('%s\t%d\n' % (name, index))
+    os.replace(tmp_path, path)
+
+
+def _is_current(fasta_path):
+    path = organisms_path(fasta_path)
+    return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(fasta_path)
+
+
+class OrganismIndex:
+    """The organism of every sequence of a FASTA file, or of the given names
+    if there is no FASTA file.
+
+    :param organisms: the organism names, in the order of the output
+    :param fasta_path: the merged genome FASTA file
+    :param write: store newly built assignments next to the FASTA file
+    """
+    def __init__(self, organisms, fasta_path=None, write=True):
+        self.organisms = list(organisms)
+        self.assignments = None
+        if fasta_path is not None and _is_current(fasta_path):
+            self.assignments = _read_organisms(organisms_path(fasta_path), self.organisms)
+        if self.assignments is None:
+            names = [] if fasta_path is None else FastaIndex(fasta_path, write).names
+            self.assignments = {name: organism_of(name, self.organisms) for name in names}
+            if fasta_path is not None and write:
+                try:
+                    _write_organisms(organisms_path(fasta_path), self.organisms, self.assignments)
+                except OSError as e:
+                    print("can't write the organism index of '%s': %s" % (fasta_path, str(e)), flush=True)
+
+    def route(self, gene_ids):
+        """the organism position of every gene id, UNASSIGNED for unknown organisms"""
+        result = np.empty(len(gene_ids), dtype=np.int64)
+        for row, gene_id in enumerate(gene_ids):
+            index = self.assignments.get(gene_id)
+            result[row] = organism_of(gene_id, self.organisms) if index is None else index
+        return result
+
+    def rows(self, gene_ids, codes=None):
+        """dictionary of organism -> increasing row indexes of its gene ids,
+        codes are the result of route(gene_ids) if already known"""
+        if codes is None:
+            codes = self.route(gene_ids)
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], np.arange(len(self.organisms) + 1))
+        return {organism: order[bounds[index]:bounds[index + 1]]
+                for index, organism in enumerate(self.organisms)}
+
+
+def report_unassigned(gene_ids, codes, organisms, num_examples=5):
+    """print the number of gene ids that are not in the rows of any organism, with examples"""
+    unassigned = np.flatnonzero(codes == UNASSIGNED)
+    if len(unassigned) > 0:
+        examples = ', '.join(gene_ids[row] for row in unassigned[:num_examples])
+        print("%d gene id(s) match none or more than one of the organisms %s and are only in the merged output, "
+              "e.g. %s" % (len(unassigned), ', '.join(organisms), examples), flush=True)
+    return len(unassigned)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=DESCRIPTION)
+    parser.add_argument('fasta', help='merged genome FASTA file')
+    parser.add_argument('organisms', nargs='+', help='organism names that occur in the sequence names')
+    args = parser.parse_args()
+    index = OrganismIndex(args.organisms, args.fasta)
+    names = list(index.assignments.keys())
+    for organism, rows in index.rows(names).items():
+        print("%s: %d sequences" % (organism, len(rows)))
+    print("unassigned: %d sequences" % np.count_nonzero(index.route(names) == UNASSIGNED))
@@ -10,11 +10,13 @@ This includes
 """
 import argparse
 import json
-from rpy2.robjects.packages import importr
-from rpy2.robjects.vectors import StrVector
 import subprocess
 import os
 
+from .fasta_index import find_genome_fasta
+from .resources import available_resources
+from .salmon_quants import extract_salmon_quants
+
 DESCRIPTION = """post_star_salmon.py - Post-run step for STAR Salmon"""
 
 if __name__ == '__main__':
@@ -37,8 +39,16 @@ if __name__ == '__main__':
     organisms = config['organisms']
     #org1, org2 = os.path.basename(genome_dir).split('_')
     print('\033[33mExtracting salmon quant files...\033[0m')
-    global_search = importr("GlobalSearch")
-    global_search.extract_salmon_quants(StrVector(organisms), output_dir, postrun_outdir)
+    formats = config.get('postrun_formats', ['csv'])
+    # the sequence names of the FASTA file salmon quantified against
+    try:
+        genome_fasta = find_genome_fasta(genome_dir, config.get('salmon_options', {}).get('genome_fasta') or
+                                         config.get('genome_fasta'))
+    except FileNotFoundError:
+        genome_fasta = None
+    extract_salmon_quants(organisms, output_dir, postrun_outdir, workers=available_resources().cpus,
+                          formats=formats, incremental=config.get('postrun_incremental', False),
+                          genome_fasta=genome_fasta)
     # now run MultiQC
     print('\033[33mRunning MultiQC...\033[0m')
     multiqc_outdir = os.path.join(postrun_outdir, 'MultiQC')
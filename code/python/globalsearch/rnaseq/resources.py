@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+"""
+resources.py - thread and memory planning for the pipeline tools
+
+The CPUs and memory a task may use are taken from the Slurm allocation
+(SLURM_CPUS_PER_TASK, SLURM_MEM_PER_NODE or SLURM_MEM_PER_CPU) or, outside
+of Slurm, from the local machine. The planner splits them into a thread
+and memory budget for every subprocess stage, so the tools neither
+oversubscribe the allocation nor leave cores idle. The stages run one after
+the other, so every stage can use the whole allocation.
+"""
+from collections import namedtuple
+import os
+import sys
+
+from .trim_galore import trim_pool_size, TRIMGALORE_CORES_PER_JOB, TRIMGALORE_MEMORY_PER_JOB
+
+GB = 1024 ** 3
+MB = 1024 ** 2
+
+# The STAR default for the BAM sorting memory, used if the memory is unknown
+DEFAULT_LIMIT_BAM_SORT_RAM = 5784458574
+
+# Share of the memory STAR may use for BAM sorting, the rest is
+# reserved for the genome and the alignment buffers
+STAR_SORT_MEMORY_FRACTION = 0.25
+
+# Share of the memory samtools sort may use in deduplication
+SAMTOOLS_SORT_MEMORY_FRACTION = 0.5
+SAMTOOLS_SORT_MIN_MEMORY_PER_THREAD = 64 * MB
+
+# streaming deduplication runs STAR, samtools view and samtools sort at the
+# same time, they share the CPUs of the stage
+DEDUP_STREAMING_PROCESSES = 3
+
+# spladder runs one process per BAM file in the single sample steps and
+# one process per contrast in the tests, each with a few threads
+SPLADDER_THREADS_PER_SAMPLE = 2
+SPLADDER_THREADS_PER_TEST = 5
+
+# kallisto quant gains little from more threads than this per sample, so
+# samples are quantified side by side instead
+KALLISTO_THREADS_PER_SAMPLE = 4
+
+Resources = namedtuple('Resources', ['cpus', 'memory', 'source'])
+StagePlan = namedtuple('StagePlan', ['threads', 'workers', 'memory'])
+
+# options that only control the resources of a tool and don't change its results
+STAR_RESOURCE_OPTIONS = ['--runThreadN', '--limitBAMsortRAM']
+SALMON_RESOURCE_OPTIONS = ['-p']
+
+
+def _int_prefix(value):
+    """the leading number of a Slurm value like "32" or "2(x3)", None if there is none"""
+    digits = ''
+    for c in value.strip():
+        if not c.isdigit():
+            break
+        digits += c
+    return int(digits) if len(digits) > 0 else None
+
+
+def local_cpus():
+    """the CPUs this process may run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def local_memory():
+    """the physical memory of the machine in bytes, None if it can't be determined"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def available_resources(environ=None):
+    """Determine the CPUs and memory (in bytes) of the task from the Slurm
+    environment variables, falling back to the local machine for the values
+    that Slurm does not provide"""
+    if environ is None:
+        environ = os.environ
+    cpus = memory = None
+    for name in ['SLURM_CPUS_PER_TASK', 'SLURM_JOB_CPUS_PER_NODE']:
+        if name in environ:
+            cpus = _int_prefix(environ[name])
+            if cpus is not None:
+                break
+    # --mem=0 requests all the memory of the node, the node's memory is used then
+    if 'SLURM_MEM_PER_NODE' in environ:
+        memory = _int_prefix(environ['SLURM_MEM_PER_NODE'])
+        memory = memory * MB if memory else None
+    elif 'SLURM_MEM_PER_CPU' in environ and cpus is not None:
+        memory = _int_prefix(environ['SLURM_MEM_PER_CPU'])
+        memory = memory * cpus * MB if memory else None
+
+    source = 'slurm' if cpus is not None or memory is not None else 'local'
+    if cpus is None:
+        cpus = local_cpus()
+    if memory is None:
+        memory = local_memory()
+    return Resources(cpus, memory, source)
+
+
+def share_resources(resources, num_shares):
+    """the resources of one of num_shares tasks that run side by side"""
+    if num_shares <= 1:
+        return resources
+    memory = resources.memory // num_shares if resources.memory is not None else None
+    return Resources(max(1, resources.cpus // num_shares), memory, resources.source)
+
+
+def split_stage(stage_plan, num_jobs, threads_per_job):
+    """Split the threads of a stage between up to num_jobs jobs that run side
+    by side with at least threads_per_job threads each, returns the StagePlan
+    of the pool: the threads of a job and the number of workers"""
+    workers = max(1, min(num_jobs, stage_plan.threads // threads_per_job))
+    return StagePlan(max(1, stage_plan.threads // workers), workers, stage_plan.memory)
+
+
+def plan_resources(resources, star_threads=None, limit_bam_sort_ram=None,
+                   trim_cores=None, trim_memory=None):
+    """Split the resources into a StagePlan for each stage. The optional
+    arguments are explicit settings that take precedence over the plan.
+    Memory is in bytes, except trim_memory, which is in GB like the
+    trim_galore_pool() budget"""
+    cpus, memory = resources.cpus, resources.memory
+    plan = {}
+
+    if trim_cores is None:
+        trim_cores = cpus
+    trim_memory = trim_memory * GB if trim_memory is not None else memory
+    trim_workers = trim_pool_size(trim_cores, trim_cores,
+                                  trim_memory / GB if trim_memory is not None else None)
+    plan['trim_galore'] = StagePlan(TRIMGALORE_CORES_PER_JOB, trim_workers,
+                                    trim_workers * TRIMGALORE_MEMORY_PER_JOB * GB)
+
+    if limit_bam_sort_ram is None:
+        if memory is not None:
+            limit_bam_sort_ram = int(memory * STAR_SORT_MEMORY_FRACTION)
+        else:
+            limit_bam_sort_ram = DEFAULT_LIMIT_BAM_SORT_RAM
+    plan['star'] = StagePlan(star_threads if star_threads is not None else cpus, 1, limit_bam_sort_ram)
+
+    sort_memory = int(memory * SAMTOOLS_SORT_MEMORY_FRACTION) if memory is not None else None
+    plan['dedup'] = StagePlan(cpus, 1, sort_memory)
+    plan['dedup_streaming'] = StagePlan(max(1, cpus // DEDUP_STREAMING_PROCESSES), DEDUP_STREAMING_PROCESSES,
+                                        sort_memory)
+    plan['salmon'] = StagePlan(cpus, 1, None)
+    plan['kallisto'] = StagePlan(cpus, 1, None)
+
+    plan['spladder_sample'] = StagePlan(SPLADDER_THREADS_PER_SAMPLE,
+                                        max(1, cpus // SPLADDER_THREADS_PER_SAMPLE), None)
+    plan['spladder_merged'] = StagePlan(cpus, 1, None)
+    plan['spladder_test'] = StagePlan(SPLADDER_THREADS_PER_TEST,
+                                      max(1, cpus // SPLADDER_THREADS_PER_TEST), None)
+    return plan
+
+
+def sort_memory_per_thread(stage_plan):
+    """the samtools sort -m value for a stage, None if the memory is unknown"""
+    if stage_plan.memory is None:
+        return None
+    per_thread = max(SAMTOOLS_SORT_MIN_MEMORY_PER_THREAD, stage_plan.memory // stage_plan.threads)
+    return '%dM' % (per_thread // MB)
+
+
+def without_resource_options(command, options):
+    """the command without the given thread and memory options and their values,
+    used to compare commands independently of the allocation they run in"""
+    result = []
+    skip = False
+    for arg in command:
+        if skip:
+            skip = False
+        elif arg in options:
+            skip = True
+        else:
+            result.append(arg)
+    return result
+
+
+def _format_memory(memory):
+    return '%.1f GB' % (memory / GB) if memory is not None else 'unbounded'
+
+
+def log_plan(resources, plan, stages=None, outfile=sys.stdout):
+    """Print the resources and the budget of every stage, pointing out
+    stages that oversubscribe the CPUs or leave some of them idle"""
+    print("Resources (%s): %d CPUs, %s" % (resources.source, resources.cpus,
+                                           _format_memory(resources.memory)),
+          file=outfile, flush=True)
+    for stage in (stages if stages is not None else plan.keys()):
+        stage_plan = plan[stage]
+        used = stage_plan.threads * stage_plan.workers
+        if used > resources.cpus:
+            note = ' (oversubscribed by %d CPUs)' % (used - resources.cpus)
+        elif used < resources.cpus:
+            note = ' (%d CPUs idle)' % (resources.cpus - used)
+        else:
+            note = ''
+        print("  %s: %d worker(s) x %d thread(s), memory %s%s" % (stage, stage_plan.workers,
+                                                                stage_plan.threads,
+                                                                _format_memory(stage_plan.memory), note),
+              file=outfile, flush=True)
@@ -3,9 +3,16 @@
 """
 RNASeq Analysis pipeline using Kallisto
 """
-import glob, sys, os, re, subprocess
+import glob, sys, os, re, signal, subprocess, shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from .find_files import find_fastq_files
-from .trim_galore import trim_galore, collect_trimmed_data, create_result_dirs
+from .discovery_cache import open_discovery_cache
+from .trim_galore import TrimProcesses, trim_galore_pool, create_result_dirs, trimmed_files, file_base
+from .resources import GB, KALLISTO_THREADS_PER_SAMPLE, available_resources, plan_resources, split_stage, log_plan
+from .checkpoint import tool_version, tmp_path, commit_path
+from .index_cache import cached_index, index_key
+from .fasta_index import check_unique_names
+from .kallisto_batch import run_kallisto_batch
 import argparse
 
 # data and results directories
@@ -17,7 +24,9 @@ import argparse
 
 ############# Functions ##############
 ####################### Run Kalisto ###############################
-def run_kallisto(index_path, results_dir, pair_files):
+def run_kallisto(index_path, results_dir, pair_files, threads=4, processes=None):
+    """If processes is a TrimProcesses, the run is registered there and can
+    be stopped, a failed or stopped run raises a CalledProcessError"""
     print('\033[33mRunning kallisto! \033[0m')
     # flatten the pair_files list into an input file list
     input_files = []
@@ -28,38 +37,109 @@ def run_kallisto(index_path, results_dir, pair_files):
               'quant', '-i', index_path]
     command.extend(input_files)
     command.extend(['-o', results_dir,
-                    '-b', '100', '--bias', '-t', '4', '--rf-stranded'])
+                    '-b', '100', '--bias', '-t', str(threads), '--rf-stranded'])
     kallisto_cmd = ' '.join(command)
     print('Kallisto run command: "%s"' % kallisto_cmd)
-    compl_proc = subprocess.run(command, check=True, capture_output=False)
+    if processes is None:
+        compl_proc = subprocess.run(command, check=True, capture_output=False)
+        return
+    proc = processes.start(command, shell=False)
+    if proc is None:
+        raise subprocess.CalledProcessError(-signal.SIGTERM, kallisto_cmd)
+    try:
+        returncode = proc.wait()
+    finally:
+        processes.finished(proc)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, kallisto_cmd)
+
+
+def run_kallisto_sample(index_path, sample_dir, input_files, threads=4, processes=None):
+    """Quantify a single sample into sample_dir. The output is written to a
+    temporary directory first, an existing sample_dir is a finished result
+    and is not computed again. A failed run is not committed"""
+    if os.path.exists(sample_dir):
+        print("Kallisto result '%s' found, skipping" % sample_dir, flush=True)
+        return sample_dir
+    build_dir = tmp_path(sample_dir)
+    if os.path.exists(build_dir):
+        shutil.rmtree(build_dir)  # left behind by an interrupted run
+    run_kallisto(index_path, build_dir, [input_files], threads=threads, processes=processes)
+    commit_path(sample_dir)
+    return sample_dir
+
+
+def kallisto_pool(index_path, results_dir, samples, stage_plan):
+    """Quantify the samples, a list of (sample name, input files) tuples, into
+    results_dir/<sample name> concurrently, the threads of the stage plan
+    are split between the samples that run side by side.
+
+    Returns the sample directories in the order of samples. As soon as one
+    kallisto run fails, the pending runs are cancelled, the running ones
+    terminated without committing their results and the error is raised
+    after all of them have exited.
+    """
+    pool_plan = split_stage(stage_plan, len(samples), KALLISTO_THREADS_PER_SAMPLE)
+    print("Quantifying %d sample(s), %d at a time with %d thread(s) each" %
+          (len(samples), pool_plan.workers, pool_plan.threads), flush=True)
+    sample_dirs = [os.path.join(results_dir, name) for name, input_files in samples]
+    processes = TrimProcesses()
+    executor = ThreadPoolExecutor(max_workers=pool_plan.workers)
+    try:
+        futures = [executor.submit(run_kallisto_sample, index_path, sample_dir, input_files, pool_plan.threads,
+                                   processes)
+                   for sample_dir, (name, input_files) in zip(sample_dirs, samples)]
+        for future in as_completed(futures):
+            future.result()
+    except BaseException:
+        processes.stop()
+        raise
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    return sample_dirs
 
  ####################### Create Kallisto index ###############################
 def kallisto_index(index_path, transcriptome_path):
+    """Create the index for the transcriptome. The index is cached next to
+    index_path under a key for the transcriptome content and the kallisto
+    version, index_path links to it. Only one of the tasks that need the
+    same index builds it, the others wait for it"""
     print('\033[33mRunning kallisto index! \033[0m')
-    if os.path.exists(index_path):
-        print("index path '%s' exists, skipping the indexing" % index_path)
-        return
+    cache_root, name = os.path.split(os.path.abspath(index_path))
+    key = index_key([transcriptome_path], {}, tool_version('kallisto', 'version'), cache_root)
 
-    command = ['kallisto',
-               'index',
-               '-i', index_path,
-               transcriptome_path]
-    kallistoindex_cmd = ' '.join(command)
-    print('kallisto index command: %s' % kallistoindex_cmd)
-    compl_proc = subprocess.run(command, check=True, capture_output=False)
+    def build(build_path):
+        check_unique_names(transcriptome_path)
+        command = ['kallisto',
+                   'index',
+                   '-i', build_path,
+                   transcriptome_path]
+        kallistoindex_cmd = ' '.join(command)
+        print('kallisto index command: %s' % kallistoindex_cmd)
+        compl_proc = subprocess.run(command, check=True, capture_output=False)
+    cached_index(cache_root, name, key, build)
+    return index_path
 
 ####################### Running the Pipeline ###############################
-def run_pipeline(data_folder, results_folder, genome_dir, transcriptome_file, args):
-    folder_count = 1
+def plan_pipeline_resources(args):
+    resources = available_resources()
+    plan = plan_resources(resources, trim_cores=args.trim_cores, trim_memory=args.trim_memory)
+    log_plan(resources, plan, stages=['trim_galore', 'kallisto'])
+    return plan
+
 
-    # Loop through each data folder
+def prepare_folder(data_folder, results_folder, genome_dir, args, plan):
+    """Trim the file sets of a data folder. Returns the trimmed, FastQC and
+    results directories and the samples to quantify, a list of
+    (sample name, trimmed files) tuples"""
     folder_name = data_folder.split('/')[-1]
     print('\033[33mProcessing Folder: %s\033[0m' %(folder_name))
 
     # Get the list of first file names in paired end sequences
     #first_pair_files = glob.glob('%s/*_1.fq*' %(data_folder))
     #print(first_pair_files)
-    pair_files = find_fastq_files(data_folder, args.fastq_patterns.split(','))
+    with open_discovery_cache(args.discovery_cache) as cache:
+        pair_files = find_fastq_files(data_folder, args.fastq_patterns.split(','), cache=cache)
 
     # Program specific results directories
     organism = os.path.basename(genome_dir)
@@ -72,9 +152,6 @@ def run_pipeline(data_folder, results_folder, genome_dir, transcriptome_file, ar
     create_result_dirs(data_trimmed_dir,fastqc_dir,results_dir, htseq_dir)
     print("PAIR_FILES: ", pair_files, flush=True)
 
-    index_path = os.path.join(results_folder, "%s_kallistoindex" % organism)
-    kallisto_index(index_path, transcriptome_file)
-
     # Loop through each file and create filenames
     file_count = 1
     is_gzip = True
@@ -113,22 +190,65 @@ def run_pipeline(data_folder, results_folder, genome_dir, transcriptome_file, ar
         #print("sample_id: %s" %(sample_id))
         sample_id = fastq_fname.replace(file_ext, "")
         print("sample_id: %s" % sample_id, flush=True)
-
-        # 01. Run TrimGalore
-        # WW: Activate/deactivate for debugging
-        trim_galore(first_pair_file, second_pair_file, folder_name, sample_id,
-                    data_trimmed_dir, fastqc_dir)
         file_count += 1
 
-        # Run folder level salmon analysis
-        first_pair_group, second_pair_group = collect_trimmed_data(data_trimmed_dir, is_gzip, is_paired_end)
-        run_kallisto(index_path, results_dir, [first_pair_group.split(' '), second_pair_group.split(' ')])
+    # 01. Run TrimGalore on all file sets of the folder concurrently
+    trim_plan = plan['trim_galore']
+    trim_galore_pool(pair_files, folder_name, data_trimmed_dir, fastqc_dir,
+                     cores=trim_plan.threads * trim_plan.workers, memory=trim_plan.memory / GB)
+
+    samples = [(file_base(first_pair_file), trimmed_files(first_pair_file, second_pair_file, data_trimmed_dir))
+               for first_pair_file, second_pair_file in pair_files]
+    return data_trimmed_dir, fastqc_dir, results_dir, samples
 
-        folder_count += 1
+
+def folder_index_path(results_folder, genome_dir):
+    organism = os.path.basename(genome_dir)
+    return os.path.join(results_folder, "%s_kallistoindex" % organism)
+
+
+def run_merged(index_path, results_dir, samples, plan):
+    """quantify all file sets of the folder together, kallisto expects the
+    files of a pair next to each other"""
+    run_kallisto(index_path, results_dir, [input_files for name, input_files in samples],
+                 threads=plan['kallisto'].threads)
+
+
+def run_pipeline(data_folder, results_folder, genome_dir, transcriptome_file, args):
+    plan = plan_pipeline_resources(args)
+    index_path = kallisto_index(folder_index_path(results_folder, genome_dir), transcriptome_file)
+
+    data_trimmed_dir, fastqc_dir, results_dir, samples = prepare_folder(data_folder, results_folder,
+                                                                        genome_dir, args, plan)
+    # 02. Quantify every file set on its own
+    kallisto_pool(index_path, results_dir, samples, plan['kallisto'])
+
+    # 03. Optionally quantify all file sets of the folder together, once
+    if args.merged:
+        run_merged(index_path, results_dir, samples, plan)
 
     return data_trimmed_dir,fastqc_dir,results_dir
 
 
+def run_batch(data_folders, results_folder, genome_dir, transcriptome_file, args):
+    """Process several data folders, the file sets of all folders are
+    quantified by a single kallisto process that loads the index once"""
+    plan = plan_pipeline_resources(args)
+    index_path = kallisto_index(folder_index_path(results_folder, genome_dir), transcriptome_file)
+
+    folders = [prepare_folder(data_folder, results_folder, genome_dir, args, plan)
+               for data_folder in data_folders]
+    batch_samples = [(os.path.join(results_dir, name), input_files)
+                     for data_trimmed_dir, fastqc_dir, results_dir, samples in folders
+                     for name, input_files in samples]
+    batch_dir = tmp_path(os.path.join(results_folder, "kallisto_batch_%s" % os.path.basename(data_folders[0])))
+    run_kallisto_batch(index_path, batch_dir, batch_samples, transcriptome_file, threads=plan['kallisto'].threads)
+
+    if args.merged:
+        for data_trimmed_dir, fastqc_dir, results_dir, samples in folders:
+            run_merged(index_path, results_dir, samples, plan)
+
+
 DESCRIPTION = """run_kallisto.py - run Kallisto pipeline"""
 
 if __name__ == '__main__':
@@ -136,13 +256,24 @@ if __name__ == '__main__':
                                      description=DESCRIPTION)
     parser.add_argument('genomedir', help='genome directory')
     parser.add_argument('dataroot', help="parent of input directory")
-    parser.add_argument('indir', help="input directory without the input dir part")
+    parser.add_argument('indir', nargs='+', help="input directories without the input dir part")
     parser.add_argument('transcriptome_file', help="path to transcriptome_file")
     parser.add_argument('outdir', help='output directory')
     parser.add_argument('--fastq_patterns', help="FASTQ file patterns", default="*_{{pairnum}}.fq.*")
+    parser.add_argument('--trim_cores', type=int, default=None, help="core budget for concurrent trim_galore runs")
+    parser.add_argument('--trim_memory', type=float, default=None, help="memory budget (GB) for concurrent trim_galore runs")
+    parser.add_argument('--discovery_cache', default=None, help="path to the discovery cache database")
+    parser.add_argument('--merged', action='store_true',
+                        help="also quantify all file sets of the data folder together")
+    parser.add_argument('--batch', action='store_true',
+                        help="quantify the file sets of all input directories with a single kallisto process")
     args = parser.parse_args()
 
-    print("Processing directory %s" % args.indir)
-    data_folder = os.path.join(args.dataroot, args.indir)
-    data_trimmed_dir, fastqc_dir, results_dir = run_pipeline(data_folder, args.outdir, args.genomedir,
-                                                             args.transcriptome_file, args)
+    data_folders = [os.path.join(args.dataroot, indir) for indir in args.indir]
+    if args.batch:
+        print("Processing directories %s" % ', '.join(args.indir))
+        run_batch(data_folders, args.outdir, args.genomedir, args.transcriptome_file, args)
+    else:
+        for data_folder in data_folders:
+            print("Processing directory %s" % os.path.basename(data_folder))
+            run_pipeline(data_folder, args.outdir, args.genomedir, args.transcriptome_file, args)
@@ -11,6 +11,7 @@ from multiprocessing import Pool, cpu_count, Manager
 from subprocess import *
 #from pathos.multiprocessing import ProcessingPoll as Pool
 from functools import partial
+from .resources import available_resources, plan_resources, log_plan
 #from find_files import find_fastq_files
 
 DESCRIPTION = """run_spladder.py - run spladder"""
@@ -27,14 +28,14 @@ def create_dirs(spladder_work_dir, spladder_out_dir, parsed_event_dir):
 
 
 ####################### SplAdder Step1 Single graphs #############################
-def SplAdder_step1_single_graphs(input_bam, genome_annotation, spladder_out_dir):
+def SplAdder_step1_single_graphs(input_bam, genome_annotation, spladder_out_dir, parallel=2):
     command = ['spladder', 'build',
                 '-o', spladder_out_dir,
                 '-a', genome_annotation,
                 '-b', input_bam,
                 '--merge-strat', 'single',
                 '--no-extract-ase',
-                '--parallel', '2',
+                '--parallel', str(parallel),
                 '-v']
     cmd = ' '.join(command)
     print('SplAdder_Step1_single_graphs_run_command:\n%s' % cmd)
@@ -47,14 +48,14 @@ def SplAdder_step1_single_graphs(input_bam, genome_annotation, spladder_out_dir)
     errOut.close()
     
 ####################### SplAdder Step2 Merged graphs #############################
-def SplAdder_step2_merged_graphs(genome_annotation, spladder_out_dir, input_bam_list):
+def SplAdder_step2_merged_graphs(genome_annotation, spladder_out_dir, input_bam_list, parallel=40):
     command = ['spladder', 'build',
                 '-o', spladder_out_dir,
                 '-a', genome_annotation,
                 '-b', input_bam_list,
                 '--merge-strat', 'merge_graphs',
                 '--no-extract-ase',
-                '--parallel', '40',
+                '--parallel', str(parallel),
                 '-v']
     cmd = ' '.join(command)
     print('SplAdder_Step2_merging_splice_graphs_run_command:\n%s' % cmd)
@@ -69,7 +70,7 @@ def SplAdder_step2_merged_graphs(genome_annotation, spladder_out_dir, input_bam_
     #compl_proc = subprocess.run(command, check=True, capture_output=False)
 
 ####################### SplAdder Step3 Quantification #############################
-def SplAdder_step3_quantification(input_bam, genome_annotation, spladder_out_dir):
+def SplAdder_step3_quantification(input_bam, genome_annotation, spladder_out_dir, parallel=2):
     command = ['spladder', 'build',
                 '-o', spladder_out_dir,
                 '-a', genome_annotation,
@@ -78,7 +79,7 @@ def SplAdder_step3_quantification(input_bam, genome_annotation, spladder_out_dir
                 '--no-extract-ase',
                 '--quantify-graph',
                 '--qmode', 'single',
-                '--parallel', '2',
+                '--parallel', str(parallel),
                 '-v']
     cmd = ' '.join(command)
     print('SplAdder_Step3_splice_graphs_run_command:\n%s' % cmd)
@@ -91,7 +92,7 @@ def SplAdder_step3_quantification(input_bam, genome_annotation, spladder_out_dir
     errOut.close()
 
 ####################### SplAdder Step4 Aggregate Quantification####################
-def SplAdder_step4_aggregate_quantification(genome_annotation, spladder_out_dir, input_bam_list):
+def SplAdder_step4_aggregate_quantification(genome_annotation, spladder_out_dir, input_bam_list, parallel=40):
     command = ['spladder', 'build',
                 '-o', spladder_out_dir,
                 '-a', genome_annotation,
@@ -100,7 +101,7 @@ def SplAdder_step4_aggregate_quantification(genome_annotation, spladder_out_dir,
                 '--no-extract-ase',
                 '--quantify-graph',
                 '--qmode', 'collect',
-                '--parallel', '40',
+                '--parallel', str(parallel),
                 '-v']
     cmd = ' '.join(command)
     print('SplAdder_Step4_aggregate_quantification_run_command:\n%s' % cmd)
@@ -114,12 +115,12 @@ def SplAdder_step4_aggregate_quantification(genome_annotation, spladder_out_dir,
     #os.system(cmd)
 
 ####################### SplAdder Step5 Call Events ###############################
-def SplAdder_step5_call_events(genome_annotation, spladder_out_dir, input_bam_list):
+def SplAdder_step5_call_events(genome_annotation, spladder_out_dir, input_bam_list, parallel=40):
     command = ['spladder', 'build',
                 '-o', spladder_out_dir,
                 '-a', genome_annotation,
                 '-b', input_bam_list,
-                '--parallel', '40',
+                '--parallel', str(parallel),
                 '-v']
     cmd = ' '.join(command)
     print('SplAdder_Step5_call_events_run_command:\n%s' % cmd)
@@ -133,7 +134,7 @@ def SplAdder_step5_call_events(genome_annotation, spladder_out_dir, input_bam_li
     #os.system(cmd)
 
 ####################### SplAdder Step6 Contrast Tests ############################
-def SplAdder_step6_contrast_test(contrs, spladder_out_dir, contrast_dir):
+def SplAdder_step6_contrast_test(contrs, spladder_out_dir, contrast_dir, parallel=5):
     [var1, var2, const] = contrs.split()
     conditionA = contrast_dir + '/host_' + var1 + '_' + const + '.txt'
     conditionB = contrast_dir + '/host_' + var2 + '_' + const + '.txt'
@@ -148,7 +149,7 @@ def SplAdder_step6_contrast_test(contrs, spladder_out_dir, contrast_dir):
                 '--labelA', labelA,
                 '--labelB', labelB,
                 '--diagnose-plots',
-                '--parallel', '5',
+                '--parallel', str(parallel),
                 '-v']
     cmd = ' '.join(command)
     print('SplAdder_Step6_contrast_test_run_command:\n%s' % cmd)
@@ -223,6 +224,11 @@ def Clean_Up(spladder_out_dir):
 def run_spladder(spladder_work_dir, spladder_out_dir, parsed_event_dir, input_bam_list, genome_annotation, all_contrasts, contrast_dir, sample_type, args):
     # Run create directories function to create directory structure
     create_dirs(spladder_work_dir, spladder_out_dir, parsed_event_dir)
+
+    # plan the processes and threads of the steps
+    resources = available_resources()
+    plan = plan_resources(resources)
+    log_plan(resources, plan, stages=['spladder_sample', 'spladder_merged', 'spladder_test'])
     
     #---run step 1
     bamlist = open(input_bam_list, 'r')
@@ -233,29 +239,34 @@ def run_spladder(spladder_work_dir, spladder_out_dir, parsed_event_dir, input_ba
     print(bams)
     bamlist.close()
    
-    partial_work_step1 = partial(SplAdder_step1_single_graphs, genome_annotation=genome_annotation, spladder_out_dir=spladder_out_dir)
-    cpus = 16
+    partial_work_step1 = partial(SplAdder_step1_single_graphs, genome_annotation=genome_annotation, spladder_out_dir=spladder_out_dir,
+                                 parallel=plan['spladder_sample'].threads)
+    cpus = plan['spladder_sample'].workers
     pool = Pool(processes=cpus)
     pool.map(partial_work_step1, bams)
     pool.close()
     pool.join()
 
     #---run step 2
-    SplAdder_step2_merged_graphs(genome_annotation, spladder_out_dir, input_bam_list)
+    SplAdder_step2_merged_graphs(genome_annotation, spladder_out_dir, input_bam_list,
+                                 parallel=plan['spladder_merged'].threads)
 
     #---run step 3
-    partial_work_step3 = partial(SplAdder_step3_quantification, genome_annotation=genome_annotation, spladder_out_dir=spladder_out_dir)
-    cpus = 16
+    partial_work_step3 = partial(SplAdder_step3_quantification, genome_annotation=genome_annotation, spladder_out_dir=spladder_out_dir,
+                                 parallel=plan['spladder_sample'].threads)
+    cpus = plan['spladder_sample'].workers
     pool = Pool(processes=cpus)
     pool.map(partial_work_step3, bams)
     pool.close()
     pool.join()
 
     #---run step 4
-    SplAdder_step4_aggregate_quantification(genome_annotation, spladder_out_dir, input_bam_list)
+    SplAdder_step4_aggregate_quantification(genome_annotation, spladder_out_dir, input_bam_list,
+                                            parallel=plan['spladder_merged'].threads)
 
     #---run step 5
-    SplAdder_step5_call_events(genome_annotation, spladder_out_dir, input_bam_list)
+    SplAdder_step5_call_events(genome_annotation, spladder_out_dir, input_bam_list,
+                               parallel=plan['spladder_merged'].threads)
 
     #---run step 6
     contrast_list = open(all_contrasts, 'r')
@@ -264,8 +275,9 @@ def run_spladder(spladder_work_dir, spladder_out_dir, parsed_event_dir, input_ba
         contrs.append(line.strip())
     contrast_list.close()
 
-    partial_work_step6 = partial(SplAdder_step6_contrast_test, spladder_out_dir=spladder_out_dir, contrast_dir=contrast_dir)
-    cpus = 16
+    partial_work_step6 = partial(SplAdder_step6_contrast_test, spladder_out_dir=spladder_out_dir, contrast_dir=contrast_dir,
+                                 parallel=plan['spladder_test'].threads)
+    cpus = plan['spladder_test'].workers
     pool = Pool(processes=cpus)
     pool.map(partial_work_step6, contrs)
     pool.close()
@@ -324,7 +336,7 @@ write.table(one_ldf, paste0("'''
     parseR.close()
 
     partial_work_step7 = partial(SplAdder_step7_parsing_statistic, parseRscript=parseRscript)
-    cpus = 16
+    cpus = resources.cpus
     pool = Pool(processes=cpus)
     pool.map(partial_work_step7, contrs)
     pool.close()
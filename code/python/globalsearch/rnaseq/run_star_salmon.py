@@ -7,19 +7,42 @@
 ############################################################
 import glob, sys, os, string, datetime, re
 import argparse
+import shutil
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
+from .checkpoint import Checkpoints, tool_version, tmp_path, commit_path, commit_dir_contents, list_files
+from .fasta_index import check_unique_names, find_genome_fasta
 from .find_files import find_fastq_files
-from .trim_galore import trim_galore, collect_trimmed_data, create_result_dirs
+from .index_star import is_annotated_index, star_index_dir
+from .shared_genome import SharedGenome
+from .star_sweep import parse_filter_setting, permissive_setting, setting_prefix, filter_alignments
+from .discovery_cache import open_discovery_cache
+from .resources import (GB, available_resources, share_resources, plan_resources, log_plan, sort_memory_per_thread,
+                        without_resource_options, STAR_RESOURCE_OPTIONS, SALMON_RESOURCE_OPTIONS)
+from .trim_galore import trim_galore_pool, collect_trimmed_data, create_result_dirs
 
 DESCRIPTION = """run_STAR_SALMON.py - run STAR and Salmon"""
+# how often the streaming deduplication checks that the reader of STAR's pipe is alive
+PIPE_POLL_SECONDS = 1
 
 ####################### Run STAR #####################################
 ### We need to add Read GRoup info
 ### --outSAMattrRGline ID:${i%_TF_R1_val_1.fq.gz}
 ### https://github.com/BarshisLab/danslabnotebook/blob/main/CBASSAS_GenotypeScreening.md
 
-def run_star(first_pair_group, second_pair_group, results_dir, folder_name, genome_dir, args):
+def uses_shared_genome(genome_dir, args):
+    """True if run_star loads the genome into shared memory and keeps it there"""
+    if args.twopassMode:
+        return False  # two-pass has to run without shared memory
+    if is_annotated_index(genome_dir):
+        return True
+    # can't use GFF with a shared genome memory
+    return args.genome_gff is None or not os.path.exists(args.genome_gff)
+
+
+def run_star(first_pair_group, second_pair_group, results_dir, folder_name, genome_dir, args,
+             checkpoints=None):
     print('\033[33mRunning STAR! \033[0m', flush=True)
     outfile_prefix = '%s/%s_%s_' % (results_dir, folder_name, args.starPrefix)
     star_options = ["--runThreadN", str(args.runThreadN),
@@ -35,10 +58,15 @@ def run_star(first_pair_group, second_pair_group, results_dir, folder_name, geno
                     "--outFilterScoreMinOverLread", str(args.outFilterScoreMinOverLread),
                     "--outFilterMatchNmin", str(args.outFilterMatchNmin)]
 
-    genome_load = "LoadAndKeep"  # This is the default, for efficiency
+    if args.first_pass:
+        # the first pass of a cohort two-pass run only needs the junctions
+        out_sam_type = star_options.index("--outSAMtype")
+        star_options[out_sam_type + 1:out_sam_type + 3] = ["None"]
+
+    # LoadAndKeep is the default, for efficiency
+    genome_load = "LoadAndKeep" if uses_shared_genome(genome_dir, args) else "NoSharedMemory"
     if args.twopassMode:
         star_options.extend(["--twopassMode", "Basic"])
-        genome_load = "NoSharedMemory"  # two-pass has to run without shared memory
 
     command = ["STAR", "--genomeDir", genome_dir]
     command += star_options
@@ -48,8 +76,11 @@ def run_star(first_pair_group, second_pair_group, results_dir, folder_name, geno
         command += out_sam_attrs
 
     # Handling for GFF files
-    if not args.genome_gff is None and os.path.exists(args.genome_gff):
-        genome_load = "NoSharedMemory"  # can't use GFF with a shared genome memory
+    annotated_index = is_annotated_index(genome_dir)
+    if annotated_index:
+        # the annotated junctions were inserted at index time, so the genome can be shared
+        print("genome index '%s' includes the annotation, using the shared genome" % genome_dir, flush=True)
+    elif not args.genome_gff is None and os.path.exists(args.genome_gff):
         gff_args = [
             '--sjdbGTFfile', args.genome_gff,
             '--sjdbGTFtagExonParentTranscript', args.sjdbGTFtagExonParentTranscript,
@@ -64,20 +95,40 @@ def run_star(first_pair_group, second_pair_group, results_dir, folder_name, geno
                  "--outFileNamePrefix", outfile_prefix]
     command += ["--genomeLoad", genome_load]
 
-    # add more optional arguments
-    if args.sjdbGTFfeatureExon is not None:
+    # add more optional arguments, the GTF options are part of an annotated index
+    if args.sjdbGTFfeatureExon is not None and not annotated_index:
         command += ["--sjdbGTFfeatureExon", args.sjdbGTFfeatureExon]
-    if args.sjdbGTFtagExonParentGene is not None:
+    if args.sjdbGTFtagExonParentGene is not None and not annotated_index:
         command += ["--sjdbGTFtagExonParentGene", args.sjdbGTFtagExonParentGene]
-    if args.quantMode is not None:
+    if args.quantMode is not None and not args.first_pass:
         command += ["--quantMode"] + args.quantMode
 
     cmd = ' '.join(command)
-    compl_proc = subprocess.run(command, check=True, capture_output=False, cwd=results_dir)
+    if checkpoints is None:
+        compl_proc = subprocess.run(command, check=True, capture_output=False, cwd=results_dir)
+        return
+
+    stage = 'star_%s' % args.starPrefix
+    version = tool_version('STAR')
+    # a different allocation does not invalidate the alignments
+    params = without_resource_options(command, STAR_RESOURCE_OPTIONS)
+    if checkpoints.is_complete(stage, params, version):
+        return
+    # run STAR with a temporary prefix and move the results into place when it's done
+    tmp_dir = tmp_path(os.path.join(results_dir, stage))
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    tmp_command = list(command)
+    tmp_command[tmp_command.index("--outFileNamePrefix") + 1] = os.path.join(tmp_dir, os.path.basename(outfile_prefix))
+    compl_proc = subprocess.run(tmp_command, check=True, capture_output=False, cwd=results_dir)
+    outputs = commit_dir_contents(tmp_dir, results_dir)
+    checkpoints.complete(stage, params, version, outputs)
 
 ####################### Deduplication (not in _old) ###############################
-def dedup(results_dir,folder_name):
+def dedup(results_dir, folder_name, args):
     print('\033[33mRunning Deduplication! \033[0m', flush=True)
+    dedup_plan = args.resource_plan['dedup']
     outfile_prefix = '%s/%s_%s_' %(results_dir, folder_name, args.starPrefix)
 
     aligned_bam = '%sAligned.out.bam' % (outfile_prefix)
@@ -89,7 +140,7 @@ def dedup(results_dir,folder_name):
     nosingletonCollated_bam = '%sNoSingletonCollated.out.bam' % (outfile_prefix)
 
     # STAR mark duplicates
-    star_markdup_command = ['STAR', '--runThreadN', '32',
+    star_markdup_command = ['STAR', '--runThreadN', str(dedup_plan.threads),
                             '--runMode',
                             'inputAlignmentsFromBAM',
                             '--bamRemoveDuplicatesType', 'UniqueIdenticalNotMulti',
@@ -98,15 +149,18 @@ def dedup(results_dir,folder_name):
     star_markdup_cmd = ' '.join(star_markdup_command)
 
     # removesingletons from STAR
-    rmsingletonsSTAR_command = ['samtools', 'view', '-@', '8',
+    rmsingletonsSTAR_command = ['samtools', 'view', '-@', str(dedup_plan.threads),
                                 '-b', '-F', '0x400', markdupSTAR_bam,
                                 '>', nosingleton_bam]
     rmsingletonsSTAR_cmd = ' '.join(rmsingletonsSTAR_command)
 
     # Collate reads by name
     collatereadsSTAR_command = ['samtools', 'sort', '-o',
-                                nosingletonCollated_bam,
-                                '-n', '-@', '8', nosingleton_bam]
+                                tmp_path(nosingletonCollated_bam),
+                                '-n', '-@', str(dedup_plan.threads)]
+    if sort_memory_per_thread(dedup_plan) is not None:
+        collatereadsSTAR_command += ['-m', sort_memory_per_thread(dedup_plan)]
+    collatereadsSTAR_command.append(nosingleton_bam)
     collatereadsSTAR_cmd = ' '.join(collatereadsSTAR_command)
 
     ## STAR based BAM duplicate removal
@@ -121,16 +175,111 @@ def dedup(results_dir,folder_name):
     # Remove marked duplicates withh samtools
     print('Samtools  Collate reads by read name run command:%s' % collatereadsSTAR_cmd, flush=True)
     compl_proc = subprocess.run(collatereadsSTAR_cmd, shell=True, check=True, capture_output=False, cwd=results_dir)
+    commit_path(nosingletonCollated_bam)
+    return nosingletonCollated_bam
+
+
+def dedup_streaming(results_dir, folder_name, args):
+    """Deduplication without intermediate BAM files: STAR writes the duplicate marked
+    alignments into a named pipe, samtools view removes the duplicates and streams
+    uncompressed BAM into samtools sort. Only the name collated BAM file is written
+    to the results directory. The three processes run at the same time and split
+    the threads of the stage
+    """
+    print('\033[33mRunning streaming Deduplication! \033[0m', flush=True)
+    dedup_plan = args.resource_plan['dedup_streaming']
+    outfile_prefix = '%s/%s_%s_' %(results_dir, folder_name, args.starPrefix)
+
+    aligned_bam = '%sAligned.out.bam' % (outfile_prefix)
+    markdupSTAR_bam = '%sProcessed.out.bam' % (outfile_prefix)
+    nosingletonCollated_bam = '%sNoSingletonCollated.out.bam' % (outfile_prefix)
+
+    # STAR mark duplicates, there is no need to compress what goes into the pipe
+    star_markdup_command = ['STAR', '--runThreadN', str(dedup_plan.threads),
+                            '--runMode',
+                            'inputAlignmentsFromBAM',
+                            '--bamRemoveDuplicatesType', 'UniqueIdenticalNotMulti',
+                            '--outBAMcompression', '0',
+                            '--inputBAMfile', aligned_bam,
+                            '--outFileNamePrefix', outfile_prefix]
+    # remove the marked duplicates and collate reads by name
+    rmsingletonsSTAR_command = ['samtools', 'view', '-@', str(dedup_plan.threads),
+                                '-u', '-F', '0x400', markdupSTAR_bam]
+    collatereadsSTAR_command = ['samtools', 'sort', '-n', '-@', str(dedup_plan.threads),
+                                '-o', tmp_path(nosingletonCollated_bam)]
+    if sort_memory_per_thread(dedup_plan) is not None:
+        collatereadsSTAR_command += ['-m', sort_memory_per_thread(dedup_plan)]
+    collatereadsSTAR_command.append('-')
+    print('Streaming deduplication run command: %s | %s | %s' % (' '.join(star_markdup_command),
+                                                                 ' '.join(rmsingletonsSTAR_command),
+                                                                 ' '.join(collatereadsSTAR_command)),
+          flush=True)
+
+    if os.path.exists(markdupSTAR_bam):
+        os.remove(markdupSTAR_bam)
+    os.mkfifo(markdupSTAR_bam)
+    try:
+        view_proc = subprocess.Popen(rmsingletonsSTAR_command, stdout=subprocess.PIPE, cwd=results_dir)
+        sort_proc = subprocess.Popen(collatereadsSTAR_command, stdin=view_proc.stdout, cwd=results_dir)
+        view_proc.stdout.close()  # sort owns the pipe now
+        star_proc = subprocess.Popen(star_markdup_command, cwd=results_dir)
+        while True:
+            try:
+                star_proc.wait(timeout=PIPE_POLL_SECONDS)
+                break
+            except subprocess.TimeoutExpired:
+                if view_proc.poll() not in (None, 0):
+                    # without a reader, STAR blocks forever opening or writing the pipe
+                    star_proc.kill()
+        if star_proc.returncode != 0:
+            # STAR might have failed before opening the pipe, don't wait for the reader
+            view_proc.kill()
+        view_status = view_proc.wait()
+        sort_status = sort_proc.wait()
+    finally:
+        os.remove(markdupSTAR_bam)
+
+    if any(status != 0 for status in [star_proc.returncode, view_status, sort_status]):
+        # don't leave a partial result behind
+        if os.path.exists(tmp_path(nosingletonCollated_bam)):
+            os.remove(tmp_path(nosingletonCollated_bam))
+    if star_proc.returncode != 0:
+        raise subprocess.CalledProcessError(star_proc.returncode, star_markdup_command)
+    if view_status != 0:
+        raise subprocess.CalledProcessError(view_status, rmsingletonsSTAR_command)
+    if sort_status != 0:
+        raise subprocess.CalledProcessError(sort_status, collatereadsSTAR_command)
+    commit_path(nosingletonCollated_bam)
+    return nosingletonCollated_bam
+
+
+def run_dedup(results_dir, folder_name, args, checkpoints):
+    """run the selected deduplication mode unless it already completed"""
+    stage = 'dedup_%s' % args.starPrefix
+    params = {'star': checkpoints.digest('star_%s' % args.starPrefix), 'streaming': args.dedup_streaming}
+    version = '%s, %s' % (tool_version('STAR'), tool_version('samtools'))
+    if checkpoints.is_complete(stage, params, version):
+        return
+    if args.dedup_streaming:
+        output = dedup_streaming(results_dir, folder_name, args)
+    else:
+        output = dedup(results_dir, folder_name, args)
+    checkpoints.complete(stage, params, version, [output])
 
 
 ####################### Run Salmon Count ###############################
 # WW: Check the names of the input files they will be different from _out
-def run_salmon_quant(results_dir, folder_name, genome_fasta):
+def run_salmon_quant(results_dir, folder_name, genome_fasta, args, checkpoints=None,
+                     salmon_input=None, salmon_prefix=None, upstream=None):
     outfile_prefix = '%s/%s_%s_' %(results_dir, folder_name, args.starPrefix)
     print(outfile_prefix, flush=True)
     print('\033[33mRunning salmon-quant! \033[0m', flush=True)
+    if salmon_prefix is None:
+        salmon_prefix = args.salmonPrefix
     # check if we are performing deduplication
-    if args.dedup:
+    if salmon_input is not None:
+        pass  # explicitly specified, e.g. by a filter sweep
+    elif args.dedup:
         salmon_input = '%sNoSingletonCollated.out.bam' % (outfile_prefix)
     else:
         salmon_input = '%sAligned.out.bam' % (outfile_prefix)
@@ -140,12 +289,66 @@ def run_salmon_quant(results_dir, folder_name, genome_fasta):
         if os.path.exists(salmon_transcriptome_input):
             salmon_input = salmon_transcriptome_input
 
-    command = ['salmon', 'quant', '-t', genome_fasta,
-        '-l', 'A',  '-a',  salmon_input, '-o', '%s/%s_salmon_quant' % (results_dir, args.salmonPrefix)]
+    salmon_outdir = '%s/%s_salmon_quant' % (results_dir, salmon_prefix)
+    command = ['salmon', 'quant', '-p', str(args.resource_plan['salmon'].threads), '-t', genome_fasta,
+        '-l', 'A',  '-a',  salmon_input, '-o', salmon_outdir]
     cmd = ' '.join(command)
+    if checkpoints is None:
+        print("Salmon quant command: '%s'" % cmd, flush=True)
+        # run as a joined string
+        compl_proc = subprocess.run(cmd, check=True, capture_output=False, cwd=results_dir, shell=True)
+        return
+
+    stage = 'salmon_%s' % salmon_prefix
+    if upstream is None:
+        upstream = ('dedup_%s' if args.dedup else 'star_%s') % args.starPrefix
+    params = {'command': without_resource_options(command, SALMON_RESOURCE_OPTIONS),
+              'upstream': checkpoints.digest(upstream)}
+    version = tool_version('salmon')
+    if checkpoints.is_complete(stage, params, version):
+        return
+    # write into a temporary output directory and rename it when salmon is done
+    if os.path.exists(tmp_path(salmon_outdir)):
+        shutil.rmtree(tmp_path(salmon_outdir))
+    cmd = ' '.join(command[:-1] + [tmp_path(salmon_outdir)])
     print("Salmon quant command: '%s'" % cmd, flush=True)
     # run as a joined string
     compl_proc = subprocess.run(cmd, check=True, capture_output=False, cwd=results_dir, shell=True)
+    commit_path(salmon_outdir)
+    checkpoints.complete(stage, params, version, list_files(salmon_outdir))
+
+
+####################### STAR filter sweep ###############################
+def run_filter_sweep(results_dir, folder_name, genome_fasta, args, checkpoints):
+    """Derive every filter setting of the sweep from the permissive alignment and
+    quantify each of them with salmon"""
+    settings = [parse_filter_setting(spec) for spec in args.filter_sweep]
+    outfile_prefix = '%s/%s_%s_' %(results_dir, folder_name, args.starPrefix)
+    if args.dedup:
+        input_bam = '%sNoSingletonCollated.out.bam' % outfile_prefix
+        upstream = 'dedup_%s' % args.starPrefix
+    else:
+        input_bam = '%sAligned.out.bam' % outfile_prefix
+        upstream = 'star_%s' % args.starPrefix
+    dedup_suffix = '_dedup' if args.dedup else ''
+    filtered_bams = ['%sFiltered_%s%s.out.bam' % (outfile_prefix, setting_prefix(setting), dedup_suffix)
+                     for setting in settings]
+
+    print('\033[33mRunning STAR filter sweep! \033[0m', flush=True)
+    stage = 'filter_%s' % args.starPrefix
+    params = {'upstream': checkpoints.digest(upstream), 'settings': [list(setting) for setting in settings]}
+    version = tool_version('samtools')
+    if not checkpoints.is_complete(stage, params, version):
+        counts = filter_alignments(input_bam, filtered_bams, settings,
+                                   threads=args.resource_plan['dedup'].threads)
+        for setting, count in zip(settings, counts):
+            print("filter setting %s: %d alignments" % (setting_prefix(setting), count), flush=True)
+        checkpoints.complete(stage, params, version, filtered_bams)
+
+    for setting, filtered_bam in zip(settings, filtered_bams):
+        salmon_prefix = 'salmon_%s%s' % (setting_prefix(setting), dedup_suffix)
+        run_salmon_quant(results_dir, folder_name, genome_fasta, args, checkpoints,
+                         salmon_input=filtered_bam, salmon_prefix=salmon_prefix, upstream=stage)
 
 
 ####################### Run HTSEq Count ###############################
@@ -161,8 +364,25 @@ def run_htseq(htseq_dir, results_dir, folder_name, genome_gff):
 
 ####################### Running the Pipeline ###############################
 
+def plan_pipeline_resources(args, concurrency=1):
+    """plan the threads and memory of all stages, explicitly specified
+    values take precedence, and log the plan. concurrency is the number of
+    data folders that are processed side by side"""
+    resources = share_resources(available_resources(), concurrency)
+    plan = plan_resources(resources, star_threads=args.runThreadN, limit_bam_sort_ram=args.limitBAMsortRAM,
+                          trim_cores=args.trim_cores, trim_memory=args.trim_memory)
+    dedup_stage = 'dedup_streaming' if args.dedup_streaming else 'dedup'
+    log_plan(resources, plan, stages=['trim_galore', 'star', dedup_stage, 'salmon'])
+    args.runThreadN = plan['star'].threads
+    args.limitBAMsortRAM = plan['star'].memory
+    args.resource_plan = plan
+    return plan
+
+
 def run_pipeline(data_folder, results_folder, genome_dir, genome_fasta, args):
     folder_count = 1
+    if getattr(args, 'resource_plan', None) is None:
+        plan_pipeline_resources(args)
 
     # Loop through each data folder
     folder_name = data_folder.split('/')[-1]
@@ -170,7 +390,8 @@ def run_pipeline(data_folder, results_folder, genome_dir, genome_fasta, args):
 
     # Get the list of first file names in paired end sequences
     ## We need to make sure we capture fastq data files
-    pair_files = find_fastq_files(data_folder, args.fastq_patterns.split(','))
+    with open_discovery_cache(args.discovery_cache) as cache:
+        pair_files = find_fastq_files(data_folder, args.fastq_patterns.split(','), cache=cache)
 
     # Program specific results directories
     data_trimmed_dir = "%s/%s/trimmed" % (results_folder,folder_name)
@@ -209,27 +430,45 @@ def run_pipeline(data_folder, results_folder, genome_dir, genome_fasta, args):
         # Collect Sample attributes
         sample_id = fastq_fname.replace(file_ext, "")
         print("sample_id: %s" % sample_id, flush=True)
-
-        # Run TrimGalore
-        trim_galore(first_pair_file, second_pair_file, folder_name,sample_id, data_trimmed_dir, fastqc_dir)
         file_count += 1
 
+    # Run TrimGalore on all file sets of the folder concurrently
+    trim_plan = args.resource_plan['trim_galore']
+    trim_galore_pool(pair_files, folder_name, data_trimmed_dir, fastqc_dir,
+                     cores=trim_plan.threads * trim_plan.workers, memory=trim_plan.memory / GB)
+
     # Collect Trimmed data for input into STAR
     first_pair_group, second_pair_group = collect_trimmed_data(data_trimmed_dir, is_gzip, is_paired_end)
 
+    # completion manifests of the stages, so a rerun can resume
+    checkpoints = Checkpoints(results_dir, resume=not args.no_resume)
+
+    if args.filter_sweep is not None:
+        # align once with the most permissive filter setting of the sweep
+        permissive = permissive_setting([parse_filter_setting(spec) for spec in args.filter_sweep])
+        for name, value in permissive._asdict().items():
+            setattr(args, name, value)
+
     # Run STAR
-    run_star(first_pair_group, second_pair_group, results_dir, folder_name, genome_dir, args)
+    run_star(first_pair_group, second_pair_group, results_dir, folder_name, genome_dir, args,
+             checkpoints)
+    if args.first_pass:
+        # the junctions of all samples go into the cohort index for the second pass
+        return data_trimmed_dir, fastqc_dir, results_dir
 
     # Run Deduplication
     if args.dedup:
         print('\033[33mRunning Deduplication: \033[0m', flush=True)
-        dedup(results_dir,folder_name)
+        run_dedup(results_dir, folder_name, args, checkpoints)
 
     # Run Salmon Quant
     if args.salmon_genome_fasta is not None:
         genome_fasta = args.salmon_genome_fasta
 
-    run_salmon_quant(results_dir, folder_name, genome_fasta)
+    if args.filter_sweep is not None:
+        run_filter_sweep(results_dir, folder_name, genome_fasta, args, checkpoints)
+    else:
+        run_salmon_quant(results_dir, folder_name, genome_fasta, args, checkpoints)
     folder_count += 1
 
     return data_trimmed_dir, fastqc_dir, results_dir
@@ -240,13 +479,15 @@ if __name__ == '__main__':
                                      description=DESCRIPTION)
     parser.add_argument('genomedir', help='genome directory')
     parser.add_argument('dataroot', help="parent of input directory")
-    parser.add_argument('indir', help="input directory (R<somenumber>)")
+    parser.add_argument('indir', nargs='+', help="input directories (R<somenumber>), processed as a batch against the same loaded genome")
     parser.add_argument('outdir', help='output directory')
     parser.add_argument('--fastq_patterns', help="FASTQ file patterns", default="*_{{pairnum}}.fq.*")
     parser.add_argument('--genome_gff', help='genome GFF file')
     parser.add_argument('--genome_fasta', help='genome FASTA file')
     parser.add_argument('--dedup', action='store_true', help='should we deduplicate bam files (True or False)')
+    parser.add_argument('--dedup_streaming', action='store_true', help='deduplicate without intermediate bam files')
     parser.add_argument('--twopassMode', action='store_true', help='run STAR in two-pass mode')
+    parser.add_argument('--first_pass', action='store_true', help='only collect the junctions for a cohort two-pass run')
     parser.add_argument('--starPrefix', help="STAR output file name prefix")
     parser.add_argument('--salmonPrefix', help="Salmon output folder name prefix")
     parser.add_argument('--outFilterMismatchNmax', nargs='?', const=10, type=int)
@@ -254,8 +495,8 @@ if __name__ == '__main__':
     parser.add_argument('--outFilterScoreMinOverLread', nargs='?', const=0.66, type=float)
     parser.add_argument('--outFilterMatchNmin', nargs='?', const=0, type=int)
     parser.add_argument('--outSAMattributes', nargs='?', type=str, default="Standard")
-    parser.add_argument('--runThreadN', type=int, default=32)
-    parser.add_argument('--limitBAMsortRAM', type=int, default=5784458574)
+    parser.add_argument('--runThreadN', type=int, default=None, help="STAR threads, default: all CPUs of the allocation")
+    parser.add_argument('--limitBAMsortRAM', type=int, default=None, help="STAR BAM sorting memory, default: planned from the allocation")
     parser.add_argument('--sjdbGTFtagExonParentTranscript', default="Parent")
     parser.add_argument('--sjdbOverhang', type=int, default=None)
     parser.add_argument('--limitSjdbInsertNsj', type=int, default=1602710)
@@ -264,15 +505,43 @@ if __name__ == '__main__':
     parser.add_argument('--sjdbGTFtagExonParentGene')
     parser.add_argument('--quantMode', nargs="+")
     parser.add_argument('--salmon_genome_fasta')
+    parser.add_argument('--trim_cores', type=int, default=None, help="core budget for concurrent trim_galore runs")
+    parser.add_argument('--trim_memory', type=float, default=None, help="memory budget (GB) for concurrent trim_galore runs")
+    parser.add_argument('--discovery_cache', default=None, help="path to the discovery cache database")
+    parser.add_argument('--batch_overlap', type=int, default=1, help="number of data folders of a batch processed side by side")
+    parser.add_argument('--genome_state_dir', default=None, help="directory for the shared genome lock and reference count that all tasks of a node share (default: /dev/shm)")
+    parser.add_argument('--no_resume', action='store_true', help="rerun all stages, even if they completed before")
+    parser.add_argument('--filter_sweep', nargs='+', default=None,
+                        help="filter settings derived from a single alignment, each in the form 'outFilterMismatchNmax,outFilterMismatchNoverLmax,outFilterScoreMinOverLread,outFilterMatchNmin'")
 
     args = parser.parse_args()
 
     now = datetime.datetime.now()
     timeprint = now.strftime("%Y-%m-%d %H:%M")
-    data_folder = "%s/%s" % (args.dataroot, args.indir)
-    if args.genome_fasta is not None and os.path.exists(args.genome_fasta):
-        genome_fasta = args.genome_fasta
-    else:
-        genome_fasta = glob.glob('%s/*.fasta' % (args.genomedir))[0]
-
-    data_trimmed_dir,fastqc_dir,results_dir = run_pipeline(data_folder, args.outdir, args.genomedir, genome_fasta, args)
+    data_folders = ["%s/%s" % (args.dataroot, indir) for indir in args.indir]
+    genome_fasta = find_genome_fasta(args.genomedir, args.genome_fasta)
+    # salmon quantifies against the sequences of this file
+    check_unique_names(args.salmon_genome_fasta if args.salmon_genome_fasta is not None else genome_fasta)
+
+    # all data folders of the batch use the same loaded genome, which is shared
+    # with the other tasks on the node and removed by the last one
+    batch_overlap = max(1, min(args.batch_overlap, len(data_folders)))
+    plan_pipeline_resources(args, concurrency=batch_overlap)
+    genome_index_dir = star_index_dir(args.genomedir)
+    shared_genome = None
+    if uses_shared_genome(genome_index_dir, args):
+        shared_genome = SharedGenome(genome_index_dir, args.genome_state_dir)
+        shared_genome.acquire()
+    try:
+        if batch_overlap > 1:
+            with ThreadPoolExecutor(max_workers=batch_overlap) as executor:
+                futures = [executor.submit(run_pipeline, data_folder, args.outdir, genome_index_dir, genome_fasta, args)
+                           for data_folder in data_folders]
+                for future in futures:
+                    future.result()
+        else:
+            for data_folder in data_folders:
+                data_trimmed_dir,fastqc_dir,results_dir = run_pipeline(data_folder, args.outdir, genome_index_dir, genome_fasta, args)
+    finally:
+        if shared_genome is not None:
+            shared_genome.release()
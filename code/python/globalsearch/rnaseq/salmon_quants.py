@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+"""
+salmon_quants.py - TPM and NumReads matrices from the salmon quant.sf files
+
+This is the Python version of GlobalSearch::extract_salmon_quants() in the
+R package. Every quant.sf file is read once, by a pool of worker processes,
+and its TPM and NumReads columns are written into matrices with a row per
+transcript and a column per sample that are allocated up front. Salmon
+writes the transcripts of an index in the same order for every sample, so
+workers only send the transcript names back if they differ from the first
+file, which keeps the memory proportional to the output matrices.
+
+The output files are the same as the ones of the R version:
+
+  <outdir>/TPMs/STAR_Salmon_<organisms>_TPM_matrix_Merged.csv
+  <outdir>/TPMs/STAR_Salmon_<organisms>_TPM_matrix_<organism>.csv
+  <outdir>/Counts/STAR_Salmon_<organisms>_NumReads_matrix_Merged.csv
+  <outdir>/Counts/STAR_Salmon_<organisms>_NumReads_matrix_<organism>.csv
+
+with a gene_id column followed by a column per data folder, missing values
+are written as NA. With the 'hdf5' format, both matrices are also written to
+
+  <outdir>/STAR_Salmon_<organisms>_matrices.h5
+
+see matrix_h5.py, which allows reading a subset of genes or samples.
+
+The HDF5 file also records the path, modification time and size of the
+quant file of every column. In incremental mode, that file is the stored
+state: only quant files that are new or changed since it was written are
+parsed, their columns are replaced or appended, the other columns are
+copied from the file and columns of quant files that no longer exist are
+dropped.
+"""
+import argparse
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import os
+
+import numpy as np
+
+from .matrix_h5 import write_matrices, read_matrix, read_sample_info
+from .organism_index import OrganismIndex, report_unassigned
+
+DESCRIPTION = """salmon_quants.py - extract the TPM and NumReads matrices from salmon quant.sf files"""
+
+QUANT_FILE = 'quant.sf'
+QUANT_DIR_SUFFIX = 'salmon_quant'
+TPM_DIR = 'TPMs'
+COUNT_DIR = 'Counts'
+ALGORITHM = 'STAR_Salmon'
+FORMATS = ('csv', 'hdf5')
+
+# the merged matrices and the quant file of every column
+QuantState = namedtuple('QuantState', ['gene_ids', 'sources', 'mtimes', 'sizes', 'tpm', 'numreads'])
+
+
+def find_quant_files(analysis_dir):
+    """the quant.sf files in the *salmon_quant directories below analysis_dir, sorted by path"""
+    result = []
+    for root, dirs, files in os.walk(analysis_dir):
+        if root.endswith(QUANT_DIR_SUFFIX) and QUANT_FILE in files:
+            result.append(os.path.join(root, QUANT_FILE))
+    return sorted(result)
+
+
+def sample_names(quant_files, analysis_dir):
+    """The column names of the quant files: the data folder below analysis_dir.
+    If a data folder has more than one quant file, e.g. from a filter sweep,
+    its columns are named by the path of the quant directory instead"""
+    relative = [os.path.relpath(os.path.dirname(path), analysis_dir) for path in quant_files]
+    folders = [path.split(os.sep)[0] for path in relative]
+    counts = Counter(folders)
+    return [folder if counts[folder] == 1 else path for folder, path in zip(folders, relative)]
+
+
+def names_digest(names):
+    return hashlib.sha256('\n'.join(names).encode('utf-8')).hexdigest()
+
+
+def read_quant(path, reference_digest=None):
+    """Read a quant.sf file. Returns (names, TPM values, NumReads values),
+    names is None if the transcripts match the ones of reference_digest"""
+    names, tpms, numreads = [], [], []
+    with open(path) as infile:
+        header = infile.readline().rstrip('\n').split('\t')
+        name_col, tpm_col, numreads_col = header.index('Name'), header.index('TPM'), header.index('NumReads')
+        for line in infile:
+            row = line.rstrip('\n').split('\t')
+            names.append(row[name_col])
+            tpms.append(row[tpm_col])
+            numreads.append(row[numreads_col])
+    tpms = np.array(tpms, dtype=np.float64)
+    numreads = np.array(numreads, dtype=np.float64)
+    if reference_digest is not None and names_digest(names) == reference_digest:
+        names = None
+    return names, tpms, numreads
+
+
+def build_matrices(quant_files, workers=None):
+    """Returns the transcript names and the TPM and NumReads matrices
+    (transcripts x quant files) of the quant files. Transcripts that are
+    missing in a file are NaN in its column. The transcripts are in the
+    order in which they first occur."""
+    if len(quant_files) == 0:
+        return [], np.zeros((0, 0)), np.zeros((0, 0))
+    names, first_tpms, first_numreads = read_quant(quant_files[0])
+    reference_digest = names_digest(names)
+    row_index = {name: row for row, name in enumerate(names)}
+    tpm_matrix = np.full((len(names), len(quant_files)), np.nan)
+    numreads_matrix = np.full((len(names), len(quant_files)), np.nan)
+    tpm_matrix[:, 0] = first_tpms
+    numreads_matrix[:, 0] = first_numreads
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(read_quant, quant_files[1:], [reference_digest] * (len(quant_files) - 1),
+                               chunksize=8)
+        for col, (file_names, tpms, numreads) in enumerate(results, start=1):
+            if file_names is None:
+                tpm_matrix[:, col] = tpms
+                numreads_matrix[:, col] = numreads
+                continue
+            for name in file_names:
+                if name not in row_index:
+                    row_index[name] = len(names)
+                    names.append(name)
+            if len(names) > tpm_matrix.shape[0]:
+                padding = np.full((len(names) - tpm_matrix.shape[0], len(quant_files)), np.nan)
+                tpm_matrix = np.vstack([tpm_matrix, padding])
+                numreads_matrix = np.vstack([numreads_matrix, padding])
+            rows = np.array([row_index[name] for name in file_names], dtype=np.int64)
+            tpm_matrix[rows, col] = tpms
+            numreads_matrix[rows, col] = numreads
+    return names, tpm_matrix, numreads_matrix
+
+
+def file_manifest(quant_files, analysis_dir):
+    """the paths relative to analysis_dir, modification times and sizes of the quant files"""
+    stats = [os.stat(path) for path in quant_files]
+    return ([os.path.relpath(path, analysis_dir) for path in quant_files],
+            [stat.st_mtime_ns for stat in stats], [stat.st_size for stat in stats])
+
+
+def update_state(previous, quant_files, analysis_dir, workers=None):
+    """The QuantState of quant_files. The columns of files that are unchanged
+    since the previous state are copied from it, all others are parsed.
+    Returns the state and the number of parsed files."""
+    sources, mtimes, sizes = file_manifest(quant_files, analysis_dir)
+    known = {}
+    if previous is not None:
+        known = {source: (col, mtime, size) for col, (source, mtime, size)
+                 in enumerate(zip(previous.sources, previous.mtimes, previous.sizes))}
+    reused, parsed = [], []
+    for col, (source, mtime, size) in enumerate(zip(sources, mtimes, sizes)):
+        entry = known.get(source)
+        if entry is not None and entry[1:] == (mtime, size):
+            reused.append((col, entry[0]))
+        else:
+            parsed.append(col)
+
+    names, tpms, numreads = build_matrices([quant_files[col] for col in parsed], workers)
+    gene_ids = [] if previous is None else list(previous.gene_ids)
+    row_index = {name: row for row, name in enumerate(gene_ids)}
+    for name in names:
+        if name not in row_index:
+            row_index[name] = len(gene_ids)
+            gene_ids.append(name)
+    tpm_matrix = np.full((len(gene_ids), len(quant_files)), np.nan)
+    numreads_matrix = np.full((len(gene_ids), len(quant_files)), np.nan)
+    if len(reused) > 0:
+        cols, previous_cols = [np.array(values, dtype=np.int64) for values in zip(*reused)]
+        num_previous = len(previous.gene_ids)
+        tpm_matrix[:num_previous, cols] = previous.tpm[:, previous_cols]
+        numreads_matrix[:num_previous, cols] = previous.numreads[:, previous_cols]
+    if len(parsed) > 0:
+        rows = np.array([row_index[name] for name in names], dtype=np.int64)
+        tpm_matrix[np.ix_(rows, parsed)] = tpms
+        numreads_matrix[np.ix_(rows, parsed)] = numreads
+    # genes that only occurred in quant files that are gone
+    keep = ~np.isnan(numreads_matrix).all(axis=1)
+    if not keep.all():
+        gene_ids = [gene_id for gene_id, kept in zip(gene_ids, keep) if kept]
+        tpm_matrix, numreads_matrix = tpm_matrix[keep], numreads_matrix[keep]
+    return QuantState(gene_ids, sources, mtimes, sizes, tpm_matrix, numreads_matrix), len(parsed)
+
+
+def read_state(path):
+    """the QuantState stored in an HDF5 matrix file, None if it has none"""
+    if not os.path.exists(path):
+        return None
+    info = read_sample_info(path)
+    if any(name not in info for name in ['source', 'mtime', 'size']):
+        return None
+    gene_ids, samples, tpm_matrix = read_matrix(path, 'TPM')
+    gene_ids, samples, numreads_matrix = read_matrix(path, 'NumReads')
+    return QuantState(gene_ids, info['source'], [int(mtime) for mtime in info['mtime']],
+                      [int(size) for size in info['size']], tpm_matrix, numreads_matrix)
+
+
+def _csv_field(value):
+    if any(c in value for c in ',"\n'):
+        return '"%s"' % value.replace('"', '""')
+    return value
+
+
+def write_matrix_csv(path, gene_ids, columns, matrix, rows=None):
+    """write the matrix with a gene_id column, restricted to the given row indexes"""
+    if rows is None:
+        rows = range(len(gene_ids))
+    # one format operation per row, rows with missing values are formatted
+    # value by value with NaN written as NA
+    row_format = ''.join([',%.15g'] * len(columns))
+    missing = np.isnan(matrix).any(axis=1)
+    with open(path, 'w') as outfile:
+        outfile.write(','.join(_csv_field(name) for name in ['gene_id'] + list(columns)) + '\n')
+        for row in rows:
+            values = matrix[row].tolist()
+            if missing[row]:
+                formatted = ''.join(',NA' if value != value else ',%.15g' % value for value in values)
+            else:
+                formatted = row_format % tuple(values)
+            outfile.write(_csv_field(gene_ids[row]) + formatted + '\n')
+
+
+def write_out_tables(gene_ids, columns, matrix, outdir, typename, organisms, organism_rows=None,
+                     algorithm=ALGORITHM):
+    """write the merged matrix and the rows of each organism, organism_rows
+    maps the organisms to their row indexes, see OrganismIndex.rows()"""
+    if organism_rows is None:
+        organism_rows = OrganismIndex(organisms).rows(gene_ids)
+    prefix = os.path.join(outdir, '%s_%s_%s' % (algorithm, '_'.join(organisms), typename))
+    write_matrix_csv(prefix + '_Merged.csv', gene_ids, columns, matrix)
+    for organism in organisms:
+        write_matrix_csv('%s_%s.csv' % (prefix, organism), gene_ids, columns, matrix, organism_rows[organism])
+
+
+def hdf5_path(outdir, organisms, algorithm=ALGORITHM):
+    return os.path.join(outdir, '%s_%s_matrices.h5' % (algorithm, '_'.join(organisms)))
+
+
+def extract_salmon_quants(organisms, analysis_dir, outdir, workers=None, formats=('csv',), incremental=False,
+                          genome_fasta=None):
+    """Extract the TPMs and the number of reads from all the quant.sf files
+    in analysis_dir and write them to the TPMs and Counts directories in outdir
+    ('csv' format) and/or to a single HDF5 file in outdir ('hdf5' format).
+    If incremental, only the quant files that changed since the HDF5 file
+    was written are parsed, the HDF5 file is always written in that case.
+    The rows of the organisms are determined from the sequence names of
+    genome_fasta, see organism_index.py."""
+    unknown = set(formats) - set(FORMATS)
+    if len(unknown) > 0:
+        raise ValueError("unknown output format(s): %s" % ', '.join(sorted(unknown)))
+    analysis_dir = os.path.realpath(analysis_dir)
+    quant_files = find_quant_files(analysis_dir)
+    print("Extracting salmon quants from %d files in '%s'" % (len(quant_files), analysis_dir), flush=True)
+    columns = sample_names(quant_files, analysis_dir)
+    previous = None
+    if incremental:
+        formats = set(formats) | {'hdf5'}
+        previous = read_state(hdf5_path(outdir, organisms))
+    state, num_parsed = update_state(previous, quant_files, analysis_dir, workers)
+    if incremental:
+        print("%d quant files are new or changed" % num_parsed, flush=True)
+    gene_ids, tpm_matrix, numreads_matrix = state.gene_ids, state.tpm, state.numreads
+    organism_index = OrganismIndex(organisms, genome_fasta)
+    codes = organism_index.route(gene_ids)
+    report_unassigned(gene_ids, codes, organisms)
+    organism_rows = organism_index.rows(gene_ids, codes)
+    if 'csv' in formats:
+        tpm_dir = os.path.join(outdir, TPM_DIR)
+        count_dir = os.path.join(outdir, COUNT_DIR)
+        os.makedirs(tpm_dir, exist_ok=True)
+        os.makedirs(count_dir, exist_ok=True)
+        write_out_tables(gene_ids, columns, tpm_matrix, tpm_dir, 'TPM_matrix', organisms, organism_rows)
+        write_out_tables(gene_ids, columns, numreads_matrix, count_dir, 'NumReads_matrix', organisms,
+                         organism_rows)
+    if 'hdf5' in formats:
+        os.makedirs(outdir, exist_ok=True)
+        write_matrices(hdf5_path(outdir, organisms), gene_ids, columns,
+                       {'TPM': tpm_matrix, 'NumReads': numreads_matrix},
+                       organism_rows,
+                       {'source': state.sources, 'mtime': state.mtimes, 'size': state.sizes})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=DESCRIPTION)
+    parser.add_argument('analysis_dir', help='the pipeline output directory')
+    parser.add_argument('outdir', help='directory for the TPMs and Counts directories')
+    parser.add_argument('organisms', nargs='+', help='organism names that occur in the gene ids')
+    parser.add_argument('--workers', type=int, default=None, help="number of parser processes")
+    parser.add_argument('--formats', nargs='+', choices=FORMATS, default=['csv'], help="output formats")
+    parser.add_argument('--genome_fasta', default=None,
+                        help="merged genome FASTA file, its sequence names determine the organisms")
+    parser.add_argument('--incremental', action='store_true',
+                        help="only parse the quant files that changed since the last HDF5 output")
+    args = parser.parse_args()
+    extract_salmon_quants(args.organisms, args.analysis_dir, args.outdir, args.workers, args.formats,
+                          args.incremental, args.genome_fasta)
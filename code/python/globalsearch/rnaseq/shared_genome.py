@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+"""
+shared_genome.py - node level lifecycle of a STAR genome in shared memory
+
+Array tasks that land on the same node can share one copy of the genome.
+A lock file serializes the tasks of a node and a state file next to it
+records the process ids of the tasks that currently use the genome. The
+first task loads the genome (--genomeLoad LoadAndExit), later tasks attach
+to it through --genomeLoad LoadAndKeep, and the last task to release the
+genome removes it (--genomeLoad Remove).
+
+Tasks that were killed before releasing the genome are detected by their
+process ids and dropped from the holders, so they don't keep the genome
+loaded forever.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+
+# the lock and state files have to be visible to all tasks of a node. The
+# temporary directory can be private to a job (Slurm job_container/tmpfs),
+# /dev/shm is shared by the node like the genome itself
+NODE_SHARED_DIR = '/dev/shm'
+
+
+def default_state_dir():
+    if os.path.isdir(NODE_SHARED_DIR) and os.access(NODE_SHARED_DIR, os.W_OK | os.X_OK):
+        return NODE_SHARED_DIR
+    return tempfile.gettempdir()
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # exists, but belongs to another user
+    return True
+
+
+class SharedGenome:
+    """Reference counted shared memory genome of a node.
+
+    :param genome_dir: the STAR genome directory
+    :param state_dir: directory for the lock and state files that all tasks of the
+                      node share, default_state_dir() if not specified
+    :param star_command: the STAR executable
+    """
+    def __init__(self, genome_dir, state_dir=None, star_command='STAR'):
+        self.genome_dir = genome_dir
+        self.state_dir = state_dir if state_dir is not None else default_state_dir()
+        self.star_command = star_command
+        self.pid = os.getpid()
+        key = hashlib.sha256(os.path.realpath(genome_dir).encode('utf-8')).hexdigest()[:16]
+        base = os.path.join(self.state_dir, 'star_genome_%s_%s' % (socket.gethostname(), key))
+        self.lock_path = base + '.lock'
+        self.state_path = base + '.json'
+
+    def _run_star(self, genome_load):
+        log_dir = tempfile.mkdtemp(prefix='star_genome_', dir=self.state_dir)
+        try:
+            command = [self.star_command, '--genomeDir', self.genome_dir, '--genomeLoad', genome_load,
+                       '--outFileNamePrefix', log_dir + '/']
+            print("shared genome command: '%s'" % ' '.join(command), flush=True)
+            return subprocess.run(command, check=False, capture_output=False, cwd=log_dir).returncode
+        finally:
+            shutil.rmtree(log_dir)
+
+    def _read_holders(self):
+        try:
+            with open(self.state_path) as infile:
+                holders = json.load(infile)['holders']
+        except (OSError, ValueError, KeyError):
+            holders = []
+        return [pid for pid in holders if _process_alive(pid)]
+
+    def _write_holders(self, holders):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as outfile:
+            json.dump({'genome_dir': self.genome_dir, 'holders': holders}, outfile)
+        os.replace(tmp_path, self.state_path)
+
+    def _locked(self, update):
+        """call update(holders) with the node's lock held and store the holders it returns"""
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._write_holders(update(self._read_holders()))
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def holders(self):
+        """the process ids of the live tasks that use the genome"""
+        return self._read_holders()
+
+    def acquire(self):
+        """register this process as a user of the genome, loading it if it is the first one"""
+        def update(holders):
+            if len(holders) == 0:
+                status = self._run_star('LoadAndExit')
+                if status != 0:
+                    raise subprocess.CalledProcessError(status, '%s --genomeLoad LoadAndExit' % self.star_command)
+            if self.pid not in holders:
+                holders.append(self.pid)
+            return holders
+        self._locked(update)
+
+    def release(self):
+        """unregister this process, the last one removes the genome from shared memory"""
+        def update(holders):
+            holders = [pid for pid in holders if pid != self.pid]
+            if len(holders) == 0:
+                status = self._run_star('Remove')
+                if status != 0:
+                    print("removing the shared genome failed with exit status %d" % status, flush=True)
+            return holders
+        self._locked(update)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
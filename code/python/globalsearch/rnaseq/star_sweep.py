@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+"""
+star_sweep.py - derive STAR filter parameter sweeps from a single alignment
+
+Instead of realigning for every combination of outFilterMismatchNmax,
+outFilterMismatchNoverLmax, outFilterScoreMinOverLread and outFilterMatchNmin,
+the reads are aligned once with the most permissive combination. Every
+requested combination is then derived from that alignment in one streaming
+pass over the alignment records, using the nM and AS attributes and the
+alignment lengths, the same quantities STAR applies these filters to.
+
+The alignments need the nM and AS attributes (contained in the "Standard"
+outSAMattributes) and the mates of an alignment need to be grouped by read
+name, which holds for STAR's unsorted and samtools' name sorted output.
+Multimapper attributes (NH) are not adjusted when some of the alignments
+of a read are filtered out.
+"""
+from collections import namedtuple
+import subprocess
+
+from .checkpoint import tmp_path, commit_path
+
+FilterSetting = namedtuple('FilterSetting', ['outFilterMismatchNmax', 'outFilterMismatchNoverLmax',
+                                             'outFilterScoreMinOverLread', 'outFilterMatchNmin'])
+
+# CIGAR operations that consume the read / are aligned to the reference
+QUERY_OPS = set('MIS=X')
+MAPPED_OPS = set('M=X')
+
+
+def _number(s):
+    value = float(s)
+    return int(value) if value.is_integer() and '.' not in s else value
+
+
+def parse_filter_setting(spec):
+    """parse a setting in the form "outFilterMismatchNmax,outFilterMismatchNoverLmax,
+    outFilterScoreMinOverLread,outFilterMatchNmin", e.g. "10,0.01,0.05,10\""""
+    comps = spec.split(',')
+    if len(comps) != 4:
+        raise ValueError("filter setting '%s' needs 4 comma separated values" % spec)
+    return FilterSetting(*[_number(c.strip()) for c in comps])
+
+
+def setting_prefix(setting):
+    """the naming used in star_prefix and salmon_prefix, e.g. "10_0.01_0.05_10\""""
+    return '_'.join(str(value) for value in setting)
+
+
+def permissive_setting(settings):
+    """the combination that lets through every alignment any of the settings accepts"""
+    return FilterSetting(max(s.outFilterMismatchNmax for s in settings),
+                         max(s.outFilterMismatchNoverLmax for s in settings),
+                         min(s.outFilterScoreMinOverLread for s in settings),
+                         min(s.outFilterMatchNmin for s in settings))
+
+
+def _cigar_lengths(cigar):
+    """return (query length, mapped length) of a CIGAR string"""
+    query_len = mapped_len = 0
+    num = 0
+    for c in cigar:
+        if c.isdigit():
+            num = num * 10 + ord(c) - 48
+        else:
+            if c in QUERY_OPS:
+                query_len += num
+            if c in MAPPED_OPS:
+                mapped_len += num
+            num = 0
+    return query_len, mapped_len
+
+
+def _tag(fields, name, default=None):
+    prefix = name + ':'
+    for field in fields[11:]:
+        if field.startswith(prefix):
+            return field.split(':', 2)[2]
+    return default
+
+
+def alignment_stats(records):
+    """compute (nM, AS, mapped length, read length) for the split SAM records of all
+    mates of one alignment. nM and AS are per alignment in STAR, lengths are summed
+    over the mates"""
+    num_mismatches = score = None
+    mapped_len = read_len = 0
+    for fields in records:
+        query_len, mapped = _cigar_lengths(fields[5])
+        mapped_len += mapped
+        read_len += len(fields[9]) if fields[9] != '*' else query_len
+        if num_mismatches is None:
+            num_mismatches = int(_tag(fields, 'nM', 0))
+            score = int(_tag(fields, 'AS', 0))
+    return num_mismatches, score, mapped_len, read_len
+
+
+def passes_filter(stats, setting):
+    """apply STAR's filter semantics to the alignment statistics"""
+    num_mismatches, score, mapped_len, read_len = stats
+    return (num_mismatches <= setting.outFilterMismatchNmax and
+            num_mismatches <= setting.outFilterMismatchNoverLmax * mapped_len and
+            score >= setting.outFilterScoreMinOverLread * read_len and
+            mapped_len >= setting.outFilterMatchNmin)
+
+
+def _read_groups(lines):
+    """group the SAM records by read name, yields (header line, None) or (None, records)"""
+    current_name = None
+    records = []
+    for line in lines:
+        if line.startswith('@'):
+            yield line, None
+            continue
+        fields = line.rstrip('\n').split('\t')
+        if fields[0] != current_name and len(records) > 0:
+            yield None, records
+            records = []
+        current_name = fields[0]
+        records.append(fields)
+    if len(records) > 0:
+        yield None, records
+
+
+def filter_sam_stream(lines, outputs, settings):
+    """Filter the SAM lines for all settings in a single pass.
+    outputs is a list of writable text streams, one for each setting.
+    Returns the number of alignments written to each output
+    """
+    counts = [0] * len(settings)
+    for header, records in _read_groups(lines):
+        if header is not None:
+            for out in outputs:
+                out.write(header)
+            continue
+        # split the records of the read into its alignments by the hit index
+        alignments = {}
+        for fields in records:
+            if int(fields[1]) & 0x4:  # unmapped
+                continue
+            alignments.setdefault(_tag(fields, 'HI', '1'), []).append(fields)
+        for alignment in alignments.values():
+            stats = alignment_stats(alignment)
+            lines_out = None
+            for i, setting in enumerate(settings):
+                if passes_filter(stats, setting):
+                    if lines_out is None:
+                        lines_out = ''.join('\t'.join(fields) + '\n' for fields in alignment)
+                    outputs[i].write(lines_out)
+                    counts[i] += 1
+    return counts
+
+
+def filter_alignments(input_bam, output_bams, settings, threads=1):
+    """Stream input_bam once through samtools and write one filtered BAM file
+    per setting. The outputs are written under temporary names and renamed when
+    all of them are complete"""
+    reader = subprocess.Popen(['samtools', 'view', '-h', '-@', str(threads), input_bam],
+                              stdout=subprocess.PIPE, universal_newlines=True)
+    writers = [subprocess.Popen(['samtools', 'view', '-b', '-@', str(threads),
+                                 '-o', tmp_path(output_bam), '-'],
+                                stdin=subprocess.PIPE, universal_newlines=True)
+               for output_bam in output_bams]
+    try:
+        counts = filter_sam_stream(reader.stdout, [writer.stdin for writer in writers], settings)
+    finally:
+        for writer in writers:
+            writer.stdin.close()
+        reader.stdout.close()
+    statuses = [reader.wait()] + [writer.wait() for writer in writers]
+    if any(status != 0 for status in statuses):
+        raise subprocess.CalledProcessError(max(statuses), 'samtools view')
+    for output_bam in output_bams:
+        commit_path(output_bam)
+    return counts
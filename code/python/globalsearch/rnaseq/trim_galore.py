@@ -1,4 +1,8 @@
 import os
+import signal
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from fs.osfs import OSFS
 import fs
 
@@ -7,32 +11,67 @@ TRIMGALORE_SUFFIX_PAIRED = "_val_1.fq"
 PAIRED_END_FQ_PATTERN = '/*_val_%d.fq'
 SINGLE_END_FQ_PATTERN = '/*_trimmed.fq'
 
+# Resources a single trim_galore run needs: cutadapt, the gzip
+# compressor and FastQC each keep a core busy for the most part
+TRIMGALORE_CORES_PER_JOB = 2
+TRIMGALORE_MEMORY_PER_JOB = 2  # in GB
+
 """
 trim_galore --fastqc_args "--outdir /proj/omics4tb2/wwu/Global_Search/redsea-output/R1/fastqc_results/" --paired --output_dir /proj/omics4tb2/wwu/Global_Search/redsea-output/R1/trimmed/ /proj/omics4tb2/wwu/GlobalSearch.old/Pilot_Fail_Concat/rawdata/R1/R1_concat_1.fq.gz /proj/omics4tb2/wwu/GlobalSearch.old/Pilot_Fail_Concat/rawdata/R1/R1_concat_2.fq.gz"""
 
+class TrimProcesses:
+    """The running trim_galore processes of a pool, so they can be stopped
+    when one of them fails. Every process runs in its own session, which
+    also stops the cutadapt, gzip and FastQC processes it started. The
+    kallisto pool uses it for its kallisto processes the same way."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = set()
+        self.stopped = False
+
+    def start(self, cmd, shell=True):
+        """start cmd (in a shell by default), None if the pool was stopped"""
+        with self.lock:
+            if self.stopped:
+                return None
+            proc = subprocess.Popen(cmd, shell=shell, start_new_session=True)
+            self.running.add(proc)
+            return proc
+
+    def finished(self, proc):
+        with self.lock:
+            self.running.discard(proc)
+
+    def stop(self):
+        """terminate all running processes, no new process is started afterwards"""
+        with self.lock:
+            self.stopped = True
+            for proc in self.running:
+                try:
+                    os.killpg(proc.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+
 def trim_galore(first_pair_file, second_pair_file, folder_name, sample_id, data_trimmed_dir,
-                fastqc_dir):
+                fastqc_dir, processes=None):
+    """Run trim_galore on a single file pair and return its exit status.
+    If the trimmed result already exists, trimming is skipped and 0 is returned.
+    If processes is a TrimProcesses, the run is registered there and can be stopped,
+    the output of a failed or stopped run is removed
+    """
     paired = second_pair_file is not None  # make sure we are not single end
 
     # check whether the result already exists and skip if it does
-    file_base = os.path.basename(first_pair_file).replace(".gz", "").replace(".fastq", "").replace(".fq", "")
-    if paired:
-        trimmed_file_name = file_base + TRIMGALORE_SUFFIX_PAIRED
-    else:
-        trimmed_file_name = file_base + TRIMGALORE_SUFFIX_SINGLE
-
-    trimmed_path = os.path.join(data_trimmed_dir, trimmed_file_name)
-    trimmed_path_gz = trimmed_path + ".gz"
-    if os.path.exists(trimmed_path) or os.path.exists(trimmed_path_gz):
-        print("Trimmed file '%s' found, skipping trim_galore" % trimmed_file_name, flush=True)
-        return
+    trimmed_path = trimmed_files(first_pair_file, second_pair_file, data_trimmed_dir)[0]
+    if os.path.exists(trimmed_path):
+        print("Trimmed file '%s' found, skipping trim_galore" % os.path.basename(trimmed_path), flush=True)
+        return 0
 
     print ("\033[34m Running TrimGalore \033[0m")
     # create sample specific trimmed and fastqc directories
-    if not os.path.exists(data_trimmed_dir):
-        os.makedirs(data_trimmed_dir)
-    if not os.path.exists(fastqc_dir):
-        os.makedirs(fastqc_dir)
+    os.makedirs(data_trimmed_dir, exist_ok=True)
+    os.makedirs(fastqc_dir, exist_ok=True)
 
     # run Command
     command = ['trim_galore', '--fastqc_args', '"--outdir %s/"' % fastqc_dir]
@@ -43,7 +82,109 @@ def trim_galore(first_pair_file, second_pair_file, folder_name, sample_id, data_
         command.append(second_pair_file)
     cmd = ' '.join(command)
     print( '++++++ Trimgalore Command:', cmd)
-    os.system(cmd)  # run with os.system(), since you have that funny outdir parameter
+    # run in a shell, since you have that funny outdir parameter
+    if processes is None:
+        compl_proc = subprocess.run(cmd, shell=True, check=False, capture_output=False)
+        return compl_proc.returncode
+    proc = processes.start(cmd)
+    if proc is None:
+        return -signal.SIGTERM
+    try:
+        returncode = proc.wait()
+    finally:
+        processes.finished(proc)
+    if returncode != 0:
+        # a partial result would be skipped as trimmed in the next run
+        for path in trimmed_files(first_pair_file, second_pair_file, data_trimmed_dir):
+            if os.path.exists(path):
+                os.remove(path)
+    return returncode
+
+
+def trim_pool_size(num_pairs, cores=None, memory=None,
+                   cores_per_job=TRIMGALORE_CORES_PER_JOB,
+                   memory_per_job=TRIMGALORE_MEMORY_PER_JOB):
+    """Determine how many trim_galore processes can run side by side within
+    the given core and memory (in GB) budget. If cores is not specified, the
+    CPUs available to this process are used, if memory is not specified,
+    it does not restrict the pool size.
+    """
+    if cores is None:
+        cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    workers = max(1, cores // cores_per_job)
+    if memory is not None:
+        workers = min(workers, max(1, int(memory // memory_per_job)))
+    return max(1, min(workers, num_pairs))
+
+
+def trim_galore_pool(pair_files, folder_name, data_trimmed_dir, fastqc_dir,
+                     cores=None, memory=None):
+    """Trim all the file pairs of a data folder concurrently, bounded by the
+    core and memory budget.
+
+    Returns a list of (pair_file, exit_status) tuples in the order of pair_files.
+    As soon as one trim_galore run fails, the pending runs are cancelled, the
+    running ones terminated and a CalledProcessError is raised after all of
+    them have exited.
+    """
+    num_workers = trim_pool_size(len(pair_files), cores, memory)
+    print("Trimming %d file set(s) with %d worker(s)" % (len(pair_files), num_workers), flush=True)
+    statuses = {}
+    processes = TrimProcesses()
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    try:
+        futures = {}
+        for index, (first_pair_file, second_pair_file) in enumerate(pair_files):
+            future = executor.submit(trim_galore, first_pair_file, second_pair_file, folder_name,
+                                     _sample_id(first_pair_file), data_trimmed_dir, fastqc_dir,
+                                     processes=processes)
+            futures[future] = index
+        for future in as_completed(futures):
+            index = futures[future]
+            status = future.result()
+            statuses[index] = status
+            if status != 0:
+                raise subprocess.CalledProcessError(status, 'trim_galore %s' % pair_files[index][0])
+    except BaseException:
+        processes.stop()
+        raise
+    finally:
+        # don't leave trim_galore processes writing into data_trimmed_dir
+        executor.shutdown(wait=True, cancel_futures=True)
+    return [(pair_file, statuses[index]) for index, pair_file in enumerate(pair_files)]
+
+
+def file_base(fastq_path):
+    """the name of a FASTQ file without its extensions, which trim_galore
+    uses as the prefix of its output files"""
+    return os.path.basename(fastq_path).replace(".gz", "").replace(".fastq", "").replace(".fq", "")
+
+
+def trimmed_files(first_pair_file, second_pair_file, data_trimmed_dir):
+    """The trim_galore output files of a file pair, second_pair_file is None
+    for single end data. The compressed name is returned if it exists or
+    the input was compressed"""
+    if second_pair_file is None:
+        names = [file_base(first_pair_file) + TRIMGALORE_SUFFIX_SINGLE]
+    else:
+        names = [file_base(first_pair_file) + TRIMGALORE_SUFFIX_PAIRED,
+                 file_base(second_pair_file) + TRIMGALORE_SUFFIX_PAIRED.replace('_1', '_2')]
+    result = []
+    for name in names:
+        path = os.path.join(data_trimmed_dir, name)
+        if os.path.exists(path + ".gz") or (not os.path.exists(path) and first_pair_file.endswith(".gz")):
+            path += ".gz"
+        result.append(path)
+    return result
+
+
+def _sample_id(fastq_path):
+    fastq_fname = os.path.basename(fastq_path)
+    if fastq_fname.endswith("gz"):
+        file_ext = '.'.join(fastq_fname.split('.')[-2:])
+    else:
+        file_ext = fastq_fname.split('.')[-1]
+    return fastq_fname.replace(file_ext, "")
 
 
 ####################### Collect trimmed data files ###############################
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+"""
+tximport.py - gene level counts, abundances and lengths from transcript quantifications
+
+This is the Python version of tximport(type = "salmon" | "kallisto",
+tx2gene = ...), which the R scripts use to prepare the DESeq2 input. It
+reads the salmon quant.sf files or the kallisto abundance.h5/abundance.tsv
+files of all samples into transcript x sample matrices and summarizes
+them to genes for all samples at once:
+
+  abundance   sum of the transcript TPMs of a gene
+  counts      sum of the estimated counts of a gene, or counts derived from
+              the abundances (countsFromAbundance "scaledTPM" or
+              "lengthScaledTPM")
+  length      abundance weighted mean of the effective transcript lengths
+
+Lengths of genes without abundance in a sample are replaced by the
+geometric mean of the gene's lengths in the other samples, or by the mean
+transcript length if it has no abundance in any sample, as tximport does.
+Transcripts that are not in the transcript to gene map are dropped.
+
+The transcript to gene map is read from a GFF3 or GTF annotation (or a two
+column transcript/gene table) and stored next to it as <gff>.tx2gene, it is
+reused as long as it is newer than the annotation.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import gzip
+import os
+import re
+
+import h5py
+import numpy as np
+
+from .kallisto_batch import BATCH_MARKER, is_batch_result
+from .matrix_h5 import write_matrices
+from .salmon_quants import find_quant_files, sample_names, write_matrix_csv
+
+DESCRIPTION = """tximport.py - summarize salmon or kallisto quantifications to gene level matrices"""
+
+TX2GENE_SUFFIX = '.tx2gene'
+KALLISTO_H5 = 'abundance.h5'
+KALLISTO_TSV = 'abundance.tsv'
+COUNTS_FROM_ABUNDANCE = ('no', 'scaledTPM', 'lengthScaledTPM')
+GENE_TYPES = {'gene', 'pseudogene', 'ncRNA_gene'}
+ANNOTATION_EXTENSIONS = ('.gff', '.gff3', '.gtf')
+GTF_ATTRIBUTE = re.compile(r'(\S+) "([^"]*)"')
+
+
+def _open_text(path):
+    return gzip.open(path, 'rt') if path.endswith('.gz') else open(path)
+
+
+def _gff3_attributes(text):
+    result = {}
+    for field in text.strip().split(';'):
+        if '=' in field:
+            key, value = field.split('=', 1)
+            result[key.strip()] = value.strip()
+    return result
+
+
+def parse_tx2gene(path):
+    """The transcript to gene map of a GFF3 or GTF annotation. GTF lines map
+    their transcript_id to their gene_id. In GFF3 files, the ID (and Name, if
+    it differs) of every feature whose Parent is a gene maps to the gene ID."""
+    gtf_map = {}
+    features = []
+    gene_ids = set()
+    with _open_text(path) as infile:
+        for line in infile:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 9:
+                continue
+            gtf_attributes = dict(GTF_ATTRIBUTE.findall(fields[8]))
+            if 'transcript_id' in gtf_attributes and 'gene_id' in gtf_attributes:
+                gtf_map[gtf_attributes['transcript_id']] = gtf_attributes['gene_id']
+                continue
+            attributes = _gff3_attributes(fields[8])
+            if 'ID' not in attributes:
+                continue
+            if fields[2] in GENE_TYPES:
+                gene_ids.add(attributes['ID'])
+            elif 'Parent' in attributes:
+                features.append((attributes['ID'], attributes.get('Name'), attributes['Parent']))
+    result = gtf_map
+    for feature_id, name, parent in features:
+        # features with several parents are assigned to the first one
+        gene_id = parent.split(',')[0]
+        if gene_id in gene_ids:
+            result[feature_id] = gene_id
+            if name is not None and name not in result:
+                result[name] = gene_id
+    return result
+
+
+def read_tx2gene_table(path):
+    """a two column (transcript, gene) table, separated by tabs or commas"""
+    result = {}
+    with _open_text(path) as infile:
+        for line in infile:
+            fields = re.split('[\t,]', line.rstrip('\n'))
+            if len(fields) >= 2 and len(fields[0]) > 0:
+                result[fields[0]] = fields[1]
+    return result
+
+
+def _write_table(path, tx2gene):
+    """write the map atomically"""
+    tmp_path = '%s.%d' % (path, os.getpid())
+    with open(tmp_path, 'w') as outfile:
+        for transcript, gene in tx2gene.items():
+            outfile.write('%s\t%s\n' % (transcript, gene))
+    os.replace(tmp_path, path)
+
+
+def load_tx2gene(path, write=True):
+    """The transcript to gene map of an annotation or a transcript/gene table.
+    The map of an annotation is cached next to it as <path>.tx2gene"""
+    if not any(path.replace('.gz', '').endswith(ext) for ext in ANNOTATION_EXTENSIONS):
+        return read_tx2gene_table(path)
+    cache_path = path + TX2GENE_SUFFIX
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        return read_tx2gene_table(cache_path)
+    tx2gene = parse_tx2gene(path)
+    if write:
+        try:
+            _write_table(cache_path, tx2gene)
+        except OSError as e:
+            print("can't write the transcript to gene map of '%s': %s" % (path, str(e)), flush=True)
+    return tx2gene
+
+
+def _read_columns(path, name_col, length_col, count_col, abundance_col):
+    with open(path) as infile:
+        header = infile.readline().rstrip('\n').split('\t')
+        cols = [header.index(col) for col in (name_col, length_col, count_col, abundance_col)]
+        rows = [line.rstrip('\n').split('\t') for line in infile]
+    names = [row[cols[0]] for row in rows]
+    values = [np.array([row[col] for row in rows], dtype=np.float64) for col in cols[1:]]
+    return [names] + values
+
+
+def read_quantification(path):
+    """Read a salmon quant.sf or kallisto abundance.h5/abundance.tsv file.
+    Returns (transcript names, effective lengths, counts, TPM)"""
+    if path.endswith('.h5'):
+        with h5py.File(path, 'r') as infile:
+            names = [name.decode('utf-8') if isinstance(name, bytes) else name for name in infile['aux/ids'][:]]
+            lengths = infile['aux/eff_lengths'][:].astype(np.float64)
+            counts = infile['est_counts'][:].astype(np.float64)
+        # kallisto doesn't store the TPM in abundance.h5
+        rates = np.divide(counts, lengths, out=np.zeros_like(counts), where=lengths > 0)
+        abundance = rates * 1e6 / rates.sum() if rates.sum() > 0 else rates
+        return names, lengths, counts, abundance
+    if os.path.basename(path) == KALLISTO_TSV:
+        return _read_columns(path, 'target_id', 'eff_length', 'est_counts', 'tpm')
+    return _read_columns(path, 'Name', 'EffectiveLength', 'NumReads', 'TPM')
+
+
+def find_quantifications(quant_type, analysis_dir):
+    """the quant.sf files (salmon) or the abundance files of every kallisto
+    result directory below analysis_dir, abundance.h5 if it exists. Results
+    of kallisto batch mode (no bootstraps, no bias correction) can't be
+    combined with kallisto quant results"""
+    if quant_type == 'salmon':
+        return find_quant_files(analysis_dir)
+    result = []
+    batch_dirs = []
+    for root, dirs, files in os.walk(analysis_dir):
+        for name in (KALLISTO_H5, KALLISTO_TSV):
+            if name in files:
+                result.append(os.path.join(root, name))
+                if BATCH_MARKER in files:
+                    batch_dirs.append(root)
+                break
+    if 0 < len(batch_dirs) < len(result):
+        raise ValueError("%s mixes %d kallisto batch mode result(s) (e.g. %s) with %d kallisto quant result(s)" %
+                         (analysis_dir, len(batch_dirs), batch_dirs[0], len(result) - len(batch_dirs)))
+    return sorted(result)
+
+
+def read_quantifications(paths, workers=None):
+    """Read the quantification files in parallel. Returns the transcript names
+    and the length, counts and abundance matrices (transcripts x files)"""
+    if len(paths) == 0:
+        raise ValueError("no quantification files")
+    names, first_lengths, first_counts, first_abundance = read_quantification(paths[0])
+    positions = {name: row for row, name in enumerate(names)}
+    lengths = np.empty((len(names), len(paths)))
+    counts = np.empty((len(names), len(paths)))
+    abundance = np.empty((len(names), len(paths)))
+    lengths[:, 0], counts[:, 0], abundance[:, 0] = first_lengths, first_counts, first_abundance
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(read_quantification, paths[1:], chunksize=8)
+        for col, (file_names, file_lengths, file_counts, file_abundance) in enumerate(results, start=1):
+            if file_names == names:
+                rows = slice(None)
+            elif len(file_names) == len(names) and all(name in positions for name in file_names):
+                rows = np.array([positions[name] for name in file_names], dtype=np.int64)
+            else:
+                raise ValueError("'%s' was quantified against other transcripts than '%s'" % (paths[col],
+                                                                                               paths[0]))
+            lengths[rows, col], counts[rows, col], abundance[rows, col] = file_lengths, file_counts, file_abundance
+    return names, lengths, counts, abundance
+
+
+def _rowsum(matrix, order, starts):
+    """sums of the rows of matrix by gene, order groups the rows of a gene together"""
+    return np.add.reduceat(matrix[order], starts, axis=0)
+
+
+def summarize_to_genes(tx_names, lengths, counts, abundance, tx2gene, counts_from_abundance='no'):
+    """Gene level matrices of the transcript x sample matrices. Returns
+    (gene ids, length, counts, abundance), the genes are sorted by id"""
+    if counts_from_abundance not in COUNTS_FROM_ABUNDANCE:
+        raise ValueError("countsFromAbundance must be one of %s" % ', '.join(COUNTS_FROM_ABUNDANCE))
+    genes = [tx2gene.get(name) for name in tx_names]
+    keep = np.array([gene is not None for gene in genes], dtype=bool)
+    if not keep.any():
+        raise ValueError("none of the transcripts are in the transcript to gene map")
+    if not keep.all():
+        print("transcripts missing from the transcript to gene map: %d" % np.count_nonzero(~keep), flush=True)
+    lengths, counts, abundance = lengths[keep], counts[keep], abundance[keep]
+    gene_ids, codes = np.unique(np.array([gene for gene in genes if gene is not None]), return_inverse=True)
+    order = np.argsort(codes, kind='stable')
+    starts = np.flatnonzero(np.diff(codes[order], prepend=-1))
+
+    gene_abundance = _rowsum(abundance, order, starts)
+    gene_counts = _rowsum(counts, order, starts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gene_lengths = _rowsum(abundance * lengths, order, starts) / gene_abundance
+        # lengths of genes without abundance in a sample
+        missing = np.isnan(gene_lengths)
+        if missing.any():
+            transcripts_per_gene = np.diff(np.append(starts, len(order)))
+            mean_lengths = _rowsum(lengths.mean(axis=1), order, starts) / transcripts_per_gene
+            num_present = np.count_nonzero(~missing, axis=1)
+            log_sums = np.where(missing, 0, np.log(gene_lengths)).sum(axis=1)
+            geometric_means = np.exp(log_sums / np.maximum(num_present, 1))
+            replacement = np.where(missing.all(axis=1), mean_lengths, geometric_means)
+            gene_lengths = np.where(missing, replacement[:, np.newaxis], gene_lengths)
+
+    if counts_from_abundance != 'no':
+        new_counts = gene_abundance
+        if counts_from_abundance == 'lengthScaledTPM':
+            new_counts = gene_abundance * gene_lengths.mean(axis=1, keepdims=True)
+        new_sums = new_counts.sum(axis=0)
+        scale = np.divide(gene_counts.sum(axis=0), new_sums, out=np.zeros_like(new_sums), where=new_sums > 0)
+        gene_counts = new_counts * scale
+    return list(gene_ids), gene_lengths, gene_counts, gene_abundance
+
+
+def tximport(quant_type, analysis_dir, tx2gene_path, outdir, prefix=None, counts_from_abundance='no',
+             workers=None, formats=('csv',)):
+    """Summarize the quantifications below analysis_dir to genes and write the
+    counts, abundance and length matrices to outdir as
+    <prefix>_gene_<matrix>.csv and/or <prefix>_gene_matrices.h5"""
+    analysis_dir = os.path.realpath(analysis_dir)
+    paths = find_quantifications(quant_type, analysis_dir)
+    print("Summarizing %d %s quantifications in '%s'" % (len(paths), quant_type, analysis_dir), flush=True)
+    if quant_type == 'kallisto' and len(paths) > 0 and is_batch_result(os.path.dirname(paths[0])):
+        # find_quantifications doesn't mix them, so all results are from batch runs
+        if counts_from_abundance == 'lengthScaledTPM':
+            raise ValueError("kallisto batch mode results have no effective lengths, lengthScaledTPM "
+                             "would scale the counts by transcript lengths")
+        print("WARNING: kallisto batch mode results have no effective lengths, the gene lengths are "
+              "weighted means of the transcript lengths", flush=True)
+    tx2gene = load_tx2gene(tx2gene_path)
+    tx_names, lengths, counts, abundance = read_quantifications(paths, workers)
+    gene_ids, gene_lengths, gene_counts, gene_abundance = summarize_to_genes(tx_names, lengths, counts, abundance,
+                                                                             tx2gene, counts_from_abundance)
+    columns = sample_names(paths, analysis_dir)
+    matrices = {'counts': gene_counts, 'abundance': gene_abundance, 'length': gene_lengths}
+    if prefix is None:
+        prefix = 'STAR_Salmon' if quant_type == 'salmon' else 'Kallisto'
+    os.makedirs(outdir, exist_ok=True)
+    if 'csv' in formats:
+        for name, matrix in matrices.items():
+            write_matrix_csv(os.path.join(outdir, '%s_gene_%s.csv' % (prefix, name)), gene_ids, columns, matrix)
+    if 'hdf5' in formats:
+        write_matrices(os.path.join(outdir, '%s_gene_matrices.h5' % prefix), gene_ids, columns, matrices)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=DESCRIPTION)
+    parser.add_argument('type', choices=['salmon', 'kallisto'], help='quantification tool')
+    parser.add_argument('analysis_dir', help='the pipeline output directory')
+    parser.add_argument('tx2gene', help='GFF3/GTF annotation or a transcript/gene table')
+    parser.add_argument('outdir', help='output directory')
+    parser.add_argument('--prefix', default=None, help='prefix of the output files')
+    parser.add_argument('--countsFromAbundance', default='no', choices=COUNTS_FROM_ABUNDANCE,
+                        help='counts from the abundances, as in tximport')
+    parser.add_argument('--workers', type=int, default=None, help="number of parser processes")
+    parser.add_argument('--formats', nargs='+', choices=['csv', 'hdf5'], default=['csv'], help="output formats")
+    args = parser.parse_args()
+    tximport(args.type, args.analysis_dir, args.tx2gene, args.outdir, args.prefix, args.countsFromAbundance,
+             args.workers, args.formats)
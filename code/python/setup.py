@@ -29,7 +29,7 @@ CLASSIFIERS = [
     "Programming Language :: Python :: Implementation :: CPython",
     "Topic :: Software Development :: Libraries :: Python Modules"
     ]
-INSTALL_REQUIRES = ['jinja2', 'fs', 'xmlrunner', 'rpy2']
+INSTALL_REQUIRES = ['jinja2', 'fs', 'xmlrunner', 'rpy2', 'numpy', 'h5py']
 
 
 if __name__ == '__main__':
@@ -8,8 +8,17 @@ import unittest
 import xmlrunner
 import os, sys
 import fs
+import shutil
+import tempfile
+from unittest import mock
 
 from globalsearch.control.gs_prepare import check_star_options
+import globalsearch.control.gs_prepare as gs_prepare
+
+FAKE_TOOL = """#!/bin/sh
+echo run >> %s
+echo "%s"
+"""
 
 class CheckParamsTest(unittest.TestCase):
     def test_check_star_options_out_samattrs_special_success(self):
@@ -34,9 +43,87 @@ class CheckParamsTest(unittest.TestCase):
         """check wrong type for outSAMattributes"""
         self.assertRaises(TypeError, check_star_options, {'outSAMattributes': 'NH HI'})
 
+
+class ProbeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.tmpdir, "cache", "probes.json")
+        self.runs_path = os.path.join(self.tmpdir, "runs")
+        for command, output in [("salmon", "salmon 0.13.1"), ("samtools", "samtools 1.9")]:
+            self.write_tool(command, output)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_tool(self, command, output):
+        path = os.path.join(self.tmpdir, command)
+        with open(path, 'w') as outfile:
+            outfile.write(FAKE_TOOL % (self.runs_path, output))
+        os.chmod(path, 0o755)
+
+    def num_runs(self):
+        if not os.path.exists(self.runs_path):
+            return 0
+        with open(self.runs_path) as infile:
+            return len(infile.readlines())
+
+    def test_probe_cache(self):
+        """tools are only run again if their executable changed"""
+        commands = [("salmon", "--version"), ("samtools", "--version"), ("nonexisting-tool", "--version")]
+        with mock.patch.dict(os.environ, {"PATH": self.tmpdir}):
+            outputs = gs_prepare.probe_commands(commands, self.cache_path)
+            self.assertEqual("salmon 0.13.1\n", outputs[("salmon", "--version")])
+            self.assertEqual("samtools 1.9\n", outputs[("samtools", "--version")])
+            self.assertIsNone(outputs[("nonexisting-tool", "--version")])
+            self.assertEqual(2, self.num_runs())
+            self.assertEqual(outputs, gs_prepare.probe_commands(commands, self.cache_path))
+            self.assertEqual(2, self.num_runs())
+            self.write_tool("salmon", "salmon 1.10.0")
+            outputs = gs_prepare.probe_commands(commands, self.cache_path)
+            self.assertEqual("salmon 1.10.0\n", outputs[("salmon", "--version")])
+            self.assertEqual(3, self.num_runs())
+
+    def test_check_commands(self):
+        with mock.patch.dict(os.environ, {"PATH": self.tmpdir}):
+            gs_prepare.check_commands(["salmon", "samtools", "kallisto"], self.cache_path)
+            self.write_tool("salmon", "salmon 1.10.0")
+            self.assertRaises(SystemExit, gs_prepare.check_commands, ["salmon"], self.cache_path)
+            self.assertRaises(SystemExit, gs_prepare.check_commands, ["STAR"], self.cache_path)
+
+    def test_check_kallisto_batch(self):
+        """batch mode needs kallisto pseudo --quant, which exists from 0.46.2 to 0.48"""
+        with mock.patch.dict(os.environ, {"PATH": self.tmpdir}):
+            self.assertRaises(SystemExit, gs_prepare.check_kallisto_batch, self.cache_path)
+            self.write_tool("kallisto", "kallisto, version 0.46.1")
+            self.assertRaises(SystemExit, gs_prepare.check_kallisto_batch, self.cache_path)
+            self.write_tool("kallisto", "kallisto, version 0.46.2 ")
+            gs_prepare.check_kallisto_batch(self.cache_path)
+            self.write_tool("kallisto", "kallisto, version 0.48.0  ")
+            gs_prepare.check_kallisto_batch(self.cache_path)
+            self.write_tool("kallisto", "kallisto, version 0.50.1   ")
+            self.assertRaises(SystemExit, gs_prepare.check_kallisto_batch, self.cache_path)
+
+    def test_rlibraries_cache(self):
+        """R is only started if the installed library changed"""
+        package_dir = os.path.join(self.tmpdir, "GlobalSearch")
+        os.makedirs(package_dir)
+        with open(os.path.join(package_dir, "DESCRIPTION"), 'w') as outfile:
+            outfile.write("Package: GlobalSearch\n")
+        with mock.patch.object(gs_prepare, 'check_rlibrary_installed', return_value=package_dir) as check:
+            self.assertEqual([], gs_prepare.check_rlibraries_installed(self.cache_path))
+            self.assertEqual([], gs_prepare.check_rlibraries_installed(self.cache_path))
+            self.assertEqual(1, check.call_count)
+            os.utime(os.path.join(package_dir, "DESCRIPTION"), (0, 0))
+            self.assertEqual([], gs_prepare.check_rlibraries_installed(self.cache_path))
+            self.assertEqual(2, check.call_count)
+        with mock.patch.object(gs_prepare, 'check_rlibrary_installed', return_value=None):
+            shutil.rmtree(package_dir)
+            self.assertEqual(["GlobalSearch"], gs_prepare.check_rlibraries_installed(self.cache_path))
+
 if __name__ == '__main__':
     SUITE = []
     SUITE.append(unittest.TestLoader().loadTestsFromTestCase(CheckParamsTest))
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(ProbeTest))
     if len(sys.argv) > 1 and sys.argv[1] == 'xml':
         xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
     else:
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+"""
+checkpoint_test.py - Unit tests for the globalsearch.rnaseq.checkpoint module
+"""
+
+import unittest
+import xmlrunner
+import os, sys
+import shutil
+import tempfile
+from globalsearch.rnaseq.checkpoint import Checkpoints, tmp_path, commit_path, commit_dir_contents
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def __write(self, path, content="data"):
+        with open(path, 'w') as outfile:
+            outfile.write(content)
+        return path
+
+    def setUp(self):
+        self.results_dir = tempfile.mkdtemp()
+        self.checkpoints = Checkpoints(self.results_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.results_dir)
+
+    def test_not_complete_without_manifest(self):
+        self.assertFalse(self.checkpoints.is_complete('star', ['STAR'], '2.7.10a'))
+        self.assertIsNone(self.checkpoints.digest('star'))
+
+    def test_complete(self):
+        """a stage with matching parameters, version and outputs is complete"""
+        output = self.__write(os.path.join(self.results_dir, "Aligned.out.bam"))
+        self.checkpoints.complete('star', ['STAR', '--runThreadN', '4'], '2.7.10a', [output])
+        self.assertTrue(self.checkpoints.is_complete('star', ['STAR', '--runThreadN', '4'], '2.7.10a'))
+        self.assertIsNotNone(self.checkpoints.digest('star'))
+
+    def test_changed_params_or_version(self):
+        output = self.__write(os.path.join(self.results_dir, "Aligned.out.bam"))
+        self.checkpoints.complete('star', ['STAR', '--runThreadN', '4'], '2.7.10a', [output])
+        self.assertFalse(self.checkpoints.is_complete('star', ['STAR', '--runThreadN', '8'], '2.7.10a'))
+        self.assertFalse(self.checkpoints.is_complete('star', ['STAR', '--runThreadN', '4'], '2.7.11b'))
+
+    def test_changed_output(self):
+        """an output that was truncated or removed invalidates the stage"""
+        output = self.__write(os.path.join(self.results_dir, "Aligned.out.bam"))
+        self.checkpoints.complete('star', {}, '2.7.10a', [output])
+        self.__write(output, "da")
+        self.assertFalse(self.checkpoints.is_complete('star', {}, '2.7.10a'))
+        os.remove(output)
+        self.assertFalse(self.checkpoints.is_complete('star', {}, '2.7.10a'))
+
+    def test_no_resume(self):
+        checkpoints = Checkpoints(self.results_dir, resume=False)
+        checkpoints.complete('star', {}, '2.7.10a', [])
+        self.assertFalse(checkpoints.is_complete('star', {}, '2.7.10a'))
+
+    def test_commit_path_replaces_dir(self):
+        outdir = os.path.join(self.results_dir, "salmon_quant")
+        os.makedirs(outdir)
+        self.__write(os.path.join(outdir, "old.sf"))
+        os.makedirs(tmp_path(outdir))
+        self.__write(os.path.join(tmp_path(outdir), "quant.sf"))
+        commit_path(outdir)
+        self.assertEqual(["quant.sf"], os.listdir(outdir))
+        self.assertFalse(os.path.exists(tmp_path(outdir)))
+
+    def test_commit_dir_contents(self):
+        tmp_dir = os.path.join(self.results_dir, "star.tmp")
+        os.makedirs(os.path.join(tmp_dir, "R1__STARtmp"))
+        self.__write(os.path.join(tmp_dir, "R1_Aligned.out.bam"))
+        files = commit_dir_contents(tmp_dir, self.results_dir)
+        self.assertEqual([os.path.join(self.results_dir, "R1_Aligned.out.bam")], files)
+        self.assertTrue(os.path.isdir(os.path.join(self.results_dir, "R1__STARtmp")))
+        self.assertFalse(os.path.exists(tmp_dir))
+
+
+if __name__ == '__main__':
+    SUITE = []
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(CheckpointTest))
+    if len(sys.argv) > 1 and sys.argv[1] == 'xml':
+        xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
+    else:
+        unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+"""
+cohort_twopass_test.py - Unit tests for the globalsearch.rnaseq.cohort_twopass module
+"""
+
+import unittest
+import xmlrunner
+import os, sys
+import shutil
+import tempfile
+from unittest import mock
+import globalsearch.rnaseq.cohort_twopass as cohort_twopass
+import globalsearch.rnaseq.index_star as index_star
+
+# chrom, start, end, strand, motif, annotated, unique, multi, overhang
+SAMPLE1 = [("chr1", 100, 200, 1, 1, 0, 5, 0, 30),
+           ("chr1", 300, 400, 2, 2, 0, 1, 2, 20),
+           ("chr2", 50, 80, 0, 0, 0, 10, 0, 40),   # non-canonical
+           ("chr2", 500, 900, 1, 0, 1, 0, 1, 10)]  # non-canonical, annotated
+SAMPLE2 = [("chr1", 100, 200, 1, 1, 0, 4, 1, 35),
+           ("chr1", 300, 400, 2, 2, 0, 2, 0, 25),
+           ("chr10", 10, 20, 1, 1, 0, 3, 0, 10)]
+
+
+class CohortTwopassTest(unittest.TestCase):
+
+    def __write_sj(self, name, rows):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as outfile:
+            for row in rows:
+                outfile.write('\t'.join(str(value) for value in row) + '\n')
+        return path
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sj_paths = [self.__write_sj("R1_SJ.out.tab", SAMPLE1), self.__write_sj("R2_SJ.out.tab", SAMPLE2)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_merge_unfiltered(self):
+        """everything but unannotated non-canonical junctions, read counts summed"""
+        chroms, starts, ends, strands, unique_reads, samples = cohort_twopass.merge_junctions(
+            self.sj_paths, min_unique_reads=0, min_samples=1)
+        self.assertEqual(['chr1', 'chr1', 'chr10', 'chr2'], list(chroms))
+        self.assertEqual([100, 300, 10, 500], list(starts))
+        self.assertEqual([200, 400, 20, 900], list(ends))
+        self.assertEqual(['+', '-', '+', '+'], list(strands))
+        self.assertEqual([9, 3, 3, 0], list(unique_reads))
+        self.assertEqual([2, 2, 1, 1], list(samples))
+
+    def test_merge_filtered(self):
+        """junctions need the minimum number of unique reads in enough samples"""
+        chroms, starts, ends, strands, unique_reads, samples = cohort_twopass.merge_junctions(
+            self.sj_paths, min_unique_reads=2, min_samples=2)
+        self.assertEqual(['chr1'], list(chroms))
+        self.assertEqual([100], list(starts))
+        self.assertEqual([2], list(samples))
+
+    def test_merge_empty(self):
+        empty = self.__write_sj("R3_SJ.out.tab", [])
+        result = cohort_twopass.merge_junctions([empty])
+        self.assertEqual(0, len(result[0]))
+
+    def test_build_cohort_index(self):
+        """the merged junctions are inserted into a new index"""
+        config = {'output_dir': self.tmpdir, 'star_options': {'sjdbOverhang': 149}}
+        genome_fasta = self.__write_sj("genome.fasta", [(">chr1",), ("ACGT",)])
+
+        def fake_create_genome_index(genome_dir, genome_fasta, args):
+            self.assertEqual(149, args.sjdbOverhang)
+            self.assertIsNone(args.genome_gff)
+            with open(args.sjdbFileChrStartEnd[0]) as infile:
+                self.assertEqual(["chr1\t100\t200\t+", "chr1\t300\t400\t-"], infile.read().splitlines())
+            open(os.path.join(genome_dir, "SAindex"), 'w').close()
+
+        with mock.patch.object(index_star, 'create_genome_index', fake_create_genome_index), \
+             mock.patch.object(index_star, 'tool_version', lambda command: '2.7.10a'):
+            index_dir = cohort_twopass.build_cohort_index(config, genome_fasta, self.sj_paths,
+                                                          min_unique_reads=1, min_samples=2)
+        self.assertEqual(["SAindex"], os.listdir(index_dir))
+        self.assertTrue(os.path.islink(index_dir))
+
+
+if __name__ == '__main__':
+    SUITE = []
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(CohortTwopassTest))
+    if len(sys.argv) > 1 and sys.argv[1] == 'xml':
+        xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
+    else:
+        unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+"""
+discovery_cache_test.py - Unit tests for the globalsearch.rnaseq.discovery_cache module
+"""
+
+import unittest
+import xmlrunner
+import os, sys
+import shutil
+import tempfile
+import fs
+import globalsearch.rnaseq.find_files as find_files
+import sqlite3
+from globalsearch.rnaseq.discovery_cache import DiscoveryCache, open_discovery_cache
+
+
+class DiscoveryCacheTest(unittest.TestCase):
+
+    def __make_input_folder(self, num_samples, pattern="R%d_%d.fq.gz"):
+        for i in range(1, num_samples + 1):
+            dir = "inputdata/R%d/raw_data" % i
+            self.os_fs.makedirs(dir)
+            for j in range(2):
+                fname = pattern % (i, j + 1)
+                self.os_fs.touch(fs.path.combine(dir, fname))
+
+    def __bump_mtime(self, path):
+        """make sure the directory modification time differs from the recorded one"""
+        syspath = self.os_fs.getsyspath(path)
+        stat = os.stat(syspath)
+        os.utime(syspath, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.os_fs = fs.open_fs(self.tmpdir)
+        self.os_fs.makedir("inputdata")
+        self.input_dir = os.path.join(self.tmpdir, "inputdata")
+        self.cache = DiscoveryCache(os.path.join(self.tmpdir, "cache.sqlite"))
+
+    def tearDown(self):
+        self.cache.close()
+        self.os_fs.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_folder_list_warm(self):
+        """a second lookup is answered from the cache"""
+        self.__make_input_folder(2)
+        config = {'input_dir': self.input_dir}
+        result1 = find_files.rnaseq_data_folder_list(config, cache=self.cache)
+        result2 = find_files.rnaseq_data_folder_list(config, cache=self.cache)
+        self.assertEqual(sorted(result1), ['R1', 'R2'])
+        self.assertEqual(result1, result2)
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+
+    def test_folder_list_invalidated(self):
+        """adding a data folder invalidates the cached folder list"""
+        self.__make_input_folder(1)
+        config = {'input_dir': self.input_dir}
+        find_files.rnaseq_data_folder_list(config, cache=self.cache)
+        self.os_fs.makedir("inputdata/R2")
+        self.__bump_mtime("inputdata")
+        result = find_files.rnaseq_data_folder_list(config, cache=self.cache)
+        self.assertEqual(sorted(result), ['R1', 'R2'])
+        self.assertEqual(0, self.cache.hits)
+
+    def test_find_fastq_files_warm(self):
+        """cached FASTQ pairs are returned as tuples"""
+        self.__make_input_folder(1)
+        data_folder = os.path.join(self.input_dir, "R1")
+        result1 = find_files.find_fastq_files(data_folder, ["*_{{readnum}}.fq.*"], cache=self.cache)
+        result2 = find_files.find_fastq_files(data_folder, ["*_{{readnum}}.fq.*"], cache=self.cache)
+        expected = [(os.path.join(data_folder, "raw_data/R1_1.fq.gz"),
+                     os.path.join(data_folder, "raw_data/R1_2.fq.gz"))]
+        self.assertEqual(expected, result1)
+        self.assertEqual(expected, result2)
+        self.assertEqual(1, self.cache.hits)
+
+    def test_find_fastq_files_subdir_invalidated(self):
+        """a change in a nested directory invalidates the cached pairs"""
+        self.__make_input_folder(1)
+        data_folder = os.path.join(self.input_dir, "R1")
+        find_files.find_fastq_files(data_folder, ["*_{{readnum}}.fq.*"], cache=self.cache)
+        self.os_fs.touch("inputdata/R1/raw_data/R1_L2_1.fq.gz")
+        self.os_fs.touch("inputdata/R1/raw_data/R1_L2_2.fq.gz")
+        self.__bump_mtime("inputdata/R1/raw_data")
+        result = find_files.find_fastq_files(data_folder, ["*_{{readnum}}.fq.*"], cache=self.cache)
+        self.assertEqual(2, len(result))
+        self.assertEqual(0, self.cache.hits)
+
+
+    def test_open_discovery_cache(self):
+        """the cache is closed at the end of the with block"""
+        with open_discovery_cache(os.path.join(self.tmpdir, "cache.sqlite")) as cache:
+            find_files.rnaseq_data_folder_list({"input_dir": self.input_dir}, cache=cache)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            cache.conn.execute("SELECT 1")
+        with open_discovery_cache(None) as cache:
+            self.assertIsNone(cache)
+
+if __name__ == '__main__':
+    SUITE = []
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(DiscoveryCacheTest))
+    if len(sys.argv) > 1 and sys.argv[1] == 'xml':
+        xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
+    else:
+        unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+"""
+fasta_index_test.py - Unit tests for the globalsearch.rnaseq.fasta_index module
+"""
+
+import unittest
+import xmlrunner
+import os, sys
+import shutil
+import tempfile
+from unittest import mock
+import globalsearch.rnaseq.fasta_index as fasta_index
+from globalsearch.rnaseq.fasta_index import FastaIndex, FaiEntry, find_genome_fasta, check_unique_names
+
+# the index of this file in the samtools faidx format
+FASTA = """>chr1 description
+ACGTACGTAC
+GTACGTACGT
+ACG
+>chr2
+ACGTA
+>empty
+>chr3
+AC
+"""
+FAI = [FaiEntry('chr1', 23, 18, 10, 11), FaiEntry('chr2', 5, 50, 5, 6), FaiEntry('empty', 0, 63, 0, 0),
+       FaiEntry('chr3', 2, 69, 2, 3)]
+
+
+class FastaIndexTest(unittest.TestCase):
+
+    def __write_fasta(self, content, name="genome.fasta"):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w', newline='') as outfile:
+            outfile.write(content)
+        return path
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fasta = self.__write_fasta(FASTA)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_build(self):
+        """the index matches samtools faidx and is stored next to the FASTA file"""
+        index = FastaIndex(self.fasta)
+        self.assertEqual(FAI, index.entries)
+        self.assertEqual(['chr1', 'chr2', 'empty', 'chr3'], index.names)
+        self.assertEqual(5, index.length('chr2'))
+        self.assertIn('chr3', index)
+        with open(self.fasta + '.fai') as infile:
+            self.assertEqual("chr1\t23\t18\t10\t11\n", infile.readline())
+
+    def test_reuse(self):
+        """a current index is read instead of scanning the FASTA file again"""
+        FastaIndex(self.fasta)
+        with mock.patch.object(fasta_index, 'scan_fasta_records') as scan:
+            self.assertEqual(FAI, FastaIndex(self.fasta).entries)
+        scan.assert_not_called()
+        # a newer FASTA file is indexed again
+        os.utime(self.fasta, (os.path.getatime(self.fasta), os.path.getmtime(self.fasta) + 10))
+        with mock.patch.object(fasta_index, 'scan_fasta_records', return_value=([], [])) as scan:
+            FastaIndex(self.fasta)
+        scan.assert_called_once()
+
+    def test_fetch(self):
+        index = FastaIndex(self.fasta)
+        self.assertEqual("ACGTACGTACGTACGTACGTACG", index.fetch('chr1'))
+        self.assertEqual("ACGTAC", index.fetch('chr1', 8, 14))
+        self.assertEqual("CG", index.fetch('chr1', 21, 30))
+        self.assertEqual("", index.fetch('empty'))
+
+    def test_windows_line_breaks(self):
+        fasta = self.__write_fasta(FASTA.replace('\n', '\r\n'), "crlf.fasta")
+        index = FastaIndex(fasta)
+        self.assertEqual([23, 5, 0, 2], list(index.lengths))
+        self.assertEqual((10, 12), index.entries[0][3:])
+        self.assertEqual("ACGTAC", index.fetch('chr1', 8, 14))
+
+    def test_ragged_lines(self):
+        """sequences with lines of different lengths are indexed in memory only"""
+        fasta = self.__write_fasta(">chr1\nACGT\nAC\nACGT\n>chr2\nACGT\n", "ragged.fasta")
+        index = FastaIndex(fasta)
+        self.assertEqual({'chr1'}, index.ragged)
+        self.assertEqual([10, 4], list(index.lengths))
+        self.assertEqual("CACG", index.fetch('chr1', 5, 9))
+        self.assertFalse(os.path.exists(fasta + '.fai'))
+
+    def test_duplicate_names(self):
+        fasta = self.__write_fasta(">a\nAC\n>b\nAC\n>a desc\nAC\n", "dups.fasta")
+        self.assertEqual(['a'], FastaIndex(fasta).duplicate_names())
+        with self.assertRaises(ValueError):
+            check_unique_names(fasta)
+        check_unique_names(self.fasta)
+
+    def test_find_genome_fasta(self):
+        self.assertEqual(self.fasta, find_genome_fasta(self.tmpdir))
+        self.assertEqual(self.fasta, find_genome_fasta("/nonexistent", self.fasta))
+        with self.assertRaises(FileNotFoundError):
+            find_genome_fasta(os.path.join(self.tmpdir, "missing"))
+
+
+if __name__ == '__main__':
+    SUITE = []
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(FastaIndexTest))
+    if len(sys.argv) > 1 and sys.argv[1] == 'xml':
+        xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
+    else:
+        unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""
+fasta_stats_test.py - Unit tests for the globalsearch.rnaseq.fasta_stats module
+"""
+
+import unittest
+import xmlrunner
+import argparse
+import gzip
+import os, sys
+import shutil
+import tempfile
+from globalsearch.rnaseq.fasta_stats import (FastaStats, scan_fasta, n50, star_index_params, star_index_memory,
+                                             tune_index_args)
+
+FASTA = """>chr1 description
+ACGTACGTAC
+GTACGTACGT
+ACG
+>chr2
+ACGTA
+>empty
+>chr3
+AC
+"""
+
+
+class FastaStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fasta = os.path.join(self.tmpdir, "genome.fasta")
+        with open(self.fasta, 'w') as outfile:
+            outfile.write(FASTA)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_scan(self):
+        stats = scan_fasta(self.fasta)
+        self.assertEqual(30, stats.length)
+        self.assertEqual(4, stats.num_sequences)
+        self.assertEqual(23, stats.n50)
+        self.assertEqual([23, 5, 0, 2], list(stats.lengths))
+
+    def test_scan_windows_line_breaks(self):
+        with open(self.fasta, 'w') as outfile:
+            outfile.write(FASTA.replace('\n', '\r\n'))
+        self.assertEqual([23, 5, 0, 2], list(scan_fasta(self.fasta).lengths))
+
+    def test_scan_compressed(self):
+        path = os.path.join(self.tmpdir, "genome.fasta.gz")
+        with gzip.open(path, 'wt') as outfile:
+            outfile.write(FASTA)
+        self.assertEqual([23, 5, 0, 2], list(scan_fasta(path).lengths))
+
+    def test_scan_empty(self):
+        open(self.fasta, 'w').close()
+        self.assertEqual(0, scan_fasta(self.fasta).num_sequences)
+
+    def test_n50(self):
+        self.assertEqual(8, n50([2, 3, 4, 5, 6, 7, 8, 9, 10]))
+        self.assertEqual(0, n50([]))
+
+    def test_index_params(self):
+        """the parameters follow the STAR manual"""
+        # 3 Gb in 25 chromosomes: the STAR defaults
+        human = FastaStats(3 * 10 ** 9, 25, 0, [3 * 10 ** 9 // 25] * 25)
+        params = star_index_params(human)
+        self.assertEqual((14, 18), params[:2])
+        # small genome in many scaffolds
+        fragmented = FastaStats(30 * 10 ** 6, 10000, 0, [3000] * 10000)
+        self.assertEqual((11, 11), star_index_params(fragmented)[:2])
+        # short scaffolds, the read length dominates
+        self.assertEqual(7, star_index_params(FastaStats(10 ** 6, 10 ** 5, 0, [10] * 10 ** 5), 150)[1])
+
+    def test_index_memory(self):
+        """the genome, the suffix array on both strands and the suffix array index"""
+        memory = star_index_memory([1000, 100], 4, 10)
+        self.assertEqual(int(2048 + 2 * 1100 * 33 / 8 + 35 / 8 * 340), memory)
+
+    def test_tune_index_args(self):
+        """only unspecified parameters are derived"""
+        args = argparse.Namespace(genomeSAindexNbases=None, genomeChrBinNbits=16, sjdbOverhang=100)
+        tune_index_args(args, self.fasta)
+        self.assertEqual(1, args.genomeSAindexNbases)
+        self.assertEqual(16, args.genomeChrBinNbits)
+
+
+if __name__ == '__main__':
+    SUITE = []
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(FastaStatsTest))
+    if len(sys.argv) > 1 and sys.argv[1] == 'xml':
+        xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
+    else:
+        unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
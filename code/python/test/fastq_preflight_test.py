@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+"""
+fastq_preflight_test.py - Unit tests for the globalsearch.rnaseq.fastq_preflight module
+"""
+
+import unittest
+import xmlrunner
+import gzip
+import io
+import os, sys
+import random
+import shutil
+import tempfile
+from unittest import mock
+import globalsearch.rnaseq.fastq_preflight as fastq_preflight
+
+
+def fastq_records(num_reads, mate, lengths=(100, 100, 100, 90), first=0):
+    rand = random.Random(num_reads + first)
+    result = []
+    for index in range(first, first + num_reads):
+        length = lengths[index % len(lengths)]
+        sequence = ''.join(rand.choice('ACGT') for _ in range(length))
+        result.append("@read%d/%d\n%s\n+\n%s\n" % (index, mate, sequence, 'I' * length))
+    return ''.join(result).encode('ascii')
+
+
+class FastqPreflightTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def __write(self, name, data, compress=True):
+        path = os.path.join(self.tmpdir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as outfile:
+            outfile.write(gzip.compress(data) if compress else data)
+        return path
+
+    def test_verify(self):
+        path = self.__write("R1/a_1.fq.gz", fastq_records(1000, 1))
+        scan, names = fastq_preflight.scan_fastq(path, sample_reads=10)
+        self.assertIsNone(scan.error)
+        self.assertEqual((1000, True), (scan.reads, scan.exact))
+        self.assertEqual({100: 8, 90: 2}, scan.lengths)
+        self.assertEqual(["read%d" % i for i in range(10)], names)
+        self.assertEqual("length 90-100, median 100", fastq_preflight.length_summary(scan.lengths))
+
+    def test_concatenated_members(self):
+        """cat a.fq.gz b.fq.gz and uncompressed files are valid"""
+        path = self.__write("R1/a_1.fq.gz", fastq_records(300, 1))
+        with open(path, 'ab') as outfile:
+            outfile.write(gzip.compress(fastq_records(200, 1, first=300)) + b'\x00' * 16)
+        self.assertEqual((500, None), fastq_preflight.scan_fastq(path)[0][2::3])
+        path = self.__write("R1/b_1.fq", fastq_records(30, 1), compress=False)
+        self.assertEqual((30, None), fastq_preflight.scan_fastq(path)[0][2::3])
+
+    def test_broken_files(self):
+        data = gzip.compress(fastq_records(2000, 1))
+        path = self.__write("R1/truncated_1.fq.gz", data[:len(data) // 2], compress=False)
+        self.assertIn("truncated gzip stream", fastq_preflight.scan_fastq(path)[0].error)
+        # the quick mode only reads the sample and the end of the file
+        self.assertIn("truncated gzip stream",
+                      fastq_preflight.scan_fastq(path, sample_reads=10, verify=False)[0].error)
+        corrupt = bytearray(data)
+        corrupt[-6] ^= 0xff
+        path = self.__write("R1/crc_1.fq.gz", bytes(corrupt), compress=False)
+        self.assertIn("corrupt gzip stream", fastq_preflight.scan_fastq(path)[0].error)
+        path = self.__write("R1/record_1.fq.gz", fastq_records(10, 1)[:-30])
+        self.assertIn("the last FASTQ record is incomplete", fastq_preflight.scan_fastq(path, sample_reads=5)[0].error)
+        path = self.__write("R1/quality_1.fq.gz", fastq_records(10, 1).replace(b'I\n@read3', b'\n@read3'))
+        self.assertEqual("malformed FASTQ record 3", fastq_preflight.scan_fastq(path)[0].error)
+        path = self.__write("R1/empty_1.fq.gz", b'')
+        self.assertEqual("no reads", fastq_preflight.scan_fastq(path)[0].error)
+
+    def test_tail(self):
+        """the quick mode detects files that were cut off"""
+        members = b''.join(gzip.compress(fastq_records(20, 1, first=first)) for first in range(0, 2000, 20))
+        single = gzip.compress(fastq_records(5000, 1))
+        with mock.patch.object(fastq_preflight, 'TAIL_WINDOW', 4096):
+            self.assertIsNone(fastq_preflight.check_tail(self.__write("R1/a_1.fq.gz", members, compress=False)))
+            path = self.__write("R1/b_1.fq.gz", members[:-1000], compress=False)
+            self.assertIn("the last member ends at byte", fastq_preflight.check_tail(path))
+            # no member starts in the window, the trailer is compared with the estimated size
+            path = self.__write("R1/c_1.fq.gz", single, compress=False)
+            self.assertIsNone(fastq_preflight.check_tail(path, 4 * 5000 * 110))
+            self.assertIsNone(fastq_preflight.scan_fastq(path, sample_reads=100, verify=False)[0].error)
+            path = self.__write("R1/d_1.fq.gz", single[:-1000], compress=False)
+            self.assertIn("does not match the estimated size", fastq_preflight.check_tail(path, 4 * 5000 * 110))
+
+    def test_estimate(self):
+        """the quick estimate is close to the exact count"""
+        path = self.__write("R1/a_1.fq.gz", fastq_records(20000, 1))
+        with mock.patch.object(fastq_preflight, 'BLOCK_SIZE', 4096):
+            scan, names = fastq_preflight.scan_fastq(path, sample_reads=2000, verify=False)
+        self.assertFalse(scan.exact)
+        self.assertAlmostEqual(20000, scan.reads, delta=1000)
+        self.assertEqual(2000, len(names))
+
+    def test_sync(self):
+        first = self.__write("R1/a_1.fq.gz", fastq_records(100, 1))
+        second = self.__write("R1/a_2.fq.gz", fastq_records(100, 2))
+        self.assertEqual([], fastq_preflight.scan_pair(("R1", first, second), sample_reads=10).errors)
+        shifted = self.__write("R1/b_2.fq.gz", fastq_records(100, 2, first=1))
+        self.assertIn("mates out of sync at read 1: 'read0' in R1, 'read1' in R2",
+                      fastq_preflight.scan_pair(("R1", first, shifted)).errors[0])
+        # a mate that is missing reads after the sample
+        shorter = self.__write("R1/c_2.fq.gz", fastq_records(90, 2))
+        self.assertIn("100 reads in R1, 90 in R2",
+                      fastq_preflight.scan_pair(("R1", first, shorter), sample_reads=10).errors[0])
+
+    def test_run_preflight(self):
+        """scan of the data folders of a configuration and their forecast"""
+        self.__write("R1/a_1.fq.gz", fastq_records(1000, 1))
+        self.__write("R1/a_2.fq.gz", fastq_records(1000, 2))
+        self.__write("R2/b_1.fq.gz", fastq_records(500, 1))
+        truncated = self.__write("R3/c_1.fq.gz", gzip.compress(fastq_records(1000, 1))[:-100], compress=False)
+        os.makedirs(os.path.join(self.tmpdir, "R4"))
+        config = {"input_dir": self.tmpdir, "fastq_patterns": ["*_{{readnum}}.fq.*"],
+                  "preflight": {"workers": 2, "sample_reads": 100, "threads": 4}}
+        # the quick mode of the submit host only reads the samples and the ends of the files
+        with mock.patch.object(fastq_preflight, 'scan_pairs', wraps=fastq_preflight.scan_pairs) as scan_pairs:
+            errors = sorted(fastq_preflight.run_preflight(config, "star_salmon", io.StringIO()))
+        self.assertEqual((2, 100, False), scan_pairs.call_args[0][1:])
+        self.assertTrue(errors[0].startswith(truncated + ": truncated gzip stream"))
+        self.assertEqual("R4: no FASTQ files found", errors[1])
+        config["preflight"]["verify"] = True
+        outfile = io.StringIO()
+        errors = sorted(fastq_preflight.run_preflight(config, "star_salmon", outfile))
+        self.assertEqual(2, len(errors))
+        self.assertTrue(errors[0].startswith(truncated + ": truncated gzip stream"))
+        self.assertEqual("R4: no FASTQ files found", errors[1])
+        report = outfile.getvalue()
+        self.assertIn("Preflight of 3 FASTQ file set(s) in 4 data folder(s)", report)
+        self.assertIn("R1: 1 file set(s), 0.00M fragments, 0.00 Gbases", report)
+        self.assertIn("a_2.fq.gz: 0.00M reads, length 90-100, median 100", report)
+
+        scans = fastq_preflight.scan_pairs([("R1", os.path.join(self.tmpdir, "R1/a_1.fq.gz"),
+                                             os.path.join(self.tmpdir, "R1/a_2.fq.gz"))], workers=1)
+        result = fastq_preflight.forecast(scans, "star_salmon", threads=1)
+        self.assertEqual(1000, result.fragments)
+        self.assertEqual(2 * 1000 * 97.5, result.bases)
+        self.assertAlmostEqual(1000 * (1 / 8000 + 1 / 5000 + 1 / 50000) / 3600, result.hours)
+        self.assertGreater(result.disk, fastq_preflight.forecast(scans, "kallisto").disk)
+
+    def test_submit_host_defaults(self):
+        """without options, gs_prepare runs the quick mode with a few processes"""
+        config = {"input_dir": self.tmpdir, "preflight": True}
+        with mock.patch.object(fastq_preflight, 'scan_pairs', return_value=[]) as scan_pairs:
+            fastq_preflight.run_preflight(config, "kallisto", io.StringIO())
+        self.assertEqual(([], fastq_preflight.SUBMIT_HOST_WORKERS, fastq_preflight.SAMPLE_READS, False),
+                         scan_pairs.call_args[0])
+
+
+if __name__ == '__main__':
+    SUITE = []
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(FastqPreflightTest))
+    if len(sys.argv) > 1 and sys.argv[1] == 'xml':
+        xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
+    else:
+        unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+"""
+find_files_benchmark.py - Compare the single walk FASTQ finder with the legacy
+glob based finder on a synthetic input tree
+
+Usage: PYTHONPATH=. test/find_files_benchmark.py [--files N] [--osfs]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+import fs
+import globalsearch.rnaseq.find_files as find_files
+
+
+PATTERNS = ["*_{{readnum}}.fq.*", "*_{{readnum}}.fastq.*", "*_R{{readnum}}_001.fastq.gz"]
+
+
+def make_tree(filesys, num_files, fanout=20):
+    """Create a deep raw_data hierarchy below /inputdata/R1 with roughly num_files
+    files, most of them not FASTQ files"""
+    folder = "/inputdata/R1"
+    count = 0
+    lane = 0
+    while count < num_files:
+        lane_dir = fs.path.combine(folder, "raw_data/batch%d/run%d/lane%d" % (lane // 100, lane // 10, lane))
+        filesys.makedirs(lane_dir, recreate=True)
+        for readnum in [1, 2]:
+            filesys.touch(fs.path.combine(lane_dir, "S%d_L%d_R%d_001.fastq.gz" % (lane, lane, readnum)))
+        for i in range(fanout - 2):
+            filesys.touch(fs.path.combine(lane_dir, "S%d_L%d_%d.md5" % (lane, lane, i)))
+        count += fanout
+        lane += 1
+    return folder, count
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="benchmark FASTQ discovery")
+    parser.add_argument('--files', type=int, default=10000, help="number of files in the synthetic tree")
+    parser.add_argument('--osfs', action='store_true', help="benchmark on a temporary directory instead of mem://")
+    args = parser.parse_args()
+
+    if args.osfs:
+        tmpdir = tempfile.TemporaryDirectory()
+        filesys = fs.open_fs(tmpdir.name)
+    else:
+        filesys = fs.open_fs("mem://")
+    data_folder, num_files = make_tree(filesys, args.files)
+    print("synthetic tree: %d files" % num_files)
+
+    legacy, legacy_time = timed(find_files._find_fastq_files, data_folder, PATTERNS, filesys)
+    indexed, indexed_time = timed(find_files._find_fastq_files_indexed, data_folder, PATTERNS, filesys)
+    print("legacy finder:      %8.3f s, %d pair(s)" % (legacy_time, len(legacy)))
+    print("single walk finder: %8.3f s, %d pair(s)" % (indexed_time, len(indexed)))
+    print("speedup: %.1fx" % (legacy_time / indexed_time))
+    filesys.close()
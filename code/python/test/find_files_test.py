@@ -5,6 +5,8 @@ find_files_test.py - Unit tests for the globalsearch.rnaseq.find_files module
 """
 
 import unittest
+import re
+import warnings
 import xmlrunner
 import os, sys
 import fs
@@ -38,6 +40,17 @@ class FindFilesTest(unittest.TestCase):
         result = find_files.rnaseq_data_folder_list(config, filesys=self.mem_fs)
         self.assertEqual(result, ['R1', 'R2'])
 
+    def test_rnaseq_data_folder_list_scandir_threaded(self):
+        """threaded scanning keeps the listing order and reports the throughput"""
+        self.__make_input_folder(20)
+        self.mem_fs.touch("inputdata/README.txt")
+        stats = {}
+        config = {'input_dir': '/inputdata', 'scan_threads': 4}
+        result = find_files.rnaseq_data_folder_list(config, filesys=self.mem_fs, stats=stats)
+        self.assertEqual(result, [d for d in self.mem_fs.listdir('/inputdata') if d != 'README.txt'])
+        self.assertEqual(21, stats['entries'])
+        self.assertTrue(stats['entries_per_second'] > 0)
+
     def test_rnaseq_data_folder_list_includes(self):
         self.__make_input_folder(2)
         config = {'input_dir': '/inputdata', 'includes': ['R11', 'R12']}
@@ -75,6 +88,53 @@ class FindFilesTest(unittest.TestCase):
                                              filesys=self.mem_fs)
         self.assertEqual(result, [('/inputdata/R1/R1_1.fq.gz', '/inputdata/R1/R1_2.fq.gz')])
 
+    def test_find_fastq_files_multi_lane(self):
+        """all lanes of a folder are found and paired up"""
+        self.mem_fs.makedirs("inputdata/R1/raw_data/L1")
+        self.mem_fs.makedirs("inputdata/R1/raw_data/L2")
+        for lane in ["L1", "L2"]:
+            for readnum in [1, 2]:
+                self.mem_fs.touch("inputdata/R1/raw_data/%s/R1_%s_%d.fq.gz" % (lane, lane, readnum))
+        result = find_files.find_fastq_files("/inputdata/R1", ["*_{{readnum}}.fq.*"], filesys=self.mem_fs)
+        self.assertEqual(result, [
+            ('/inputdata/R1/raw_data/L1/R1_L1_1.fq.gz', '/inputdata/R1/raw_data/L1/R1_L1_2.fq.gz'),
+            ('/inputdata/R1/raw_data/L2/R1_L2_1.fq.gz', '/inputdata/R1/raw_data/L2/R1_L2_2.fq.gz')])
+
+    def test_find_fastq_files_overlapping_patterns(self):
+        """a file matching several patterns is only reported for the first one"""
+        self.__make_input_folder(1)
+        result = find_files.find_fastq_files("/inputdata/R1",
+                                             ["*_{{readnum}}.fq.*", "*_{{readnum}}.fq*"],
+                                             filesys=self.mem_fs)
+        self.assertEqual(result, [('/inputdata/R1/R1_1.fq.gz', '/inputdata/R1/R1_2.fq.gz')])
+
+    def test_find_fastq_files_same_as_legacy(self):
+        """the single walk finder agrees with the legacy finder on single pair folders"""
+        self.__make_input_folder(2, pattern="S%d_R%d_001.fastq.gz")
+        patterns = ["*_R{{readnum}}_001.fastq.gz", "*_{{readnum}}.fq.*"]
+        self.assertEqual(find_files._find_fastq_files("/inputdata/R2", patterns, self.mem_fs),
+                         find_files.find_fastq_files("/inputdata/R2", patterns, filesys=self.mem_fs))
+
+    def test_translate_glob(self):
+        """the pattern translation matches the same files as the PyFS glob"""
+        self.assertEqual(r'.*/?/[^/]*_[12]\.fq[^/]\[!\]', find_files._translate_glob('/**/*_[12].fq?[!]'))
+        for path in ["R1/a_1.fq.gz", "R1/lane1/a_2.fq.gz", "R1/a_3.fq.gz", "R1/b_1.fastq", "R1/[x]_1.fq.gz",
+                     "R1/lane2/deep/c_R1_001.fastq.gz", "R1/c_R2_001.fastq.bz2"]:
+            self.mem_fs.makedirs(fs.path.dirname(fs.path.combine("inputdata", path)), recreate=True)
+            self.mem_fs.touch(fs.path.combine("inputdata", path))
+        filesys = self.mem_fs.opendir("inputdata/R1")
+        for pattern in ["*_[12].fq.*", "*_[!1].fq*", "*.fastq", "*_R?_001.fastq.gz", "lane*/*", "[[]x]_1.fq.gz",
+                        "*_R[1-2]_00[0-9].fastq.*"]:
+            glob_path = fs.path.combine('/**', pattern)
+            with warnings.catch_warnings():
+                # the translated pattern has no nested sets
+                warnings.simplefilter('error')
+                regex = re.compile('(?ms)^%s$' % find_files._translate_glob(glob_path))
+            with warnings.catch_warnings():
+                # but the PyFS translation of "[[]x]" has
+                warnings.simplefilter('ignore', FutureWarning)
+                expected = sorted(match.path for match in filesys.glob(glob_path) if not match.info.is_dir)
+            self.assertEqual(expected, sorted(path for path in filesys.walk.files() if regex.match(path)), pattern)
 
     #
     # TEST FOR SINGLE READ SETUPS
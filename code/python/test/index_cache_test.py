@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+"""
+index_cache_test.py - Unit tests for the globalsearch.rnaseq.index_cache module
+"""
+
+import unittest
+import xmlrunner
+import os, sys
+import shutil
+import tempfile
+import threading
+import time
+import json
+from unittest import mock
+import globalsearch.rnaseq.index_cache as index_cache
+from globalsearch.rnaseq.index_cache import index_key, cached_index, resolve_index
+
+
+class IndexCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_root = tempfile.mkdtemp()
+        self.fasta = os.path.join(self.cache_root, "genome.fasta")
+        self.__write_fasta("ACGT")
+        self.builds = []
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_root)
+
+    def __write_fasta(self, sequence):
+        with open(self.fasta, 'w') as outfile:
+            outfile.write(">chr1\n%s\n" % sequence)
+
+    def __build(self, path):
+        self.builds.append(path)
+        os.makedirs(path)
+        with open(os.path.join(path, "SA"), 'w') as outfile:
+            outfile.write("index")
+
+    def test_index_key(self):
+        """the key changes with the input content, the parameters and the tool version"""
+        key = index_key([self.fasta], {'genomeSAindexNbases': 12}, '2.7.10a', self.cache_root)
+        self.assertEqual(key, index_key([self.fasta], {'genomeSAindexNbases': 12}, '2.7.10a', self.cache_root))
+        self.assertNotEqual(key, index_key([self.fasta], {'genomeSAindexNbases': 14}, '2.7.10a'))
+        self.assertNotEqual(key, index_key([self.fasta], {'genomeSAindexNbases': 12}, '2.7.11b'))
+        self.__write_fasta("ACGTACGT")
+        self.assertNotEqual(key, index_key([self.fasta], {'genomeSAindexNbases': 12}, '2.7.10a', self.cache_root))
+
+    def test_cache_hit(self):
+        """an index is only built once and the link points to it"""
+        path = cached_index(self.cache_root, 'star_index', 'abc', self.__build)
+        self.assertEqual(path, cached_index(self.cache_root, 'star_index', 'abc', self.__build))
+        self.assertEqual(1, len(self.builds))
+        self.assertEqual(os.path.join(self.cache_root, 'star_index.abc'), path)
+        self.assertEqual('star_index.abc', os.readlink(resolve_index(self.cache_root, 'star_index')))
+        self.assertFalse(os.path.exists(path + '.tmp'))
+
+    def test_link_follows_key(self):
+        cached_index(self.cache_root, 'star_index', 'abc', self.__build)
+        cached_index(self.cache_root, 'star_index', 'def', self.__build)
+        self.assertEqual('star_index.def', os.readlink(os.path.join(self.cache_root, 'star_index')))
+        cached_index(self.cache_root, 'star_index', 'abc', self.__build)
+        self.assertEqual('star_index.abc', os.readlink(os.path.join(self.cache_root, 'star_index')))
+        self.assertEqual(2, len(self.builds))
+
+    def test_legacy_index_and_interrupted_build(self):
+        """an index directory from before the cache and a partial build are replaced"""
+        os.makedirs(os.path.join(self.cache_root, 'star_index'))
+        os.makedirs(os.path.join(self.cache_root, 'star_index.abc.tmp', 'partial'))
+        path = cached_index(self.cache_root, 'star_index', 'abc', self.__build)
+        self.assertTrue(os.path.islink(os.path.join(self.cache_root, 'star_index')))
+        self.assertEqual(["SA"], os.listdir(path))
+
+    def test_failed_build(self):
+        def failing_build(path):
+            os.makedirs(path)
+            raise RuntimeError("out of memory")
+        with self.assertRaises(RuntimeError):
+            cached_index(self.cache_root, 'star_index', 'abc', failing_build)
+        self.assertIsNone(resolve_index(self.cache_root, 'star_index'))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_root, 'star_index.abc')))
+
+    def test_concurrent_builds(self):
+        """tasks that request the same index at the same time share one build"""
+        def slow_build(path):
+            time.sleep(0.2)
+            self.__build(path)
+        threads = [threading.Thread(target=cached_index, args=(self.cache_root, 'star_index', 'abc', slow_build))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(1, len(self.builds))
+
+    def test_concurrent_digests(self):
+        """concurrent tasks keep each other's memo entries and hash every file once"""
+        paths = []
+        for i in range(4):
+            paths.append(os.path.join(self.cache_root, "input%d.fa" % i))
+            with open(paths[-1], 'w') as outfile:
+                outfile.write(">chr%d\nACGT\n" % i)
+        hash_file = index_cache._hash_file
+        def slow_hash(path):
+            time.sleep(0.05)
+            return hash_file(path)
+        with mock.patch.object(index_cache, '_hash_file', side_effect=slow_hash) as hashed:
+            threads = [threading.Thread(target=index_cache.file_digest, args=(path, self.cache_root))
+                       for path in paths * 2]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(4, hashed.call_count)
+        with open(os.path.join(self.cache_root, index_cache.DIGEST_MEMO)) as infile:
+            self.assertEqual(sorted(os.path.realpath(path) for path in paths), sorted(json.load(infile)))
+
+
+if __name__ == '__main__':
+    SUITE = []
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(IndexCacheTest))
+    if len(sys.argv) > 1 and sys.argv[1] == 'xml':
+        xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
+    else:
+        unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
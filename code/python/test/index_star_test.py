@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+"""
+index_star_test.py - Unit tests for the globalsearch.rnaseq.index_star module
+and the use of annotated indexes in run_star
+"""
+
+import unittest
+import xmlrunner
+import argparse
+import os, sys
+import shutil
+import tempfile
+from unittest import mock
+import globalsearch.rnaseq.index_star as index_star
+import globalsearch.rnaseq.run_star_salmon as run_star_salmon
+
+
+def index_args(**kwargs):
+    args = dict(runThreadN=8, genomeChrBinNbits=16, genomeSAindexNbases=12, genome_gff=None, sjdbFileChrStartEnd=None,
+                sjdbOverhang=100, limitSjdbInsertNsj=1602710, sjdbGTFfeatureExon=None,
+                sjdbGTFtagExonParentTranscript=None, sjdbGTFtagExonParentGene=None)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def star_args(**kwargs):
+    args = dict(starPrefix='star', runThreadN=8, limitBAMsortRAM=1000, outFilterMismatchNmax=10,
+                outFilterMismatchNoverLmax=0.3, outFilterScoreMinOverLread=0.66, outFilterMatchNmin=0,
+                twopassMode=False, first_pass=False, outSAMattributes="Standard", genome_gff=None,
+                sjdbGTFtagExonParentTranscript="Parent", limitSjdbInsertNsj=1602710, sjdbOverhang=None,
+                sjdbGTFfeatureExon=None, sjdbGTFtagExonParentGene=None, quantMode=None)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+class IndexStarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.genome_dir = tempfile.mkdtemp()
+        self.genome_gff = os.path.join(self.genome_dir, "genome.gff3")
+        with open(self.genome_gff, 'w') as outfile:
+            outfile.write("##gff-version 3\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.genome_dir)
+
+    def __index_command(self, args):
+        with mock.patch.object(index_star.subprocess, 'run') as run:
+            index_star.create_genome_index(self.genome_dir, "genome.fasta", args)
+        return run.call_args[0][0]
+
+    def __star_command(self, args):
+        with mock.patch.object(run_star_salmon.subprocess, 'run') as run:
+            run_star_salmon.run_star("R1_1.fq.gz", "R1_2.fq.gz", self.genome_dir, "R1", self.genome_dir, args)
+        command = run.call_args[0][0]
+        return command, command[command.index("--genomeLoad") + 1]
+
+    def test_index_with_annotation(self):
+        """the annotation and its options are passed to STAR at index time"""
+        command = self.__index_command(index_args(genome_gff=self.genome_gff, sjdbOverhang=149,
+                                                  sjdbGTFtagExonParentTranscript="Parent",
+                                                  sjdbGTFtagExonParentGene="gene_id"))
+        self.assertEqual(self.genome_gff, command[command.index('--sjdbGTFfile') + 1])
+        self.assertEqual('149', command[command.index('--sjdbOverhang') + 1])
+        self.assertEqual('Parent', command[command.index('--sjdbGTFtagExonParentTranscript') + 1])
+        self.assertEqual('gene_id', command[command.index('--sjdbGTFtagExonParentGene') + 1])
+
+    def test_index_without_annotation(self):
+        command = self.__index_command(index_args(sjdbGTFtagExonParentTranscript="Parent"))
+        self.assertNotIn('--sjdbGTFfile', command)
+        self.assertNotIn('--sjdbGTFtagExonParentGene', command)
+
+    def test_star_gff_without_annotated_index(self):
+        """junctions are inserted on the fly, which needs a private genome"""
+        command, genome_load = self.__star_command(star_args(genome_gff=self.genome_gff))
+        self.assertEqual("NoSharedMemory", genome_load)
+        self.assertIn('--sjdbGTFfile', command)
+
+    def test_star_annotated_index(self):
+        """with an annotated index, the GFF is not needed and the genome is shared"""
+        with open(os.path.join(self.genome_dir, index_star.ANNOTATION_SJDB_FILE), 'w') as outfile:
+            outfile.write("chr1\t100\t200\t+\n")
+        command, genome_load = self.__star_command(star_args(genome_gff=self.genome_gff,
+                                                             sjdbGTFtagExonParentGene="gene_id"))
+        self.assertEqual("LoadAndKeep", genome_load)
+        self.assertNotIn('--sjdbGTFfile', command)
+        self.assertNotIn('--sjdbGTFtagExonParentGene', command)
+
+
+    def test_uses_shared_genome(self):
+        self.assertTrue(run_star_salmon.uses_shared_genome(self.genome_dir, star_args()))
+        self.assertFalse(run_star_salmon.uses_shared_genome(self.genome_dir, star_args(twopassMode=True)))
+        self.assertFalse(run_star_salmon.uses_shared_genome(self.genome_dir, star_args(genome_gff=self.genome_gff)))
+        with open(os.path.join(self.genome_dir, index_star.ANNOTATION_SJDB_FILE), 'w') as outfile:
+            outfile.write("chr1\t100\t200\t+\n")
+        self.assertTrue(run_star_salmon.uses_shared_genome(self.genome_dir, star_args(genome_gff=self.genome_gff)))
+
+if __name__ == '__main__':
+    SUITE = []
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(IndexStarTest))
+    if len(sys.argv) > 1 and sys.argv[1] == 'xml':
+        xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
+    else:
+        unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+"""
+kallisto_batch_test.py - Unit tests for the globalsearch.rnaseq.kallisto_batch module
+"""
+
+import unittest
+import xmlrunner
+import json
+import os, sys
+import shutil
+import subprocess
+import tempfile
+from unittest import mock
+import numpy as np
+import globalsearch.rnaseq.kallisto_batch as kallisto_batch
+
+TRANSCRIPTOME = ">t1 gene1\nACGTACGTAC\n>t2\nACGTACGTACGTACGTACGT\n>t3\nACGTA\n"
+
+
+def write_matrix(path, rows, cols, entries):
+    with open(path, 'w') as outfile:
+        outfile.write("%%MatrixMarket matrix coordinate real general\n%comment\n")
+        outfile.write("%d %d %d\n" % (rows, cols, len(entries)))
+        for entry in entries:
+            outfile.write("%d %d %g\n" % entry)
+
+
+class KallistoBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.transcriptome = os.path.join(self.tmpdir, "transcriptome.fasta")
+        with open(self.transcriptome, 'w') as outfile:
+            outfile.write(TRANSCRIPTOME)
+        self.batch_dir = os.path.join(self.tmpdir, "batch")
+        self.samples = [(os.path.join(self.tmpdir, "F1", name), ["%s_1.fq.gz" % name, "%s_2.fq.gz" % name])
+                        for name in ["A", "B"]]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def fake_kallisto(self, command, **kwargs):
+        """writes the matrices for the samples in the batch file, in reverse order"""
+        batch_file = command[command.index('-b') + 1]
+        with open(batch_file) as infile:
+            cells = [line.split('\t')[0] for line in infile][::-1]
+        with open(os.path.join(self.batch_dir, kallisto_batch.CELLS_FILE), 'w') as outfile:
+            outfile.write('\n'.join(cells) + '\n')
+        with open(os.path.join(self.batch_dir, kallisto_batch.TRANSCRIPTS_FILE), 'w') as outfile:
+            outfile.write("t1\nt2\nt3\n")
+        entries = [(row + 1, 1, 10 * int(cell[1:]) + 10) for row, cell in enumerate(cells)]
+        entries.append((1, 2, 20))
+        write_matrix(os.path.join(self.batch_dir, kallisto_batch.COUNTS_MATRIX), len(cells), 3, entries)
+        return subprocess.CompletedProcess(command, 0)
+
+    def __read_abundance(self, sample_dir):
+        with open(os.path.join(sample_dir, kallisto_batch.ABUNDANCE_FILE)) as infile:
+            return [line.rstrip('\n').split('\t') for line in infile]
+
+    def test_batch_file(self):
+        path = os.path.join(self.tmpdir, "batch.txt")
+        kallisto_batch.write_batch_file(path, self.samples)
+        with open(path) as infile:
+            self.assertEqual(["s0\tA_1.fq.gz\tA_2.fq.gz\n", "s1\tB_1.fq.gz\tB_2.fq.gz\n"], infile.readlines())
+
+    def test_read_matrix_market(self):
+        path = os.path.join(self.tmpdir, "matrix.mtx")
+        write_matrix(path, 3, 2, [(1, 2, 1.5), (3, 1, 2)])
+        expected = np.array([[0, 1.5], [0, 0], [2, 0]])
+        self.assertTrue((expected == kallisto_batch.read_matrix_market(path, (3, 2))).all())
+        # samples as columns
+        self.assertTrue((expected.T == kallisto_batch.read_matrix_market(path, (2, 3))).all())
+        with self.assertRaises(ValueError):
+            kallisto_batch.read_matrix_market(path, (4, 2))
+
+    def test_tpm(self):
+        result = kallisto_batch.tpm(np.array([[10.0, 20.0], [0.0, 0.0]]), np.array([10, 20]))
+        self.assertEqual([5e5, 5e5], list(result[0]))
+        self.assertEqual([0, 0], list(result[1]))
+
+    def test_run_batch(self):
+        """one kallisto process for all samples, the results are split into the sample directories"""
+        with mock.patch.object(kallisto_batch.subprocess, 'run', side_effect=self.fake_kallisto) as run:
+            kallisto_batch.run_kallisto_batch("index", self.batch_dir, self.samples, self.transcriptome, threads=8)
+        run.assert_called_once()
+        self.assertEqual(['kallisto', 'pseudo', '--quant'], run.call_args[0][0][:3])
+        rows_a = self.__read_abundance(self.samples[0][0])
+        self.assertEqual(kallisto_batch.ABUNDANCE_HEADER.strip().split('\t'), rows_a[0])
+        self.assertEqual(['t1', '10', '10', '10.0', '1000000.0'], rows_a[1])
+        self.assertEqual(['t2', '20', '20', '0.0', '0.0'], rows_a[2])
+        self.assertEqual(['t2', '20', '20', '20.0', '333333.3333333333'], self.__read_abundance(self.samples[1][0])[2])
+        self.assertFalse(os.path.exists(self.batch_dir))
+        # batch results are marked, they have no bootstraps and no bias correction
+        self.assertTrue(kallisto_batch.is_batch_result(self.samples[0][0]))
+        with open(os.path.join(self.samples[0][0], kallisto_batch.BATCH_MARKER)) as infile:
+            marker = json.load(infile)
+        self.assertTrue(marker['call'].startswith('kallisto pseudo --quant'))
+        self.assertEqual(0, marker['n_bootstraps'])
+        self.assertEqual('estimated counts per transcript length', marker['tpm'])
+
+    def test_full_precision(self):
+        path = os.path.join(self.tmpdir, "abundance.tsv")
+        kallisto_batch.write_abundance(path, ["t1"], np.array([600]), np.array([1234567.8]), np.array([0.1]))
+        with open(path) as infile:
+            self.assertEqual("t1\t600\t600\t1234567.8\t0.1\n", infile.readlines()[1])
+
+    def test_failed_batch_removed(self):
+        """the batch directory is not left in the output folder"""
+        error = subprocess.CalledProcessError(1, 'kallisto')
+        with mock.patch.object(kallisto_batch.subprocess, 'run', side_effect=error):
+            with self.assertRaises(subprocess.CalledProcessError):
+                kallisto_batch.run_kallisto_batch("index", self.batch_dir, self.samples, self.transcriptome)
+        self.assertFalse(os.path.exists(self.batch_dir))
+        self.assertFalse(os.path.exists(self.samples[0][0]))
+
+    def test_finished_samples_skipped(self):
+        os.makedirs(self.samples[0][0])
+        with mock.patch.object(kallisto_batch.subprocess, 'run', side_effect=self.fake_kallisto) as run:
+            kallisto_batch.run_kallisto_batch("index", self.batch_dir, self.samples, self.transcriptome)
+            self.assertEqual([], os.listdir(self.samples[0][0]))
+            self.assertTrue(os.path.exists(os.path.join(self.samples[1][0], kallisto_batch.ABUNDANCE_FILE)))
+            os.makedirs(self.samples[1][0], exist_ok=True)
+            kallisto_batch.run_kallisto_batch("index", self.batch_dir, self.samples, self.transcriptome)
+        run.assert_called_once()
+
+
+if __name__ == '__main__':
+    SUITE = []
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(KallistoBatchTest))
+    if len(sys.argv) > 1 and sys.argv[1] == 'xml':
+        xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
+    else:
+        unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+"""
+kallisto_bootstrap_test.py - Unit tests for the globalsearch.rnaseq.kallisto_bootstrap module
+"""
+
+import unittest
+import xmlrunner
+import os, sys
+import shutil
+import tempfile
+import h5py
+import numpy as np
+import globalsearch.rnaseq.kallisto_bootstrap as kallisto_bootstrap
+import globalsearch.rnaseq.matrix_h5 as matrix_h5
+
+IDS = [b"t1", b"t2", b"t3"]
+
+
+class KallistoBootstrapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def __write_abundance(self, folder, bootstraps, ids=IDS):
+        path = os.path.join(self.tmpdir, folder, "abundance.h5")
+        os.makedirs(os.path.dirname(path))
+        bootstraps = np.array(bootstraps, dtype=np.float64)
+        with h5py.File(path, 'w') as outfile:
+            outfile.create_dataset("aux/ids", data=ids)
+            outfile.create_dataset("est_counts", data=np.full(len(ids), 1e9))
+            group = outfile.create_group("bootstrap")
+            for index, values in enumerate(bootstraps):
+                group.create_dataset("bs%d" % index, data=values, compression='gzip')
+        return path
+
+    def test_summary(self):
+        """the variance is exact for large counts"""
+        bootstraps = [[10, 0, 1e9 + 1], [20, 0, 1e9 + 2], [60, 0, 1e9 + 3]]
+        path = self.__write_abundance("S1", bootstraps)
+        digest, mean, variance, infrv = kallisto_bootstrap.bootstrap_summary(path, block_rows=2)
+        np.testing.assert_allclose([30, 0, 1e9 + 2], mean)
+        np.testing.assert_allclose([700, 0, 1], variance)
+        np.testing.assert_allclose([670 / 35 + 0.01, 0.01, 0.01], infrv)
+
+    def test_summarize_bootstraps(self):
+        paths = [self.__write_abundance("S%d" % i, [[i, 2 * i, 0], [i + 2, 2 * i, 0]]) for i in range(5)]
+        paths.append(self.__write_abundance("S5", []))
+        out_path = os.path.join(self.tmpdir, "bootstraps.h5")
+        samples = kallisto_bootstrap.sample_names(paths, self.tmpdir)
+        kallisto_bootstrap.summarize_bootstraps(paths, samples, out_path, workers=2, block_samples=2)
+        gene_ids, samples, mean = matrix_h5.read_matrix(out_path, "mean")
+        self.assertEqual(["t1", "t2", "t3"], gene_ids)
+        self.assertEqual(["S0", "S1", "S2", "S3", "S4", "S5"], samples)
+        np.testing.assert_allclose([1, 2, 3, 4, 5, np.nan], mean[0])
+        np.testing.assert_allclose([0, 2, 4, 6, 8, np.nan], mean[1])
+        gene_ids, samples, variance = matrix_h5.read_matrix(out_path, "variance", samples=["S3"])
+        np.testing.assert_allclose([[2], [0], [0]], variance)
+        self.assertEqual((3, 6), matrix_h5.read_matrix(out_path, "InfRV")[2].shape)
+
+    def test_other_index(self):
+        paths = [self.__write_abundance("S1", [[1, 2, 3]]), self.__write_abundance("S2", [[1, 2]], ids=IDS[:2])]
+        out_path = os.path.join(self.tmpdir, "bootstraps.h5")
+        with self.assertRaises(ValueError):
+            kallisto_bootstrap.summarize_bootstraps(paths, ["S1", "S2"], out_path, workers=1)
+        self.assertFalse(os.path.exists(out_path))
+        self.assertFalse(os.path.exists(out_path + ".tmp"))
+
+
+if __name__ == '__main__':
+    SUITE = []
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(KallistoBootstrapTest))
+    if len(sys.argv) > 1 and sys.argv[1] == 'xml':
+        xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
+    else:
+        unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
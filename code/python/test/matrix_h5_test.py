@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+"""
+matrix_h5_test.py - Unit tests for the globalsearch.rnaseq.matrix_h5 module
+"""
+
+import unittest
+import xmlrunner
+import os, sys
+import shutil
+import tempfile
+from unittest import mock
+import numpy as np
+import globalsearch.rnaseq.matrix_h5 as matrix_h5
+
+GENE_IDS = ["Past_g%d" % i for i in range(7)] + ["Smic_g%d" % i for i in range(3)]
+SAMPLES = ["R%d" % i for i in range(9)]
+
+
+class MatrixH5Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "matrices.h5")
+        self.tpm = np.arange(len(GENE_IDS) * len(SAMPLES), dtype=np.float64).reshape(len(GENE_IDS), len(SAMPLES))
+        self.tpm[3, 4] = np.nan
+        # small chunks so that the selections span several of them
+        with mock.patch.multiple(matrix_h5, CHUNK_ROWS=4, CHUNK_COLS=2):
+            matrix_h5.write_matrices(self.path, GENE_IDS, SAMPLES, {"TPM": self.tpm, "NumReads": self.tpm * 2},
+                                     {"Past": range(7), "Smic": [7, 8, 9]})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_all(self):
+        self.assertEqual(["matrices.h5"], os.listdir(self.tmpdir))
+        self.assertEqual((GENE_IDS, SAMPLES), matrix_h5.read_index(self.path))
+        gene_ids, samples, matrix = matrix_h5.read_matrix(self.path, "NumReads")
+        self.assertEqual(GENE_IDS, gene_ids)
+        self.assertEqual(SAMPLES, samples)
+        np.testing.assert_array_equal(self.tpm * 2, matrix)
+
+    def test_read_subset(self):
+        """genes and samples are returned in the requested order"""
+        gene_ids, samples, matrix = matrix_h5.read_matrix(self.path, "TPM", genes=["Smic_g1", "Past_g3", "Past_g0"],
+                                                          samples=["R8", "R4", "R0", "R5"])
+        self.assertEqual(["Smic_g1", "Past_g3", "Past_g0"], gene_ids)
+        self.assertEqual(["R8", "R4", "R0", "R5"], samples)
+        np.testing.assert_array_equal(self.tpm[[8, 3, 0]][:, [8, 4, 0, 5]], matrix)
+
+    def test_read_samples(self):
+        gene_ids, samples, matrix = matrix_h5.read_matrix(self.path, "TPM", samples=["R7", "R1", "R7"])
+        self.assertEqual(GENE_IDS, gene_ids)
+        np.testing.assert_array_equal(self.tpm[:, [7, 1, 7]], matrix)
+
+    def test_read_organism(self):
+        gene_ids, samples, matrix = matrix_h5.read_matrix(self.path, "TPM", organism="Smic", samples=["R2"])
+        self.assertEqual(["Smic_g0", "Smic_g1", "Smic_g2"], gene_ids)
+        np.testing.assert_array_equal(self.tpm[7:, [2]], matrix)
+        gene_ids, samples, matrix = matrix_h5.read_matrix(self.path, "TPM", organism="Smic", genes=["Past_g1"])
+        self.assertEqual((0, 9), matrix.shape)
+
+    def test_unknown_names(self):
+        with self.assertRaises(KeyError):
+            matrix_h5.read_matrix(self.path, "TPM", samples=["R99"])
+        with self.assertRaises(ValueError):
+            matrix_h5.write_matrices(self.path, GENE_IDS, SAMPLES[1:], {"TPM": self.tpm})
+
+
+if __name__ == '__main__':
+    SUITE = []
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(MatrixH5Test))
+    if len(sys.argv) > 1 and sys.argv[1] == 'xml':
+        xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
+    else:
+        unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
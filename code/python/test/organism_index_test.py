@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+"""
+organism_index_test.py - Unit tests for the globalsearch.rnaseq.organism_index module
+"""
+
+import unittest
+import xmlrunner
+import io
+import os, sys
+import shutil
+import tempfile
+from unittest import mock
+import numpy as np
+import globalsearch.rnaseq.organism_index as organism_index
+
+ORGANISMS = ["past", "smic"]
+GENOME = (">XM_001_past\nACGT\n>Smic123_smic\nACGT\n>past|g7 description\nACGT\n>gene_smic.t1\nACGT\n" +
+          ">orphan\nACGT\n")
+
+
+class OrganismIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fasta = os.path.join(self.tmpdir, "Past_Smic_merged_CDS_suffixed.fasta")
+        with open(self.fasta, 'w') as outfile:
+            outfile.write(GENOME)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_organism_of(self):
+        self.assertEqual(0, organism_index.organism_of("XM_001_past", ORGANISMS))
+        self.assertEqual(1, organism_index.organism_of("smic_gene_past_like", ORGANISMS))
+        self.assertEqual(1, organism_index.organism_of("g1_smic.t2", ORGANISMS))
+        # a suffix tag wins over a substring match of the other organism
+        self.assertEqual(1, organism_index.organism_of("pastlike1_smic", ORGANISMS))
+        self.assertEqual(0, organism_index.organism_of("Pastpast001", ORGANISMS))
+        self.assertEqual(organism_index.UNASSIGNED, organism_index.organism_of("pastsmic1", ORGANISMS))
+        self.assertEqual(organism_index.UNASSIGNED, organism_index.organism_of("orphan", ORGANISMS))
+
+    def test_rows(self):
+        index = organism_index.OrganismIndex(ORGANISMS, self.fasta)
+        gene_ids = ["gene_smic.t1", "orphan", "XM_001_past", "past|g7", "new_smic", "Smic123_smic"]
+        self.assertEqual([1, -1, 0, 0, 1, 1], list(index.route(gene_ids)))
+        rows = index.rows(gene_ids)
+        self.assertEqual([2, 3], list(rows["past"]))
+        self.assertEqual([0, 4, 5], list(rows["smic"]))
+
+    def test_report_unassigned(self):
+        """ids of no or several organisms are in no organism's rows, they are reported"""
+        gene_ids = ["orphan", "a_past", "pastsmic1", "b_smic", "other"]
+        codes = organism_index.OrganismIndex(ORGANISMS).route(gene_ids)
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            self.assertEqual(3, organism_index.report_unassigned(gene_ids, codes, ORGANISMS, num_examples=2))
+        self.assertIn("3 gene id(s) match none or more than one of the organisms past, smic", stdout.getvalue())
+        self.assertIn("e.g. orphan, pastsmic1\n", stdout.getvalue())
+        with mock.patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            self.assertEqual(0, organism_index.report_unassigned(gene_ids[1:2], codes[1:2], ORGANISMS))
+        self.assertEqual("", stdout.getvalue())
+
+    def test_cache(self):
+        organism_index.OrganismIndex(ORGANISMS, self.fasta)
+        path = organism_index.organisms_path(self.fasta)
+        with open(path) as infile:
+            self.assertEqual(["#organisms\tpast\tsmic\n", "XM_001_past\t0\n"], infile.readlines()[:2])
+        # the cached assignments are used as long as they are current
+        with open(path, 'a') as outfile:
+            outfile.write("cached_only\t1\n")
+        self.assertEqual(1, organism_index.OrganismIndex(ORGANISMS, self.fasta).assignments["cached_only"])
+        # other organisms
+        index = organism_index.OrganismIndex(["smic"], self.fasta)
+        self.assertEqual({"XM_001_past": -1, "Smic123_smic": 0, "past|g7": -1, "gene_smic.t1": 0, "orphan": -1},
+                         index.assignments)
+        # a changed FASTA file
+        os.utime(path, (0, 0))
+        index = organism_index.OrganismIndex(["smic"], self.fasta)
+        self.assertNotIn("cached_only", index.assignments)
+
+    def test_no_fasta(self):
+        index = organism_index.OrganismIndex(ORGANISMS)
+        self.assertEqual({"past": [0], "smic": [1]},
+                         {organism: list(rows) for organism, rows in index.rows(["a_past", "b_smic"]).items()})
+        self.assertEqual((0,), index.rows([])["past"].shape)
+
+
+if __name__ == '__main__':
+    SUITE = []
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(OrganismIndexTest))
+    if len(sys.argv) > 1 and sys.argv[1] == 'xml':
+        xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
+    else:
+        unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
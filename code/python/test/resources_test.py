@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+"""
+resources_test.py - Unit tests for the globalsearch.rnaseq.resources module
+"""
+
+import unittest
+import xmlrunner
+import io
+import os, sys
+from unittest import mock
+import globalsearch.rnaseq.resources as resources_module
+from globalsearch.rnaseq.resources import (Resources, StagePlan, available_resources, share_resources, plan_resources,
+                                           split_stage, log_plan, sort_memory_per_thread, without_resource_options,
+                                           STAR_RESOURCE_OPTIONS, GB, MB)
+
+
+class ResourcesTest(unittest.TestCase):
+
+    def test_slurm_allocation(self):
+        resources = available_resources({'SLURM_CPUS_PER_TASK': '16', 'SLURM_MEM_PER_NODE': '65536'})
+        self.assertEqual(Resources(16, 64 * GB, 'slurm'), resources)
+
+    def test_slurm_memory_per_cpu(self):
+        resources = available_resources({'SLURM_JOB_CPUS_PER_NODE': '8(x2)', 'SLURM_MEM_PER_CPU': '2048'})
+        self.assertEqual(Resources(8, 16 * GB, 'slurm'), resources)
+
+    def test_slurm_all_memory(self):
+        """--mem=0 requests all memory of the node, not none"""
+        environ = {'SLURM_CPUS_PER_TASK': '16', 'SLURM_MEM_PER_NODE': '0'}
+        with mock.patch.object(resources_module, 'local_memory', return_value=128 * GB):
+            resources = available_resources(environ)
+        self.assertEqual(Resources(16, 128 * GB, 'slurm'), resources)
+        self.assertEqual(32 * GB, plan_resources(resources)['star'].memory)
+        with mock.patch.object(resources_module, 'local_memory', return_value=None):
+            resources = available_resources(environ)
+        self.assertEqual(Resources(16, None, 'slurm'), resources)
+        plan = plan_resources(resources)
+        self.assertEqual(5784458574, plan['star'].memory)
+        self.assertEqual(8, plan['trim_galore'].workers)
+
+    def test_local_machine(self):
+        resources = available_resources({})
+        self.assertEqual('local', resources.source)
+        self.assertTrue(resources.cpus >= 1)
+
+    def test_share_resources(self):
+        """data folders processed side by side split the allocation"""
+        self.assertEqual(Resources(5, 16 * GB, 'slurm'), share_resources(Resources(16, 48 * GB, 'slurm'), 3))
+        self.assertEqual(Resources(1, None, 'local'), share_resources(Resources(2, None, 'local'), 4))
+
+    def test_plan(self):
+        """every stage fits into the allocation"""
+        plan = plan_resources(Resources(16, 64 * GB, 'slurm'))
+        self.assertEqual(StagePlan(16, 1, 16 * GB), plan['star'])
+        self.assertEqual(StagePlan(2, 8, 16 * GB), plan['trim_galore'])
+        self.assertEqual(StagePlan(16, 1, 32 * GB), plan['dedup'])
+        # STAR, samtools view and samtools sort run side by side
+        self.assertEqual(StagePlan(5, 3, 32 * GB), plan['dedup_streaming'])
+        self.assertEqual(16, plan['salmon'].threads)
+        self.assertEqual(16, plan['kallisto'].threads)
+        self.assertEqual(StagePlan(2, 8, None), plan['spladder_sample'])
+        self.assertEqual(StagePlan(5, 3, None), plan['spladder_test'])
+        self.assertEqual('2048M', sort_memory_per_thread(plan['dedup']))
+
+    def test_split_stage(self):
+        """jobs run side by side as long as each gets its minimum number of threads"""
+        self.assertEqual(StagePlan(5, 3, None), split_stage(StagePlan(16, 1, None), 3, 4))
+        self.assertEqual(StagePlan(4, 4, None), split_stage(StagePlan(16, 1, None), 10, 4))
+        self.assertEqual(StagePlan(2, 1, None), split_stage(StagePlan(2, 1, None), 10, 4))
+
+    def test_plan_explicit_settings(self):
+        """explicitly specified values take precedence"""
+        plan = plan_resources(Resources(16, 64 * GB, 'slurm'), star_threads=32, limit_bam_sort_ram=1000,
+                              trim_cores=4, trim_memory=2)
+        self.assertEqual(StagePlan(32, 1, 1000), plan['star'])
+        self.assertEqual(1, plan['trim_galore'].workers)
+
+    def test_plan_unknown_memory(self):
+        plan = plan_resources(Resources(4, None, 'local'))
+        self.assertEqual(5784458574, plan['star'].memory)
+        self.assertIsNone(sort_memory_per_thread(plan['dedup']))
+
+    def test_log_plan(self):
+        resources = Resources(16, 64 * GB, 'slurm')
+        plan = plan_resources(resources, star_threads=32)
+        out = io.StringIO()
+        log_plan(resources, plan, stages=['star', 'spladder_test'], outfile=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual("Resources (slurm): 16 CPUs, 64.0 GB", lines[0])
+        self.assertIn("oversubscribed by 16 CPUs", lines[1])
+        self.assertIn("1 CPUs idle", lines[2])
+
+    def test_without_resource_options(self):
+        command = ['STAR', '--runThreadN', '16', '--genomeDir', 'genome', '--limitBAMsortRAM', '1000']
+        self.assertEqual(['STAR', '--genomeDir', 'genome'],
+                         without_resource_options(command, STAR_RESOURCE_OPTIONS))
+
+
+if __name__ == '__main__':
+    SUITE = []
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(ResourcesTest))
+    if len(sys.argv) > 1 and sys.argv[1] == 'xml':
+        xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
+    else:
+        unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+"""
+run_kallisto_test.py - Unit tests for the per sample quantification of the
+globalsearch.rnaseq.run_kallisto module
+"""
+
+import unittest
+import xmlrunner
+import os, sys
+import shutil
+import subprocess
+import tempfile
+import time
+from unittest import mock
+import globalsearch.rnaseq.run_kallisto as run_kallisto
+from globalsearch.rnaseq.resources import StagePlan
+
+SAMPLES = [("R1_L1_1", ["R1_L1_1_val_1.fq.gz", "R1_L1_2_val_2.fq.gz"]),
+           ("R1_L2_1", ["R1_L2_1_val_1.fq.gz", "R1_L2_2_val_2.fq.gz"]),
+           ("R1_L3_1", ["R1_L3_1_val_1.fq.gz", "R1_L3_2_val_2.fq.gz"])]
+
+
+def fake_kallisto(command, **kwargs):
+    outdir = command[command.index('-o') + 1]
+    os.makedirs(outdir, exist_ok=True)
+    with open(os.path.join(outdir, "abundance.tsv"), 'w') as outfile:
+        outfile.write("target_id\tlength\teff_length\test_counts\ttpm\n")
+    return subprocess.CompletedProcess(command, 0)
+
+
+def fake_popen(command, **kwargs):
+    """a finished kallisto process of the pool"""
+    proc = mock.Mock(pid=0)
+    proc.wait.return_value = fake_kallisto(command).returncode
+    return proc
+
+
+class RunKallistoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.results_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.results_dir)
+
+    def __commands(self, run):
+        return sorted([call[0][0] for call in run.call_args_list], key=lambda command: command[4])
+
+    def test_one_run_per_sample(self):
+        """every sample is quantified once, with its own files, into its own directory"""
+        with mock.patch.object(run_kallisto.subprocess, 'Popen', side_effect=fake_popen) as run:
+            sample_dirs = run_kallisto.kallisto_pool("index", self.results_dir, SAMPLES, StagePlan(16, 1, None))
+        commands = self.__commands(run)
+        self.assertEqual(3, len(commands))
+        for command, (name, input_files) in zip(commands, SAMPLES):
+            self.assertEqual(input_files, command[4:6])
+            self.assertEqual('5', command[command.index('-t') + 1])
+        self.assertEqual([os.path.join(self.results_dir, name) for name, input_files in SAMPLES], sample_dirs)
+        for sample_dir in sample_dirs:
+            self.assertEqual(["abundance.tsv"], os.listdir(sample_dir))
+        self.assertEqual(sorted(name for name, input_files in SAMPLES), sorted(os.listdir(self.results_dir)))
+
+    def test_thread_budget(self):
+        """samples only run side by side if each gets enough threads"""
+        with mock.patch.object(run_kallisto.subprocess, 'Popen', side_effect=fake_popen) as run:
+            run_kallisto.kallisto_pool("index", self.results_dir, SAMPLES, StagePlan(4, 1, None))
+        for command in self.__commands(run):
+            self.assertEqual('4', command[command.index('-t') + 1])
+
+    def test_resume(self):
+        """finished samples are skipped, interrupted ones are computed again"""
+        os.makedirs(os.path.join(self.results_dir, "R1_L1_1"))
+        os.makedirs(os.path.join(self.results_dir, "R1_L2_1.tmp"))
+        with mock.patch.object(run_kallisto.subprocess, 'Popen', side_effect=fake_popen) as run:
+            run_kallisto.kallisto_pool("index", self.results_dir, SAMPLES, StagePlan(16, 1, None))
+        self.assertEqual(2, run.call_count)
+        self.assertFalse(os.path.exists(os.path.join(self.results_dir, "R1_L2_1.tmp")))
+
+    def test_failure(self):
+        failed = mock.Mock(pid=0)
+        failed.wait.return_value = 1
+        with mock.patch.object(run_kallisto.subprocess, 'Popen', return_value=failed):
+            with self.assertRaises(subprocess.CalledProcessError):
+                run_kallisto.kallisto_pool("index", self.results_dir, SAMPLES, StagePlan(16, 1, None))
+        self.assertEqual([], os.listdir(self.results_dir))
+
+    def test_failure_stops_running(self):
+        """the running kallisto processes are terminated and their results not committed"""
+        bindir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(bindir, 'kallisto'), 'w') as outfile:
+                # arguments: quant -i <index> <file 1> <file 2> -o <dir> ...
+                outfile.write("#!/bin/sh\ncase $4 in *L2*) sleep 1; exit 1;; esac\n"
+                              "mkdir -p $7 && touch $7/abundance.tsv\nsleep 30\n")
+            os.chmod(os.path.join(bindir, 'kallisto'), 0o755)
+            start = time.time()
+            with mock.patch.dict(os.environ, {'PATH': bindir + os.pathsep + os.environ['PATH']}):
+                with self.assertRaises(subprocess.CalledProcessError):
+                    run_kallisto.kallisto_pool("index", self.results_dir, SAMPLES, StagePlan(16, 1, None))
+            self.assertLess(time.time() - start, 20)
+            self.assertEqual([], [name for name in os.listdir(self.results_dir) if not name.endswith('.tmp')])
+        finally:
+            shutil.rmtree(bindir)
+
+
+if __name__ == '__main__':
+    SUITE = []
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(RunKallistoTest))
+    if len(sys.argv) > 1 and sys.argv[1] == 'xml':
+        xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
+    else:
+        unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
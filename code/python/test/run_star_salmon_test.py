@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+"""
+run_star_salmon_test.py - Unit tests for the streaming deduplication of the
+globalsearch.rnaseq.run_star_salmon module
+"""
+
+import unittest
+import xmlrunner
+import argparse
+import os, sys
+import shutil
+import subprocess
+import tempfile
+import time
+from unittest import mock
+import globalsearch.rnaseq.run_star_salmon as run_star_salmon
+from globalsearch.rnaseq.resources import StagePlan
+
+# STAR opens its output pipe (<prefix>Processed.out.bam) and writes into it
+FAKE_STAR = """#!/bin/sh
+while [ $# -gt 0 ]; do
+  case $1 in --outFileNamePrefix) prefix=$2;; esac
+  shift
+done
+printf 'BAM' > ${prefix}Processed.out.bam
+"""
+# samtools view copies the pipe, samtools sort writes its input to the -o file
+FAKE_SAMTOOLS = """#!/bin/sh
+case $1 in
+  view) %s;;
+  sort) while [ $# -gt 1 ]; do case $1 in -o) out=$2;; esac; shift; done; cat > $out;;
+esac
+"""
+
+
+class DedupStreamingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.bindir = os.path.join(self.tmpdir, "bin")
+        self.results_dir = os.path.join(self.tmpdir, "results")
+        os.makedirs(self.bindir)
+        os.makedirs(self.results_dir)
+        self.args = argparse.Namespace(starPrefix='star',
+                                       resource_plan={'dedup_streaming': StagePlan(2, 3, None)})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def __write_tools(self, view):
+        for name, text in [("STAR", FAKE_STAR), ("samtools", FAKE_SAMTOOLS % view)]:
+            with open(os.path.join(self.bindir, name), 'w') as outfile:
+                outfile.write(text)
+            os.chmod(os.path.join(self.bindir, name), 0o755)
+
+    def __dedup(self):
+        with mock.patch.dict(os.environ, {'PATH': self.bindir + os.pathsep + os.environ['PATH']}):
+            return run_star_salmon.dedup_streaming(self.results_dir, "R1", self.args)
+
+    def test_streaming(self):
+        self.__write_tools('cat "$(eval echo \\${$#})"')
+        result = self.__dedup()
+        with open(result) as infile:
+            self.assertEqual("BAM", infile.read())
+        self.assertEqual([os.path.basename(result)], os.listdir(self.results_dir))
+
+    def test_reader_fails(self):
+        """STAR is stopped if samtools view exits before it opens the pipe"""
+        self.__write_tools('exit 2')
+        start = time.time()
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.__dedup()
+        self.assertLess(time.time() - start, 20)
+        self.assertEqual([], os.listdir(self.results_dir))
+
+
+if __name__ == '__main__':
+    SUITE = []
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(DedupStreamingTest))
+    if len(sys.argv) > 1 and sys.argv[1] == 'xml':
+        xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
+    else:
+        unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
@@ -3,3 +3,22 @@
 PYTHONPATH=. test/find_files_test.py
 PYTHONPATH=. test/trim_galore_test.py
 PYTHONPATH=. test/check_params_test.py
+PYTHONPATH=. test/discovery_cache_test.py
+PYTHONPATH=. test/checkpoint_test.py
+PYTHONPATH=. test/star_sweep_test.py
+PYTHONPATH=. test/resources_test.py
+PYTHONPATH=. test/index_star_test.py
+PYTHONPATH=. test/run_star_salmon_test.py
+PYTHONPATH=. test/cohort_twopass_test.py
+PYTHONPATH=. test/shared_genome_test.py
+PYTHONPATH=. test/index_cache_test.py
+PYTHONPATH=. test/fasta_stats_test.py
+PYTHONPATH=. test/fasta_index_test.py
+PYTHONPATH=. test/run_kallisto_test.py
+PYTHONPATH=. test/kallisto_batch_test.py
+PYTHONPATH=. test/salmon_quants_test.py
+PYTHONPATH=. test/matrix_h5_test.py
+PYTHONPATH=. test/organism_index_test.py
+PYTHONPATH=. test/tximport_test.py
+PYTHONPATH=. test/kallisto_bootstrap_test.py
+PYTHONPATH=. test/fastq_preflight_test.py
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+"""
+salmon_quants_test.py - Unit tests for the globalsearch.rnaseq.salmon_quants module
+"""
+
+import unittest
+import xmlrunner
+import os, sys
+import shutil
+import tempfile
+from unittest import mock
+import numpy as np
+import globalsearch.rnaseq.salmon_quants as salmon_quants
+import globalsearch.rnaseq.matrix_h5 as matrix_h5
+
+QUANT_HEADER = "Name\tLength\tEffectiveLength\tTPM\tNumReads\n"
+
+
+class SalmonQuantsTest(unittest.TestCase):
+
+    def __write_quant(self, folder, rows, quant_dir="salmon_x_salmon_quant"):
+        path = os.path.join(self.analysis_dir, folder, "results_STAR_Salmon", quant_dir)
+        os.makedirs(path)
+        with open(os.path.join(path, "quant.sf"), 'w') as outfile:
+            outfile.write(QUANT_HEADER)
+            for name, tpm, numreads in rows:
+                outfile.write("%s\t1000\t800.5\t%s\t%s\n" % (name, tpm, numreads))
+        return os.path.join(path, "quant.sf")
+
+    def setUp(self):
+        self.analysis_dir = tempfile.mkdtemp()
+        self.outdir = tempfile.mkdtemp()
+        self.__write_quant("R1", [("Past_g1", 10.5, 3), ("Smic_g1", 0, 0), ("Past_g2", 1e6, 1234.5)])
+        self.__write_quant("R2", [("Past_g1", 1, 2), ("Smic_g1", 3, 4), ("Past_g2", 5, 6)])
+        # a transcript that only occurs in one sample, another one missing
+        self.__write_quant("R3", [("Smic_g2", 7, 8), ("Past_g1", 9, 10)])
+
+    def tearDown(self):
+        shutil.rmtree(self.analysis_dir)
+        shutil.rmtree(self.outdir)
+
+    def __read(self, path):
+        with open(path) as infile:
+            return [line.rstrip('\n').split(',') for line in infile]
+
+    def test_build_matrices(self):
+        quant_files = salmon_quants.find_quant_files(self.analysis_dir)
+        self.assertEqual(3, len(quant_files))
+        names, tpms, numreads = salmon_quants.build_matrices(quant_files, workers=2)
+        self.assertEqual(["Past_g1", "Smic_g1", "Past_g2", "Smic_g2"], names)
+        self.assertEqual([10.5, 1, 9], list(tpms[0]))
+        self.assertEqual([1234.5, 6], list(numreads[2, :2]))
+        self.assertTrue(np.isnan(tpms[1, 2]))
+        self.assertEqual(8, numreads[3, 2])
+        self.assertTrue(np.isnan(numreads[3, :2]).all())
+
+    def test_sample_names(self):
+        """columns are named by data folder, sweep settings by their directory"""
+        self.__write_quant("R1", [("Past_g1", 1, 1)], quant_dir="salmon_y_salmon_quant")
+        quant_files = salmon_quants.find_quant_files(self.analysis_dir)
+        self.assertEqual(["R1/results_STAR_Salmon/salmon_x_salmon_quant",
+                          "R1/results_STAR_Salmon/salmon_y_salmon_quant", "R2", "R3"],
+                         salmon_quants.sample_names(quant_files, self.analysis_dir))
+
+    def test_extract_salmon_quants(self):
+        """the same files as the R version"""
+        salmon_quants.extract_salmon_quants(["Past", "Smic"], self.analysis_dir, self.outdir, workers=1)
+        merged = self.__read(os.path.join(self.outdir, "TPMs", "STAR_Salmon_Past_Smic_TPM_matrix_Merged.csv"))
+        self.assertEqual(["gene_id", "R1", "R2", "R3"], merged[0])
+        self.assertEqual(["Past_g1", "10.5", "1", "9"], merged[1])
+        self.assertEqual(["Smic_g1", "0", "3", "NA"], merged[2])
+        self.assertEqual(["Past_g2", "1000000", "5", "NA"], merged[3])
+        past = self.__read(os.path.join(self.outdir, "TPMs", "STAR_Salmon_Past_Smic_TPM_matrix_Past.csv"))
+        self.assertEqual(["gene_id", "Past_g1", "Past_g2"], [row[0] for row in past])
+        smic = self.__read(os.path.join(self.outdir, "Counts", "STAR_Salmon_Past_Smic_NumReads_matrix_Smic.csv"))
+        self.assertEqual([["gene_id", "R1", "R2", "R3"], ["Smic_g1", "0", "4", "NA"], ["Smic_g2", "NA", "NA", "8"]],
+                         smic)
+
+    def test_hdf5(self):
+        """only the HDF5 file, with the same values as the CSV files"""
+        salmon_quants.extract_salmon_quants(["Past", "Smic"], self.analysis_dir, self.outdir, workers=1,
+                                            formats=["hdf5"])
+        self.assertEqual(["STAR_Salmon_Past_Smic_matrices.h5"], os.listdir(self.outdir))
+        path = salmon_quants.hdf5_path(self.outdir, ["Past", "Smic"])
+        gene_ids, samples, matrix = matrix_h5.read_matrix(path, "NumReads", organism="Smic")
+        self.assertEqual(["Smic_g1", "Smic_g2"], gene_ids)
+        self.assertEqual(["R1", "R2", "R3"], samples)
+        np.testing.assert_array_equal([[0, 4, np.nan], [np.nan, np.nan, 8]], matrix)
+        with self.assertRaises(ValueError):
+            salmon_quants.extract_salmon_quants(["Past"], self.analysis_dir, self.outdir, formats=["parquet"])
+
+    def test_incremental(self):
+        """only new and changed quant files are parsed, columns of removed files are dropped"""
+        organisms = ["Past", "Smic"]
+        salmon_quants.extract_salmon_quants(organisms, self.analysis_dir, self.outdir, workers=1,
+                                            incremental=True)
+        path = salmon_quants.hdf5_path(self.outdir, organisms)
+        self.assertEqual(["R1/results_STAR_Salmon/salmon_x_salmon_quant/quant.sf",
+                          "R2/results_STAR_Salmon/salmon_x_salmon_quant/quant.sf",
+                          "R3/results_STAR_Salmon/salmon_x_salmon_quant/quant.sf"],
+                         salmon_quants.read_state(path).sources)
+
+        # top up with R4, R2 was quantified again and R3 removed
+        self.__write_quant("R4", [("Past_g1", 11, 12), ("Past_g3", 13, 14)])
+        shutil.rmtree(os.path.join(self.analysis_dir, "R2"))
+        self.__write_quant("R2", [("Past_g1", 100, 200), ("Past_g2", 300, 400)])
+        shutil.rmtree(os.path.join(self.analysis_dir, "R3"))
+        with mock.patch.object(salmon_quants, 'build_matrices', wraps=salmon_quants.build_matrices) as build:
+            salmon_quants.extract_salmon_quants(organisms, self.analysis_dir, self.outdir, workers=1,
+                                                incremental=True)
+        self.assertEqual([os.path.join(os.path.realpath(self.analysis_dir), folder,
+                                       "results_STAR_Salmon/salmon_x_salmon_quant/quant.sf")
+                          for folder in ["R2", "R4"]], build.call_args[0][0])
+        gene_ids, samples, numreads = matrix_h5.read_matrix(path, "NumReads")
+        self.assertEqual(["Past_g1", "Smic_g1", "Past_g2", "Past_g3"], gene_ids)
+        self.assertEqual(["R1", "R2", "R4"], samples)
+        np.testing.assert_array_equal([[3, 200, 12], [0, np.nan, np.nan], [1234.5, 400, np.nan],
+                                       [np.nan, np.nan, 14]], numreads)
+        merged = self.__read(os.path.join(self.outdir, "Counts", "STAR_Salmon_Past_Smic_NumReads_matrix_Merged.csv"))
+        self.assertEqual(["Smic_g1", "0", "NA", "NA"], merged[2])
+
+        # nothing changed
+        with mock.patch.object(salmon_quants, 'read_quant') as read_quant:
+            salmon_quants.extract_salmon_quants(organisms, self.analysis_dir, self.outdir, workers=1,
+                                                formats=["hdf5"], incremental=True)
+        read_quant.assert_not_called()
+        np.testing.assert_array_equal(numreads, matrix_h5.read_matrix(path, "NumReads")[2])
+
+    def test_no_quant_files(self):
+        salmon_quants.extract_salmon_quants(["Past"], self.outdir, self.outdir)
+        self.assertEqual([["gene_id"]],
+                         self.__read(os.path.join(self.outdir, "TPMs", "STAR_Salmon_Past_TPM_matrix_Merged.csv")))
+
+
+if __name__ == '__main__':
+    SUITE = []
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(SalmonQuantsTest))
+    if len(sys.argv) > 1 and sys.argv[1] == 'xml':
+        xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
+    else:
+        unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
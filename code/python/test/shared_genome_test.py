@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+"""
+shared_genome_test.py - Unit tests for the globalsearch.rnaseq.shared_genome module
+
+A stand-in STAR executable records the genomeLoad calls
+"""
+
+import unittest
+import xmlrunner
+import os, sys
+import shutil
+import subprocess
+import tempfile
+from unittest import mock
+import globalsearch.rnaseq.shared_genome as shared_genome
+from globalsearch.rnaseq.shared_genome import SharedGenome
+
+FAKE_STAR = """#!/bin/bash
+while [ $# -gt 0 ]; do
+  [ "$1" == "--genomeLoad" ] && echo "$2" >> "%s"
+  shift
+done
+exit 0
+"""
+
+
+class SharedGenomeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.calls_path = os.path.join(self.tmpdir, "calls.log")
+        self.star = os.path.join(self.tmpdir, "STAR")
+        with open(self.star, 'w') as outfile:
+            outfile.write(FAKE_STAR % self.calls_path)
+        os.chmod(self.star, 0o755)
+        self.other_task = subprocess.Popen(['sleep', '60'])
+
+    def tearDown(self):
+        self.other_task.kill()
+        self.other_task.wait()
+        shutil.rmtree(self.tmpdir)
+
+    def __lease(self, pid=None):
+        lease = SharedGenome("/genomes/past_smic", state_dir=self.tmpdir, star_command=self.star)
+        if pid is not None:
+            lease.pid = pid
+        return lease
+
+    def __calls(self):
+        if not os.path.exists(self.calls_path):
+            return []
+        with open(self.calls_path) as infile:
+            return infile.read().split()
+
+    def test_first_loads_last_removes(self):
+        task1, task2 = self.__lease(), self.__lease(self.other_task.pid)
+        task1.acquire()
+        task2.acquire()
+        self.assertEqual(["LoadAndExit"], self.__calls())
+        self.assertEqual([os.getpid(), self.other_task.pid], task1.holders())
+        task1.release()
+        self.assertEqual(["LoadAndExit"], self.__calls())
+        task2.release()
+        self.assertEqual(["LoadAndExit", "Remove"], self.__calls())
+        self.assertEqual([], task1.holders())
+
+    def test_dead_holder_dropped(self):
+        """a task that was killed without releasing the genome does not keep it loaded"""
+        dead_task = subprocess.Popen(['true'])
+        dead_task.wait()
+        self.__lease()._write_holders([dead_task.pid])
+        with self.__lease():
+            self.assertEqual([os.getpid()], self.__lease().holders())
+        # loading an already loaded genome is harmless
+        self.assertEqual(["LoadAndExit", "Remove"], self.__calls())
+
+    def test_load_failure(self):
+        with open(self.star, 'w') as outfile:
+            outfile.write("#!/bin/bash\nexit 1\n")
+        self.assertRaises(subprocess.CalledProcessError, self.__lease().acquire)
+        self.assertEqual([], self.__lease().holders())
+
+    def test_default_state_dir(self):
+        """the lock and state files go into the node shared directory, not a job private /tmp"""
+        with mock.patch.object(shared_genome, 'NODE_SHARED_DIR', self.tmpdir):
+            lease = SharedGenome("/genomes/past_smic", star_command=self.star)
+            self.assertEqual(self.tmpdir, os.path.dirname(lease.lock_path))
+        with mock.patch.object(shared_genome, 'NODE_SHARED_DIR', os.path.join(self.tmpdir, 'missing')):
+            self.assertEqual(tempfile.gettempdir(), shared_genome.default_state_dir())
+
+
+if __name__ == '__main__':
+    SUITE = []
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(SharedGenomeTest))
+    if len(sys.argv) > 1 and sys.argv[1] == 'xml':
+        xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
+    else:
+        unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
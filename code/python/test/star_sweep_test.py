@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+"""
+star_sweep_test.py - Unit tests for the globalsearch.rnaseq.star_sweep module
+"""
+
+import unittest
+import xmlrunner
+import io
+import os, sys
+from globalsearch.rnaseq.star_sweep import (FilterSetting, parse_filter_setting, permissive_setting,
+                                            setting_prefix, alignment_stats, passes_filter,
+                                            filter_sam_stream)
+
+HEADER = "@HD\tVN:1.4\n@SQ\tSN:chr1\tLN:10000\n"
+
+
+def sam_record(name, flag, cigar, seq_len, nm, score, hi=1, pos=100):
+    return '\t'.join([name, str(flag), 'chr1', str(pos), '255', cigar, '=', str(pos + 100), '0',
+                      'A' * seq_len, 'I' * seq_len,
+                      'NH:i:1', 'HI:i:%d' % hi, 'AS:i:%d' % score, 'nM:i:%d' % nm]) + '\n'
+
+
+class StarSweepTest(unittest.TestCase):
+
+    def test_parse_filter_setting(self):
+        setting = parse_filter_setting("10,0.01,0.05,10")
+        self.assertEqual(FilterSetting(10, 0.01, 0.05, 10), setting)
+        self.assertEqual("10_0.01_0.05_10", setting_prefix(setting))
+        self.assertRaises(ValueError, parse_filter_setting, "10,0.01")
+
+    def test_permissive_setting(self):
+        settings = [FilterSetting(10, 0.01, 0.05, 10), FilterSetting(5, 0.3, 0.66, 0)]
+        self.assertEqual(FilterSetting(10, 0.3, 0.05, 0), permissive_setting(settings))
+
+    def test_alignment_stats_paired(self):
+        """nM and AS per alignment, lengths summed over both mates"""
+        records = [sam_record('r1', 99, '50M', 50, 2, 90).rstrip('\n').split('\t'),
+                   sam_record('r1', 147, '10S40M', 50, 2, 90).rstrip('\n').split('\t')]
+        self.assertEqual((2, 90, 90, 100), alignment_stats(records))
+
+    def test_passes_filter(self):
+        stats = (2, 90, 90, 100)
+        self.assertTrue(passes_filter(stats, FilterSetting(10, 0.3, 0.66, 0)))
+        self.assertFalse(passes_filter(stats, FilterSetting(1, 0.3, 0.66, 0)))     # mismatches
+        self.assertFalse(passes_filter(stats, FilterSetting(10, 0.01, 0.66, 0)))   # mismatch ratio
+        self.assertFalse(passes_filter(stats, FilterSetting(10, 0.3, 0.95, 0)))    # score
+        self.assertFalse(passes_filter(stats, FilterSetting(10, 0.3, 0.66, 95)))   # matched bases
+
+    def test_filter_sam_stream(self):
+        """one pass writes each alignment to every output whose setting it passes"""
+        lines = (HEADER +
+                 sam_record('r1', 99, '50M', 50, 0, 98) + sam_record('r1', 147, '50M', 50, 0, 98) +
+                 sam_record('r2', 99, '50M', 50, 4, 80) + sam_record('r2', 147, '50M', 50, 4, 80) +
+                 sam_record('r3', 0, '30M20S', 50, 1, 28))
+        settings = [FilterSetting(10, 0.3, 0.66, 0), FilterSetting(2, 0.3, 0.66, 0),
+                    FilterSetting(10, 0.3, 0.66, 40)]
+        outputs = [io.StringIO() for _ in settings]
+        counts = filter_sam_stream(io.StringIO(lines), outputs, settings)
+        self.assertEqual([2, 1, 2], counts)
+        self.assertTrue(outputs[1].getvalue().startswith(HEADER))
+        names = [[line.split('\t')[0] for line in out.getvalue().splitlines() if not line.startswith('@')]
+                 for out in outputs]
+        self.assertEqual(['r1', 'r1', 'r2', 'r2'], names[0])
+        self.assertEqual(['r1', 'r1'], names[1])
+        self.assertEqual(['r1', 'r1', 'r2', 'r2'], names[2])
+
+    def test_filter_sam_stream_multimapper(self):
+        """the alignments of a multimapper are filtered independently"""
+        lines = (HEADER +
+                 sam_record('r1', 0, '50M', 50, 0, 49, hi=1) +
+                 sam_record('r1', 256, '50M', 50, 3, 40, hi=2, pos=500))
+        settings = [FilterSetting(1, 0.3, 0.66, 0)]
+        outputs = [io.StringIO()]
+        self.assertEqual([1], filter_sam_stream(io.StringIO(lines), outputs, settings))
+        self.assertIn('HI:i:1', outputs[0].getvalue())
+        self.assertNotIn('HI:i:2', outputs[0].getvalue())
+
+
+if __name__ == '__main__':
+    SUITE = []
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(StarSweepTest))
+    if len(sys.argv) > 1 and sys.argv[1] == 'xml':
+        xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
+    else:
+        unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))
@@ -7,6 +7,11 @@ trim_galore_test.py - Unit tests for the globalsearch.rnaseq.trim_galore module
 import unittest
 import xmlrunner
 import os, sys
+import shutil
+import subprocess
+import tempfile
+import time
+from unittest import mock
 import fs
 import globalsearch.rnaseq.trim_galore as trim_galore
 
@@ -60,6 +65,63 @@ class TrimGaloreTest(unittest.TestCase):
         self.assertEqual("/inputdata/R1/R1_3_trimmed.fq.gz", first_pair_group)
         self.assertEqual("", second_pair_group)
 
+    def test_trim_pool_size_cores(self):
+        """pool size is bounded by the cores and the number of pairs"""
+        self.assertEqual(4, trim_galore.trim_pool_size(10, cores=8, cores_per_job=2))
+        self.assertEqual(3, trim_galore.trim_pool_size(3, cores=32, cores_per_job=2))
+        self.assertEqual(1, trim_galore.trim_pool_size(5, cores=1, cores_per_job=2))
+
+    def test_trim_pool_size_memory(self):
+        """memory budget restricts the pool size"""
+        self.assertEqual(2, trim_galore.trim_pool_size(10, cores=32, memory=4,
+                                                       cores_per_job=2, memory_per_job=2))
+
+    def test_trim_galore_pool_statuses(self):
+        """all pairs are trimmed and the exit statuses returned in order"""
+        pair_files = [('/in/R1_1.fq.gz', '/in/R1_2.fq.gz'), ('/in/R2_1.fq.gz', None)]
+        with mock.patch.object(trim_galore, 'trim_galore', return_value=0) as trim:
+            result = trim_galore.trim_galore_pool(pair_files, 'R1', '/out/trimmed', '/out/fastqc',
+                                                  cores=4)
+        self.assertEqual([(pair_files[0], 0), (pair_files[1], 0)], result)
+        self.assertEqual(2, trim.call_count)
+
+    def test_trimmed_files(self):
+        """the output names of trim_galore for a pair and a single file"""
+        self.assertEqual(['/out/trimmed/R1_1_val_1.fq.gz', '/out/trimmed/R1_2_val_2.fq.gz'],
+                         trim_galore.trimmed_files('/in/R1_1.fq.gz', '/in/R1_2.fq.gz', '/out/trimmed'))
+        self.assertEqual(['/out/trimmed/R2_trimmed.fq'],
+                         trim_galore.trimmed_files('/in/R2.fastq', None, '/out/trimmed'))
+
+    def test_trim_galore_pool_fails(self):
+        """a failing trim_galore run fails the whole folder"""
+        pair_files = [('/in/R1_1.fq.gz', '/in/R1_2.fq.gz'), ('/in/R2_1.fq.gz', '/in/R2_2.fq.gz')]
+        with mock.patch.object(trim_galore, 'trim_galore', return_value=1):
+            self.assertRaises(subprocess.CalledProcessError, trim_galore.trim_galore_pool,
+                              pair_files, 'R1', '/out/trimmed', '/out/fastqc', cores=1)
+
+    def test_trim_galore_pool_stops_running(self):
+        """the running trim_galore processes are terminated and their output removed"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            bindir = os.path.join(tmpdir, 'bin')
+            os.makedirs(bindir)
+            with open(os.path.join(bindir, 'trim_galore'), 'w') as outfile:
+                # arguments: --fastqc_args <dir> --output_dir <dir> <file>
+                outfile.write("#!/bin/sh\ncase $5 in *bad*) sleep 1; exit 1;; esac\n"
+                              "touch $4/$(basename $5 .fq.gz)_trimmed.fq.gz\nsleep 30\n")
+            os.chmod(os.path.join(bindir, 'trim_galore'), 0o755)
+            trimmed_dir = os.path.join(tmpdir, 'trimmed')
+            pair_files = [('/in/R1.fq.gz', None), ('/in/R2.fq.gz', None), ('/in/bad.fq.gz', None)]
+            start = time.time()
+            with mock.patch.dict(os.environ, {'PATH': bindir + os.pathsep + os.environ['PATH']}):
+                with mock.patch.object(trim_galore, 'trim_pool_size', return_value=3):
+                    self.assertRaises(subprocess.CalledProcessError, trim_galore.trim_galore_pool,
+                                      pair_files, 'R1', trimmed_dir, os.path.join(tmpdir, 'fastqc'))
+            self.assertLess(time.time() - start, 20)
+            self.assertEqual([], os.listdir(trimmed_dir))
+        finally:
+            shutil.rmtree(tmpdir)
+
 
 if __name__ == '__main__':
     SUITE = []
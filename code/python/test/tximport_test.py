@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+"""
+tximport_test.py - Unit tests for the globalsearch.rnaseq.tximport module
+"""
+
+import unittest
+import xmlrunner
+import os, sys
+import shutil
+import tempfile
+import h5py
+import numpy as np
+import globalsearch.rnaseq.tximport as tximport
+
+GFF3 = """##gff-version 3
+chr1\tsrc\tgene\t1\t900\t.\t+\t.\tID=gA;Name=geneA
+chr1\tsrc\tmRNA\t1\t900\t.\t+\t.\tID=t1;Parent=gA;Name=t1_name
+chr1\tsrc\texon\t1\t900\t.\t+\t.\tID=t1.exon1;Parent=t1
+chr1\tsrc\tmRNA\t1\t500\t.\t+\t.\tID=t2;Parent=gA
+chr2\tsrc\tmRNA\t1\t500\t.\t+\t.\tID=t3;Parent=gB
+chr2\tsrc\tgene\t1\t500\t.\t+\t.\tID=gB
+chr3\tsrc\tpseudogene\t1\t500\t.\t+\t.\tID=gC
+chr3\tsrc\ttranscript\t1\t500\t.\t+\t.\tID=t4;Parent=gC
+"""
+GTF = """chr1\tsrc\texon\t1\t900\t.\t+\t.\tgene_id "gA"; transcript_id "t1";
+chr1\tsrc\texon\t1\t500\t.\t+\t.\tgene_id "gA"; transcript_id "t2";
+chr2\tsrc\tgene\t1\t500\t.\t+\t.\tgene_id "gB";
+"""
+# transcript: (effective length, counts, TPM) of the samples
+SAMPLE1 = [("t1", 100, 10, 300), ("t2", 200, 20, 100), ("t3", 50, 6, 600), ("t4", 80, 0, 0), ("t5", 10, 1, 1)]
+SAMPLE2 = [("t5", 10, 0, 0), ("t4", 120, 0, 0), ("t3", 50, 5, 400), ("t2", 200, 0, 0), ("t1", 100, 0, 0)]
+
+
+class TximportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.gff = os.path.join(self.tmpdir, "genome.gff3")
+        with open(self.gff, 'w') as outfile:
+            outfile.write(GFF3)
+        self.analysis_dir = os.path.join(self.tmpdir, "analysis")
+        for folder, rows in [("R1", SAMPLE1), ("R2", SAMPLE2)]:
+            quant_dir = os.path.join(self.analysis_dir, folder, "results_STAR_Salmon", "salmon_x_salmon_quant")
+            os.makedirs(quant_dir)
+            with open(os.path.join(quant_dir, "quant.sf"), 'w') as outfile:
+                outfile.write("Name\tLength\tEffectiveLength\tTPM\tNumReads\n")
+                for name, length, counts, tpm in rows:
+                    outfile.write("%s\t%d\t%d\t%g\t%g\n" % (name, length + 100, length, tpm, counts))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_gff3(self):
+        tx2gene = tximport.load_tx2gene(self.gff)
+        self.assertEqual({"t1": "gA", "t1_name": "gA", "t2": "gA", "t3": "gB", "t4": "gC"}, tx2gene)
+        with open(self.gff + ".tx2gene") as infile:
+            self.assertEqual("t1\tgA\n", infile.readline())
+        # the cached map is used while it is current
+        with open(self.gff + ".tx2gene", 'a') as outfile:
+            outfile.write("cached\tgZ\n")
+        self.assertEqual("gZ", tximport.load_tx2gene(self.gff)["cached"])
+
+    def test_gtf_and_table(self):
+        path = os.path.join(self.tmpdir, "genome.gtf")
+        with open(path, 'w') as outfile:
+            outfile.write(GTF)
+        self.assertEqual({"t1": "gA", "t2": "gA"}, tximport.parse_tx2gene(path))
+        path = os.path.join(self.tmpdir, "tx2gene.csv")
+        with open(path, 'w') as outfile:
+            outfile.write("t1,gA\nt3,gB\n")
+        self.assertEqual({"t1": "gA", "t3": "gB"}, tximport.load_tx2gene(path))
+
+    def __summarize(self, counts_from_abundance):
+        paths = tximport.find_quantifications('salmon', self.analysis_dir)
+        names, lengths, counts, abundance = tximport.read_quantifications(paths, workers=1)
+        return tximport.summarize_to_genes(names, lengths, counts, abundance, tximport.load_tx2gene(self.gff),
+                                           counts_from_abundance)
+
+    def test_summarize(self):
+        gene_ids, lengths, counts, abundance = self.__summarize('no')
+        self.assertEqual(["gA", "gB", "gC"], gene_ids)
+        np.testing.assert_array_equal([[400, 0], [600, 400], [0, 0]], abundance)
+        np.testing.assert_array_equal([[30, 0], [6, 5], [0, 0]], counts)
+        # abundance weighted, the geometric mean of the other samples or the mean transcript length
+        np.testing.assert_allclose([[125, 125], [50, 50], [100, 100]], lengths)
+
+    def test_counts_from_abundance(self):
+        gene_ids, lengths, counts, abundance = self.__summarize('scaledTPM')
+        np.testing.assert_allclose([[14.4, 0], [21.6, 5], [0, 0]], counts)
+        gene_ids, lengths, counts, abundance = self.__summarize('lengthScaledTPM')
+        np.testing.assert_allclose([[22.5, 0], [13.5, 5], [0, 0]], counts)
+        with self.assertRaises(ValueError):
+            self.__summarize('TPM')
+
+    def test_kallisto_h5(self):
+        path = os.path.join(self.tmpdir, "K1", "abundance.h5")
+        os.makedirs(os.path.dirname(path))
+        with h5py.File(path, 'w') as outfile:
+            outfile.create_dataset("aux/ids", data=[b"t1", b"t2", b"t3"])
+            outfile.create_dataset("aux/eff_lengths", data=[100.0, 200.0, 0.0])
+            outfile.create_dataset("est_counts", data=[30.0, 20.0, 1.0])
+        with open(os.path.join(self.tmpdir, "K1", "abundance.tsv"), 'w') as outfile:
+            outfile.write("target_id\tlength\teff_length\test_counts\ttpm\n")
+        self.assertEqual([path], tximport.find_quantifications('kallisto', self.tmpdir))
+        names, lengths, counts, abundance = tximport.read_quantification(path)
+        self.assertEqual(["t1", "t2", "t3"], names)
+        np.testing.assert_allclose([750000, 250000, 0], abundance)
+
+    def test_kallisto_batch_results_not_mixed(self):
+        """kallisto batch mode results can't be combined with kallisto quant results"""
+        for sample in ("K1", "K2"):
+            os.makedirs(os.path.join(self.tmpdir, sample))
+            with open(os.path.join(self.tmpdir, sample, "abundance.tsv"), 'w') as outfile:
+                outfile.write("target_id\tlength\teff_length\test_counts\ttpm\n")
+        with open(os.path.join(self.tmpdir, "K1", tximport.BATCH_MARKER), 'w') as outfile:
+            outfile.write("{}")
+        with self.assertRaises(ValueError):
+            tximport.find_quantifications('kallisto', self.tmpdir)
+        with open(os.path.join(self.tmpdir, "K2", tximport.BATCH_MARKER), 'w') as outfile:
+            outfile.write("{}")
+        self.assertEqual(2, len(tximport.find_quantifications('kallisto', self.tmpdir)))
+
+    def test_tximport(self):
+        outdir = os.path.join(self.tmpdir, "out")
+        tximport.tximport('salmon', self.analysis_dir, self.gff, outdir, counts_from_abundance='lengthScaledTPM',
+                          workers=1, formats=['csv', 'hdf5'])
+        self.assertEqual(["STAR_Salmon_gene_abundance.csv", "STAR_Salmon_gene_counts.csv",
+                          "STAR_Salmon_gene_length.csv", "STAR_Salmon_gene_matrices.h5"], sorted(os.listdir(outdir)))
+        with open(os.path.join(outdir, "STAR_Salmon_gene_counts.csv")) as infile:
+            self.assertEqual(["gene_id,R1,R2\n", "gA,22.5,0\n", "gB,13.5,5\n", "gC,0,0\n"], infile.readlines())
+
+    def test_kallisto_batch_lengths(self):
+        """batch mode results have no effective lengths, lengthScaledTPM is refused"""
+        analysis_dir = os.path.join(self.tmpdir, "kallisto")
+        for sample, counts in (("K1", "12.5"), ("K2", "1234567.8")):
+            os.makedirs(os.path.join(analysis_dir, sample))
+            with open(os.path.join(analysis_dir, sample, "abundance.tsv"), 'w') as outfile:
+                outfile.write("target_id\tlength\teff_length\test_counts\ttpm\nt1\t600\t600\t%s\t1000000.0\n" %
+                              counts)
+            with open(os.path.join(analysis_dir, sample, tximport.BATCH_MARKER), 'w') as outfile:
+                outfile.write("{}")
+        outdir = os.path.join(self.tmpdir, "out")
+        with self.assertRaises(ValueError):
+            tximport.tximport('kallisto', analysis_dir, self.gff, outdir, counts_from_abundance='lengthScaledTPM',
+                              workers=1)
+        tximport.tximport('kallisto', analysis_dir, self.gff, outdir, workers=1)
+        with open(os.path.join(outdir, "Kallisto_gene_counts.csv")) as infile:
+            self.assertEqual(["gene_id,K1,K2\n", "gA,12.5,1234567.8\n"], infile.readlines())
+
+    def test_other_transcripts(self):
+        with open(os.path.join(self.analysis_dir, "R2", "results_STAR_Salmon", "salmon_x_salmon_quant",
+                               "quant.sf"), 'a') as outfile:
+            outfile.write("t6\t100\t50\t0\t0\n")
+        with self.assertRaises(ValueError):
+            tximport.read_quantifications(tximport.find_quantifications('salmon', self.analysis_dir), workers=1)
+
+
+if __name__ == '__main__':
+    SUITE = []
+    SUITE.append(unittest.TestLoader().loadTestsFromTestCase(TximportTest))
+    if len(sys.argv) > 1 and sys.argv[1] == 'xml':
+        xmlrunner.XMLTestRunner(output='test-reports').run(unittest.TestSuite(SUITE))
+    else:
+        unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(SUITE))